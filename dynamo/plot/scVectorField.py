@@ -3,7 +3,7 @@ import pandas as pd
 from .utilities import quiver_autoscaler
 from ..tools.dimension_reduction import reduceDimension
 from ..tools.cell_velocities import cell_velocities
-from ..tools.Markov import velocity_on_grid
+from ..tools.Markov import velocity_on_grid, velocity_grid
 from ..tools.scVectorField import VectorField
 
 
@@ -292,7 +292,10 @@ def grid_velocity(adata, genes, x=0, y=1, method='SparseVFC', basis='trimap', n_
                             "adjust_for_stream": True, "V_threshold": None}
         grid_kwargs_dict.update(g_kwargs_dict)
 
-        X_grid, V_grid, D = velocity_on_grid(X[:, [x, y]], V[:, [x, y]], xy_grid_nums, **grid_kwargs_dict)
+        # the grid-to-cell neighbor map is cached in adata and reused by later plots
+        grid = velocity_grid(adata, basis, xy_grid_nums, density=grid_kwargs_dict['density'],
+                             smooth=grid_kwargs_dict['smooth'], n_neighbors=grid_kwargs_dict['n_neighbors'], dims=[x, y])
+        X_grid, V_grid, D = velocity_on_grid(X[:, [x, y]], V[:, [x, y]], xy_grid_nums, grid=grid, **grid_kwargs_dict)
 
     if quiver_scale is None:
         quiver_scale = quiver_autoscaler(X_grid, V_grid)
@@ -482,7 +485,10 @@ def stremline_plot(adata, genes, x=0, y=1, method='sparseVFC', basis='trimap', n
                             "adjust_for_stream": True, "V_threshold": None}
         grid_kwargs_dict.update(g_kwargs_dict)
 
-        X_grid, V_grid, D = velocity_on_grid(X[:, [x, y]], V[:, [x, y]], xy_grid_nums, **grid_kwargs_dict)
+        # the grid-to-cell neighbor map is cached in adata and reused by later plots
+        grid = velocity_grid(adata, basis, xy_grid_nums, density=grid_kwargs_dict['density'],
+                             smooth=grid_kwargs_dict['smooth'], n_neighbors=grid_kwargs_dict['n_neighbors'], dims=[x, y])
+        X_grid, V_grid, D = velocity_on_grid(X[:, [x, y]], V[:, [x, y]], xy_grid_nums, grid=grid, **grid_kwargs_dict)
 
 
     # if quiver_scale is None:
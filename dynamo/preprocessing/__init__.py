@@ -1,5 +1,5 @@
 """Mapping Vector Field of Single Cells
 """
 
-from .preprocess import szFactor, normalize_expr_data, recipe_monocle, Gini, topTable, Dispersion, filter_cells, filter_genes
+from .preprocess import szFactor, normalize_expr_data, recipe_monocle, recipe_monocle_chunked, Gini, topTable, Dispersion, filter_cells, filter_genes, summary_stats
 from .utilities import cook_dist
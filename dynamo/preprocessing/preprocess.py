@@ -2,9 +2,10 @@ import numpy as np
 import pandas as pd
 from sklearn.utils import sparsefuncs
 import warnings
-from scipy.sparse import issparse, csr_matrix
-from sklearn.decomposition import TruncatedSVD, FastICA
+from scipy.sparse import issparse, csr_matrix, vstack as sp_vstack
+from sklearn.decomposition import FastICA
 from .utilities import cook_dist, get_layer_keys
+from ..tools.utils import _get_chunk_size
 
 def szFactor(adata, layers='all', total_layers=None, locfunc=np.nanmean, round_exprs=True, method='mean-geometric-mean-total'):
     """Calculate the size factor of the each cell using geometric mean of total UMI across cells for a AnnData object.
@@ -56,29 +57,22 @@ def szFactor(adata, layers='all', total_layers=None, locfunc=np.nanmean, round_e
         else:
             CM = adata.layers[layer]
 
-        if round_exprs:
-            if issparse(CM):
-                CM.data = np.round(CM.data, 0)
-            else:
-                CM = CM.round().astype('int')
-
-        cell_total = CM.sum(axis=1)
-        cell_total += cell_total == 0  # avoid infinity value after log (0)
+        if round_exprs and issparse(CM):
+            CM.data = np.round(CM.data, 0)
 
-        if method == 'mean-geometric-mean-total':
-            sfs = cell_total / np.exp(locfunc(np.log(cell_total)))
-        elif method == "median":
-            sfs = cell_total / np.nanmedian(cell_total)
+        if layer == 'raw' or layer == '_total_':
+            CM = CM.round().astype('int') if round_exprs and not issparse(CM) else CM
+            cell_total = np.asarray(CM.sum(axis=1)).flatten()
         else:
-            print('This method is not supported!')
+            cell_total = _get_layer_stats(adata, layer, round_exprs)['cell_total']
+        sfs = _size_factor(cell_total, locfunc, method)
 
-        sfs[~np.isfinite(sfs)] = 1
         if layer is 'raw':
             adata.obs[layer + '_Size_Factor'] = sfs
             adata.obs['Size_Factor'] = sfs
         elif layer is 'X':
             adata.obs['Size_Factor'] = sfs
-        elif layer is 'total_':
+        elif layer == '_total_':
             adata.obs['total_Size_Factor'] = sfs
             del adata.layers['_total_']
         else:
@@ -86,7 +80,24 @@ def szFactor(adata, layers='all', total_layers=None, locfunc=np.nanmean, round_e
 
     return adata
 
-def normalize_expr_data(adata, layers='all', total_szfactor=None, norm_method='log', pseudo_expr=1, relative_expr=True, keep_filtered=True):
+
+def _size_factor(cell_total, locfunc=np.nanmean, method='mean-geometric-mean-total'):
+    """Convert the total UMI / reads of each cell into size factors (see szFactor)."""
+    cell_total = cell_total + (cell_total == 0)  # avoid infinity value after log (0)
+
+    if method == 'mean-geometric-mean-total':
+        sfs = cell_total / np.exp(locfunc(np.log(cell_total)))
+    elif method == "median":
+        sfs = cell_total / np.nanmedian(cell_total)
+    else:
+        print('This method is not supported!')
+
+    sfs[~np.isfinite(sfs)] = 1
+
+    return sfs
+
+def normalize_expr_data(adata, layers='all', total_szfactor=None, norm_method='log', pseudo_expr=1, relative_expr=True, keep_filtered=True,
+                        dtype=np.float64):
     """Normalize the gene expression value for the AnnData object
     This function is partly based on Monocle R package (https://github.com/cole-trapnell-lab/monocle3).
 
@@ -107,11 +118,14 @@ def normalize_expr_data(adata, layers='all', total_szfactor=None, norm_method='l
         keep_filtered: `bool` (default: `True`)
             A logic flag to determine whether we will only store feature genes in the adata object. If it is False, size factor
             will be recalculated only for the selected feature genes.
+        dtype: `numpy.dtype` (default: `np.float64`)
+            The data type of the normalized values, `np.float32` halves the memory of the normalized layers.
 
     Returns
     -------
         adata: :AnnData
-            A updated anndata object that are updated with normalized expression values for different layers.
+            A updated anndata object that are updated with normalized expression values for different layers. The raw layers
+            are left untouched.
     """
 
     if 'use_for_dynamo' in adata.var.columns and keep_filtered is False:
@@ -133,33 +147,30 @@ def normalize_expr_data(adata, layers='all', total_szfactor=None, norm_method='l
     for layer in layers:
         if layer is 'raw':
             CM = adata.raw
-            szfactors = adata.obs[layer + 'Size_Factor'][:, None]
+            szfactors = adata.obs[layer + '_Size_Factor'].values
         elif layer is 'X':
             CM = adata.X
-            szfactors = adata.obs['Size_Factor'][:, None]
+            szfactors = adata.obs['Size_Factor'].values
         elif layer is 'protein':
             if 'protein' in adata.obsm_keys():
                CM = adata.obsm[layer]
-               szfactors = adata.obs['protein_Size_Factor'][:, None]
+               szfactors = adata.obs['protein_Size_Factor'].values
             else:
                 continue
         else:
             CM = adata.layers[layer]
-            szfactors = adata.obs[layer + '_Size_Factor'][:, None]
+            szfactors = adata.obs[layer + '_Size_Factor'].values
 
         if norm_method == 'log' and layer is not 'protein':
             if relative_expr:
                 if total_szfactor is not None and total_szfactor in adata.obs.keys():
-                    szfactors = adata.obs[total_szfactor][:, None]
-
-                CM = CM.multiply(csr_matrix(1/szfactors)) if issparse(CM) else CM / szfactors
+                    szfactors = adata.obs[total_szfactor].values
+            else:
+                szfactors = None
 
             if pseudo_expr is None:
                 pseudo_expr = 1
-            if issparse(CM):
-                CM.data = np.log2(CM.data + pseudo_expr)
-            else:
-                CM = np.log2(CM + pseudo_expr)
+            CM = _log_normalize(CM, szfactors, pseudo_expr, dtype)
 
         elif layer is 'protein': # norm_method == 'clr':
             if norm_method is not 'clr':
@@ -167,17 +178,7 @@ def normalize_expr_data(adata, layers='all', total_szfactor=None, norm_method='l
             """This normalization implements the centered log-ratio (CLR) normalization from Seurat which is computed for
             each gene (M Stoeckius, ‎2017).
             """
-            CM = CM.T
-            n_feature = CM.shape[1]
-
-            for i in range(CM.shape[0]):
-                x = CM[i].A if issparse(CM) else CM[i]
-                res = np.log1p(x / (np.exp(np.nansum(np.log1p(x[x > 0])) / n_feature)))
-                res[np.isnan(res)] = 0
-                # res[res > 100] = 100
-                CM[i] = res # no .A is required # https://stackoverflow.com/questions/28427236/set-row-of-csr-matrix
-
-            CM = CM.T
+            CM = _clr_normalize(CM, dtype)
         else:
             warnings.warn(norm_method + ' is not implemented yet')
 
@@ -191,7 +192,53 @@ def normalize_expr_data(adata, layers='all', total_szfactor=None, norm_method='l
     return adata
 
 
-def Gini(adata, layers='all'):
+def _log_normalize(CM, szfactors=None, pseudo_expr=1, dtype=np.float64):
+    """Divide each row (cell) of CM by its size factor and log2 transform the result on a single owned copy of CM,
+    which is scaled and transformed in place. CM itself is left untouched."""
+    if issparse(CM):
+        CM = CM.__class__((CM.data.astype(dtype), CM.indices.copy(), CM.indptr.copy()), shape=CM.shape)
+        CM.sum_duplicates()
+        if szfactors is not None:
+            sparsefuncs.inplace_row_scale(CM, 1 / np.asarray(szfactors, dtype=float).flatten())
+        CM.data += pseudo_expr
+        np.log2(CM.data, out=CM.data)
+    else:
+        CM = np.array(CM, dtype=dtype)
+        if szfactors is not None:
+            CM /= np.asarray(szfactors, dtype=float).reshape(-1, 1)
+        CM += pseudo_expr
+        np.log2(CM, out=CM)
+
+    return CM
+
+
+def _clr_normalize(CM, dtype=np.float64):
+    """Centered log-ratio normalization of each feature (column) of CM, computed for all the features at once on a copy
+    of CM."""
+    n_obs = CM.shape[0]
+
+    if issparse(CM):
+        fmt = CM.format
+        CM = CM.tocsc(copy=True).astype(dtype)
+        col = np.repeat(np.arange(CM.shape[1]), np.diff(CM.indptr))
+        pos = CM.data > 0
+        log_gm = np.bincount(col[pos], weights=np.log1p(CM.data[pos]), minlength=CM.shape[1]) / n_obs
+        CM.data /= np.exp(log_gm)[col].astype(dtype)
+        np.log1p(CM.data, out=CM.data)
+        CM.data[np.isnan(CM.data)] = 0
+        # res[res > 100] = 100
+        CM = CM.asformat(fmt)
+    else:
+        CM = np.array(CM, dtype=dtype)
+        log_gm = np.log1p(np.where(CM > 0, CM, 0)).sum(0) / n_obs
+        CM /= np.exp(log_gm)[None, :]
+        np.log1p(CM, out=CM)
+        CM[np.isnan(CM)] = 0
+
+    return CM
+
+
+def Gini(adata, layers='all', n_jobs=1, chunk_size=None):
     """Calculate the Gini coefficient of a numpy array.
      https://github.com/thomasmaxwellnorman/perturbseq_demo/blob/master/perturbseq/util.py
 
@@ -200,7 +247,12 @@ def Gini(adata, layers='all'):
         adata: :class:`~anndata.AnnData`
             AnnData object
         layers: str (default: None)
-            The layer(s) to be normalized. Default is all, including RNA (X, raw) or spliced, unspliced, protein, etc.
+            The layer(s) to be normalized. Default is all, including RNA (X, raw) or spliced, unspliced, etc.
+        n_jobs: `int` (default: `1`)
+            Number of threads used to process the blocks of genes; -1 means all cores.
+        chunk_size: `int` or None (default: `None`)
+            Number of genes per block. By default a block of a sparse matrix has about 2^24 nonzero values and a block of
+            a dense matrix at most 2^23 values.
 
     Returns
     -------
@@ -211,34 +263,43 @@ def Gini(adata, layers='all'):
     # From: https://github.com/oliviaguest/gini
     # based on bottom eq: http://www.statsdirect.com/help/content/image/stat0206_wmf.gif
     # from: http://www.statsdirect.com/help/default.htm#nonparametric_methods/gini.htm
+    from concurrent.futures import ThreadPoolExecutor
+    from ..tools.utils import _get_n_jobs
 
-    layers = get_layer_keys(adata, layers)
+    # the protein features are not genes and can't be stored in the var attribute
+    layers = get_layer_keys(adata, layers, include_protein=False)
+    n_jobs = _get_n_jobs(n_jobs)
 
     for layer in layers:
         if layer is 'raw':
             CM = adata.raw
         elif layer is 'X':
             CM = adata.X
-        elif layer is 'protein':
-            if 'protein' in adata.obsm_keys():
-                CM = adata.obsm[layer]
-            else:
-                continue
         else:
             CM = adata.layers[layer]
 
-        n_features = adata.shape[1]
-        gini = np.zeros(n_features)
+        n_features = CM.shape[1]
+        has_negative = np.amin(CM) < 0 if layer == 'raw' else _get_layer_stats(adata, layer)['min'] < 0
+
+        if issparse(CM):
+            CM = CM.tocsc()
+            block_size = chunk_size if chunk_size is not None else max(1, int(2**24 * n_features / max(CM.nnz, 1)))
+            gini_fun = lambda start, end: _gini_csc(CM.data[CM.indptr[start]:CM.indptr[end]],
+                                                    CM.indptr[start:end + 1] - CM.indptr[start], CM.shape[0], has_negative)
+        else:
+            block_size = chunk_size if chunk_size is not None else max(1, 2**23 // max(CM.shape[0], 1))
+            gini_fun = lambda start, end: _gini_dense(CM[:, start:end], has_negative)
 
-        for i in np.arange(n_features):
-            cur_cm = CM[:, i].A if issparse(CM) else CM[:, i] #all values are treated equally, arrays must be 1d
-            if np.amin(CM) < 0:
-                cur_cm -= np.amin(cur_cm) #values cannot be negative
-            cur_cm += 0.0000001 # np.min(array[array!=0]) #values cannot be 0
-            cur_cm = np.sort(cur_cm) #values must be sorted
-            index = np.arange(1,cur_cm.shape[0]+1) #index per array element
-            n = cur_cm.shape[0] #number of array elements
-            gini[i] = ((np.sum((2 * index - n  - 1) * cur_cm)) / (n * np.sum(cur_cm))) #Gini coefficient
+        if n_jobs > 1:
+            block_size = min(block_size, int(np.ceil(n_features / n_jobs)))
+        starts = np.arange(0, n_features, block_size)
+        ends = np.minimum(starts + block_size, n_features)
+
+        if n_jobs > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                gini = np.hstack(list(executor.map(gini_fun, starts, ends)))
+        else:
+            gini = np.hstack([gini_fun(start, end) for start, end in zip(starts, ends)])
 
         if layer in ['raw', 'X']:
             adata.var['gini'] = gini
@@ -248,6 +309,48 @@ def Gini(adata, layers='all'):
     return adata
 
 
+def _gini_dense(CM, has_negative=False):
+    """Gini coefficient of each column of a dense matrix."""
+    cur_cm = np.array(CM, dtype=float)
+    if has_negative:
+        cur_cm -= cur_cm.min(0) #values cannot be negative
+    cur_cm += 0.0000001 # np.min(array[array!=0]) #values cannot be 0
+    cur_cm.sort(axis=0) #values must be sorted
+    index = np.arange(1, cur_cm.shape[0] + 1)[:, None] #index per array element
+    n = cur_cm.shape[0] #number of array elements
+
+    return np.sum((2 * index - n - 1) * cur_cm, 0) / (n * np.sum(cur_cm, 0)) #Gini coefficient
+
+
+def _gini_csc(data, indptr, n, has_negative=False):
+    """Gini coefficient of each column of a csc matrix (given by its data and indptr arrays) with n rows.
+
+    Only the nonzero values are sorted: in the sorted column the implicit zeros sit between the negative and the
+    positive values, so the rank of a nonzero value is its rank among the nonzeros, shifted by the number of implicit
+    zeros for non-negative values. As sum(2 * index - n - 1) = 0, the shift by the column minimum and the small constant
+    added to the values don't change the numerator and only enter the denominator.
+    """
+    n_cols = len(indptr) - 1
+    nnz = np.diff(indptr)
+    n_zeros = n - nnz
+    col = np.repeat(np.arange(n_cols), nnz)
+    x = data[np.lexsort((data, col))].astype(float) # col is already sorted so the columns stay in place
+
+    rank = np.arange(1, len(x) + 1) - indptr[col]
+    n_neg = np.bincount(col, weights=x < 0, minlength=n_cols)
+    rank = rank + n_zeros[col] * (rank > n_neg[col])
+
+    numerator = np.bincount(col, weights=(2 * rank - n - 1) * x, minlength=n_cols)
+    total = np.bincount(col, weights=x, minlength=n_cols)
+    if has_negative:
+        col_min = np.zeros(n_cols)
+        col_min[nnz > 0] = x[indptr[:-1][nnz > 0]]
+        col_min[n_zeros > 0] = np.minimum(col_min[n_zeros > 0], 0)
+        total = total - n * col_min
+
+    return numerator / (n * (total + n * 0.0000001)) #Gini coefficient
+
+
 def parametricDispersionFit(disp_table, initial_coefs=np.array([1e-6, 1])):
     """fThis function is partly based on Monocle R package (https://github.com/cole-trapnell-lab/monocle3).
 
@@ -320,56 +423,43 @@ def disp_calc_helper_NB(adata, layers='X', min_cells_detected=1):
 
     res_list = []
     for layer in layers:
-        if layer is 'raw':
-            CM = adata.raw
-            szfactors = adata.obs[layer + 'Size_Factor'][:, None]
-        elif layer is 'X':
-            CM = adata.X
-            szfactors = adata.obs['Size_Factor'][:, None]
-        else:
-            CM = adata.layers[layer]
-            szfactors = adata.obs[layer + 'Size_Factor'][:, None]
-
-        if issparse(CM):
-            CM.data = np.round(CM.data, 0)
-            rounded = CM
-        else:
-            rounded = CM.round().astype('int')
+        szfactors = adata.obs['Size_Factor' if layer == 'X' else layer + '_Size_Factor'].values
+        stats, mean, mean_sq = _gene_moments(adata, layer, szfactors, round_exprs=True)
 
-        lowerDetectedLimit = adata.uns['lowerDetectedLimit'] if 'lowerDetectedLimit' in adata.uns.keys() else 1
-        nzGenes = (rounded > lowerDetectedLimit).sum(axis=0)
-        nzGenes = nzGenes > min_cells_detected
-
-        nzGenes = nzGenes.A1 if issparse(rounded) else nzGenes
-        if layer is layer.__contains__('X_'):
-            x = rounded[:, nzGenes]
-        else:
-            x = rounded[:, nzGenes].multiply(csr_matrix(1/szfactors)) if issparse(rounded) else rounded[:, nzGenes] / szfactors
+        nzGenes = stats['gene_n_detected'] > min_cells_detected
+        n_obs = stats['shape'][0]
 
         xim = np.mean(1 / szfactors) if szfactors is not None else 1
 
-        f_expression_mean = x.mean(axis=0)
+        f_expression_mean = mean[nzGenes]
 
         # For NB: Var(Y) = mu * (1 + mu / k)
-        # x.A.var(axis=0, ddof=1)
-        f_expression_var = (x.multiply(x).mean(0).A1 - f_expression_mean.A1 ** 2) * x.shape[0] / (x.shape[0] - 1) if issparse(x) else x.var(axis=0, ddof=1)**2 # np.mean(np.power(x - f_expression_mean, 2), axis=0) # variance with n - 1
-        # https://scialert.net/fulltext/?doi=ajms.2010.1.15 method of moments
-        disp_guess_meth_moments = f_expression_var - xim * f_expression_mean # variance - mu
-
-        disp_guess_meth_moments = disp_guess_meth_moments / np.power(f_expression_mean, 2) # this is dispersion parameter (1/k)
+        f_expression_var = (mean_sq[nzGenes] - f_expression_mean ** 2) * n_obs / (n_obs - 1) # variance with n - 1
 
-        res = pd.DataFrame({"mu": np.array(f_expression_mean).flatten(), "disp": np.array(disp_guess_meth_moments).flatten()})
-        res.loc[res['mu'] == 0, 'mu'] = None
-        res.loc[res['mu'] == 0, 'disp'] = None
-        res.loc[res['disp'] < 0, 'disp'] = 0
-
-        res['gene_id'] = adata.var_names[nzGenes]
+        res = _disp_table(f_expression_mean, f_expression_var, xim, adata.var_names[nzGenes])
 
         res_list.append(res)
 
     return layers, res_list
 
 
+def _disp_table(f_expression_mean, f_expression_var, xim, gene_id):
+    """Build the method of moments dispersion table from the per gene mean and variance (see disp_calc_helper_NB)."""
+    # https://scialert.net/fulltext/?doi=ajms.2010.1.15 method of moments
+    disp_guess_meth_moments = f_expression_var - xim * f_expression_mean # variance - mu
+
+    disp_guess_meth_moments = disp_guess_meth_moments / np.power(f_expression_mean, 2) # this is dispersion parameter (1/k)
+
+    res = pd.DataFrame({"mu": np.array(f_expression_mean).flatten(), "disp": np.array(disp_guess_meth_moments).flatten()})
+    res.loc[res['mu'] == 0, 'mu'] = None
+    res.loc[res['mu'] == 0, 'disp'] = None
+    res.loc[res['disp'] < 0, 'disp'] = 0
+
+    res['gene_id'] = gene_id
+
+    return res
+
+
 def topTable(adata, layer='X', mode='dispersion'):
     """ This function is partly based on Monocle R package (https://github.com/cole-trapnell-lab/monocle3).
 
@@ -401,7 +491,10 @@ def topTable(adata, layer='X', mode='dispersion'):
         top_df = top_df.set_index('gene_id')
 
     elif mode is 'gini':
-        top_df = adata.var[layer + '_gini']
+        key = 'gini' if layer in ['raw', 'X'] else layer + '_gini'
+        if key not in adata.var.keys():
+            Gini(adata, layers=layer)
+        top_df = adata.var.loc[:, [key]].rename(columns={key: 'gini'})
 
     return top_df
 
@@ -477,12 +570,19 @@ def Dispersion(adata, layers='X', modelFormulaStr="~ 1", min_cells_detected=1, r
 
     cds_pdata = adata.obs  # .loc[:, model_terms]
     cds_pdata['rowname'] = cds_pdata.index.values
-    layers, disp_tables = disp_calc_helper_NB(adata[:, :], layers, min_cells_detected)
+    layers, disp_tables = disp_calc_helper_NB(adata, layers, min_cells_detected)
     # disp_table['disp'] = np.random.uniform(0, 10, 11)
     # disp_table = cds_pdata.apply(disp_calc_helper_NB(adata[:, :], min_cells_detected))
 
     # cds_pdata <- dplyr::group_by_(dplyr::select_(rownames_to_column(pData(cds)), "rowname", .dots=model_terms), .dots=model_terms)
     # disp_table <- as.data.frame(cds_pdata %>% do(disp_calc_helper_NB(cds[,.$rowname], cds@expressionFamily, min_cells_detected)))
+    _fit_dispersion(adata, layers, disp_tables, removeOutliers)
+
+    return adata
+
+
+def _fit_dispersion(adata, layers, disp_tables, removeOutliers=False):
+    """Fit the parametric dispersion model to each dispersion table and store it in the uns attribute (see Dispersion)."""
     for ind in range(len(layers)):
         layer, disp_table = layers[ind], disp_tables[ind]
 
@@ -518,8 +618,6 @@ def Dispersion(adata, layers='X', modelFormulaStr="~ 1", min_cells_detected=1, r
         else:
             adata.uns[layer + '_dispFitInfo'] = {"disp_table": good, "disp_func": ans, "coefs": coefs}
 
-    return adata
-
 
 def SVRs(adata, filter_bool=None, layers='X', total_szfactor=None, min_expr_cells=2, min_expr_avg=0, max_expr_avg=20, svr_gamma=None,
                          winsorize=False, winsor_perc=(1, 99.5), sort_inverse=False):
@@ -556,76 +654,74 @@ def SVRs(adata, filter_bool=None, layers='X', total_szfactor=None, min_expr_cell
             A updated annData object with `log_m`, `log_cv`, `score` added to .obs columns and `SVR` added to uns attribute
             as a new key.
     """
-    from sklearn.svm import SVR
-
     layers = get_layer_keys(adata, layers)
 
     for layer in layers:
-        if layer is 'raw':
-            CM = adata.X.copy() if adata.raw is None else adata.raw
-            szfactors = adata.obs[layer + '_Size_Factor'][:, None] if adata.raw is not None else adata.obs['Size_Factor'][:, None]
-        elif layer is 'X':
-            CM = adata.X.copy()
-            szfactors = adata.obs['Size_Factor'][:, None]
-        elif layer is 'protein':
-            if 'protein' in adata.obsm_keys():
-                CM = adata.obsm['protein'].copy()
-                szfactors = adata.obs[layer + '_Size_Factor'][:, None]
-            else:
-                continue
-        else:
-            CM = adata.layers[layer].copy()
-            szfactors = adata.obs[layer + '_Size_Factor'][:, None]
+        if layer == 'protein' and 'protein' not in adata.obsm_keys():
+            continue
 
+        szfactors = adata.obs['Size_Factor' if layer == 'X' else layer + '_Size_Factor'].values
         if total_szfactor is not None and total_szfactor in adata.obs.keys():
-            szfactors = adata.obs[total_szfactor][:, None]
-        if issparse(CM):
-            sparsefuncs.inplace_row_scale(CM, 1 / szfactors)
-        else:
-            CM /= 1 / szfactors
+            szfactors = adata.obs[total_szfactor].values
 
         if winsorize:
+            CM = _get_layer_matrix(adata, layer).copy()
+            if issparse(CM):
+                sparsefuncs.inplace_row_scale(CM, 1 / szfactors)
+            else:
+                CM = CM / szfactors[:, None]
             if min_expr_cells <= ((100 - winsor_perc[1]) * CM.shape[0] * 0.01):
                 min_expr_cells = int(np.ceil((100 - winsor_perc[1]) * CM.shape[1] * 0.01)) + 2
+            n_expr_cells, mean = np.array((CM > 0).sum(0)).flatten(), np.array(CM.mean(0)).flatten()
+        else:
+            # the moments of the size factor normalized data are taken from the summary statistics, no copy is needed
+            stats, mean, mean_sq = _gene_moments(adata, layer, szfactors)
+            n_expr_cells = stats['gene_n_expr']
 
-        detected_bool = np.array(((CM > 0).sum(0) > min_expr_cells) & (CM.mean(0) < max_expr_avg) & (
-                    CM.mean(0) > min_expr_avg)).flatten()
+        detected_bool = (n_expr_cells > min_expr_cells) & (mean < max_expr_avg) & (mean > min_expr_avg)
 
         if filter_bool is not None:
             detected_bool = filter_bool & detected_bool
 
-        valid_CM = CM[:, detected_bool]
         if winsorize:
+            valid_CM = CM[:, detected_bool]
             down, up = np.percentile(valid_CM.A, winsor_perc, 0) if issparse(valid_CM) else np.percentile(valid_CM, winsor_perc, 0)
             Sfw = np.clip(valid_CM.A, down[None, :], up[None, :]) if issparse(valid_CM) else np.percentile(valid_CM, winsor_perc, 0)
             mu = Sfw.mean(0)
             sigma = Sfw.std(0, ddof=1)
         else:
-            mu = np.array(valid_CM.mean(0)).flatten()
-            sigma = np.array(np.sqrt(valid_CM.multiply(valid_CM).mean(0).A1 - mu ** 2)).flatten() if issparse(valid_CM) else valid_CM.std(0, ddof=1)
+            mu = mean[detected_bool]
+            sigma = np.sqrt(mean_sq[detected_bool] - mu ** 2)
 
-        cv = sigma / mu
-        log_m = np.array(np.log2(mu)).flatten()
-        log_cv = np.array(np.log2(cv)).flatten()
+        _fit_svr(adata, layer, mu, sigma, detected_bool, svr_gamma, sort_inverse)
 
-        if svr_gamma is None:
-            svr_gamma = 150. / len(mu)
-        # Fit the Support Vector Regression
-        clf = SVR(gamma=svr_gamma)
-        clf.fit(log_m[:, None], log_cv)
-        fitted_fun = clf.predict
-        ff = fitted_fun(log_m[:, None])
-        score = log_cv - ff
-        if sort_inverse:
-            score = - score
+    return adata
+
+
+def _fit_svr(adata, layer, mu, sigma, detected_bool, svr_gamma=None, sort_inverse=False):
+    """Fit the log cv vs log mean SVR of the detected genes and store the scores in the var attribute (see SVRs)."""
+    from sklearn.svm import SVR
 
-        adata.var['log_m'], adata.var['log_cv'], adata.var['score'] = np.nan, np.nan, -np.inf
-        adata.var.loc[detected_bool, 'log_m'], adata.var.loc[detected_bool, 'log_cv'], adata.var.loc[detected_bool, 'score'] = np.array(log_m).flatten(), np.array(log_cv).flatten(), np.array(score).flatten()
+    cv = sigma / mu
+    log_m = np.array(np.log2(mu)).flatten()
+    log_cv = np.array(np.log2(cv)).flatten()
 
-        key = "velocyto_SVR" if layer is 'raw' or layer is 'X' else layer + "_velocyto_SVR"
-        adata.uns[key] = {"SVR": fitted_fun, "detected_bool": detected_bool}
+    if svr_gamma is None:
+        svr_gamma = 150. / len(mu)
+    # Fit the Support Vector Regression
+    clf = SVR(gamma=svr_gamma)
+    clf.fit(log_m[:, None], log_cv)
+    fitted_fun = clf.predict
+    ff = fitted_fun(log_m[:, None])
+    score = log_cv - ff
+    if sort_inverse:
+        score = - score
 
-        adata
+    adata.var['log_m'], adata.var['log_cv'], adata.var['score'] = np.nan, np.nan, -np.inf
+    adata.var.loc[detected_bool, 'log_m'], adata.var.loc[detected_bool, 'log_cv'], adata.var.loc[detected_bool, 'score'] = np.array(log_m).flatten(), np.array(log_cv).flatten(), np.array(score).flatten()
+
+    key = "velocyto_SVR" if layer == 'raw' or layer == 'X' else layer + "_velocyto_SVR"
+    adata.uns[key] = {"SVR": fitted_fun, "detected_bool": detected_bool}
 
 
 def filter_cells(adata, filter_bool=None, layer='all', keep_filtered=False, min_expr_genes_s=50, min_expr_genes_u=25, min_expr_genes_p=1,
@@ -663,15 +759,15 @@ def filter_cells(adata, filter_bool=None, layer='all', keep_filtered=False, min_
             False.
     """
 
-    detected_bool = np.ones(adata.X.shape[0], dtype=bool)
-    detected_bool = (detected_bool) & (((adata.X > 0).sum(1) > min_expr_genes_s) & ((adata.X > 0).sum(1) < max_expr_genes_s)).flatten()
+    n_expr_genes = {'X': _get_layer_stats(adata, 'X')['cell_n_expr']}
+    for key in ['spliced', 'unspliced']:
+        if key in adata.layers.keys() and (layer == key or layer == 'all'):
+            n_expr_genes[key] = _get_layer_stats(adata, key)['cell_n_expr']
+    if "protein" in adata.obsm.keys() and (layer == 'protein' or layer == 'all'):
+        n_expr_genes['protein'] = _get_layer_stats(adata, 'protein')['cell_n_expr']
 
-    if ("spliced" in adata.layers.keys()) & (layer is 'spliced' or layer is 'all'):
-        detected_bool = detected_bool & (((adata.layers['spliced'] > 0).sum(1) > min_expr_genes_s) & ((adata.layers['spliced'] > 0).sum(1) < max_expr_genes_s)).flatten()
-    if ("unspliced" in adata.layers.keys()) & (layer is 'unspliced' or layer is 'all'):
-        detected_bool = detected_bool & (((adata.layers['unspliced'] > 0).sum(1) > min_expr_genes_u) & ((adata.layers['unspliced'] > 0).sum(1) < max_expr_genes_u)).flatten()
-    if ("protein" in adata.obsm.keys()) & (layer is 'protein' or layer is 'all'):
-        detected_bool = detected_bool & (((adata.obsm['protein'] > 0).sum(1) > min_expr_genes_p) & ((adata.obsm['protein'] > 0).sum(1) < max_expr_genes_p)).flatten()
+    detected_bool = _cell_filter_bool(n_expr_genes, min_expr_genes_s, min_expr_genes_u, min_expr_genes_p,
+                                      max_expr_genes_s, max_expr_genes_u, max_expr_genes_p)
 
     filter_bool = filter_bool & detected_bool if filter_bool is not None else detected_bool
 
@@ -684,6 +780,19 @@ def filter_cells(adata, filter_bool=None, layer='all', keep_filtered=False, min_
     return adata
 
 
+def _cell_filter_bool(n_expr_genes, min_expr_genes_s=50, min_expr_genes_u=25, min_expr_genes_p=1,
+                      max_expr_genes_s=np.inf, max_expr_genes_u=np.inf, max_expr_genes_p=np.inf):
+    """Apply the filter_cells thresholds to the number of expressed genes per cell of each layer (X, spliced,
+    unspliced, protein) in n_expr_genes."""
+    detected_bool = np.ones(len(n_expr_genes['X']), dtype=bool)
+    for key, min_expr, max_expr in [('X', min_expr_genes_s, max_expr_genes_s), ('spliced', min_expr_genes_s, max_expr_genes_s),
+                                    ('unspliced', min_expr_genes_u, max_expr_genes_u), ('protein', min_expr_genes_p, max_expr_genes_p)]:
+        if key in n_expr_genes.keys():
+            detected_bool = detected_bool & (n_expr_genes[key] > min_expr) & (n_expr_genes[key] < max_expr)
+
+    return detected_bool
+
+
 def filter_genes(adata, filter_bool=None, layer='X', total_szfactor=None, keep_filtered=True, min_cell_s=5, min_cell_u=5, min_cell_p=5,
                  min_avg_exp_s=1e-2, min_avg_exp_u=1e-4, min_avg_exp_p=1e-4, max_avg_exp=100., sort_by='SVR',
                  n_top_genes=2000):
@@ -727,59 +836,83 @@ def filter_genes(adata, filter_bool=None, layer='X', total_szfactor=None, keep_f
             downstream analysis. adata will be subsetted with only the genes pass filter if keep_unflitered is set to be False.
     """
 
-    detected_bool = np.ones(adata.X.shape[1], dtype=bool)
-    detected_bool = (detected_bool) & np.array(((adata.X > 0).sum(0) > min_cell_s) & (adata.X.mean(0) > min_avg_exp_s) & (adata.X.mean(0) < max_avg_exp)).flatten()
-
-    if "spliced" in adata.layers.keys() and layer is 'spliced':
-        detected_bool = detected_bool & np.array(((adata.layers['spliced'] > 0).sum(0) > min_cell_s) & (adata.layers['spliced'].mean(0) > min_avg_exp_s) & (adata.layers['spliced'].mean(0) < max_avg_exp)).flatten()
-    if "unspliced" in adata.layers.keys() and layer is 'unspliced':
-        detected_bool = detected_bool & np.array(((adata.layers['unspliced'] > 0).sum(0) > min_cell_u) & (adata.layers['unspliced'].mean(0) > min_avg_exp_u) & (adata.layers['unspliced'].mean(0) < max_avg_exp)).flatten()
+    keys = ['X'] + [key for key in ['spliced', 'unspliced'] if key in adata.layers.keys() and layer == key]
     ############################## The following code need to be updated ##############################
     # just remove genes that are not following the protein criteria
     if "protein" in adata.obsm.keys() and layer is 'protein':
-        detected_bool = detected_bool & np.array(((adata.obsm['protein'] > 0).sum(0) > min_cell_p) & (adata.obsm['protein'].mean(0) > min_avg_exp_p) & (adata.obsm['protein'].mean(0) < max_avg_exp)).flatten()
+        keys.append('protein')
+
+    n_expr_cells, avg_exp = {}, {}
+    for key in keys:
+        stats = _get_layer_stats(adata, key)
+        n_expr_cells[key], avg_exp[key] = stats['gene_n_expr'], stats['gene_sum'] / stats['shape'][0]
+
+    detected_bool = _gene_filter_bool(n_expr_cells, avg_exp, min_cell_s, min_cell_u, min_cell_p, min_avg_exp_s,
+                                      min_avg_exp_u, min_avg_exp_p, max_avg_exp)
 
     filter_bool = filter_bool & detected_bool if filter_bool is not None else detected_bool
 
     adata.var['pass_basic_filter'] = np.array(filter_bool).flatten()
+    if sort_by == 'SVR':
+        SVRs(adata, layers=layer, total_szfactor=total_szfactor, filter_bool=filter_bool, min_expr_cells=0, min_expr_avg=0, max_expr_avg=np.inf,
+             svr_gamma=None, winsorize=False, winsor_perc=(1, 99.5), sort_inverse=False)
+    filter_bool = _top_genes(adata, filter_bool, layer, sort_by, n_top_genes)
+
+    if keep_filtered:
+        adata.var['use_for_dynamo'] = np.array(filter_bool).flatten()
+    else:
+        adata = adata[:, np.array(filter_bool).flatten()]
+        adata.var['use_for_dynamo'] = True
+
+
+    return adata
+
+
+def _gene_filter_bool(n_expr_cells, avg_exp, min_cell_s=5, min_cell_u=5, min_cell_p=5, min_avg_exp_s=1e-2, min_avg_exp_u=1e-4,
+                      min_avg_exp_p=1e-4, max_avg_exp=100.):
+    """Apply the filter_genes thresholds to the number of expressing cells and the average expression of each gene in
+    the layers (X, spliced, unspliced, protein) of n_expr_cells and avg_exp."""
+    detected_bool = np.ones(len(n_expr_cells['X']), dtype=bool)
+    for key, min_cell, min_avg_exp in [('X', min_cell_s, min_avg_exp_s), ('spliced', min_cell_s, min_avg_exp_s),
+                                       ('unspliced', min_cell_u, min_avg_exp_u), ('protein', min_cell_p, min_avg_exp_p)]:
+        if key in n_expr_cells.keys():
+            detected_bool = detected_bool & (n_expr_cells[key] > min_cell) & (avg_exp[key] > min_avg_exp) & (avg_exp[key] < max_avg_exp)
+
+    return detected_bool
+
+
+def _top_genes(adata, filter_bool, layer='X', sort_by='SVR', n_top_genes=2000):
+    """Select the top genes among those passing filter_bool, based on the dispersion, gini or SVR scores (see filter_genes)."""
     n_top_genes = np.min([n_top_genes, adata.shape[1]])
-    if sort_by is 'dispersion':
+    if sort_by == 'dispersion':
         table = topTable(adata, layer, mode='dispersion')
         valid_table = table.query("dispersion_empirical > dispersion_fit")
-        valid_table = valid_table.loc[set(adata.var.index[filter_bool]).intersection(valid_table.index), :]
+        valid_table = valid_table.loc[list(set(adata.var.index[filter_bool]).intersection(valid_table.index)), :]
         gene_id = np.argsort(-valid_table.loc[:, 'dispersion_empirical'])[:n_top_genes]
         gene_id = valid_table.iloc[gene_id, :].index
         filter_bool = adata.var.index.isin(gene_id)
-    elif sort_by is 'gini':
+    elif sort_by == 'gini':
         table = topTable(adata, layer, mode='gini')
         valid_table = table.loc[filter_bool, :]
-        gene_id = np.argsort(-valid_table.loc[:, 'gini'])[:n_top_genes]
+        gene_id = np.argsort(-valid_table.loc[:, 'gini'].values)[:n_top_genes]
         gene_id = valid_table.index[gene_id]
-        filter_bool = gene_id.isin(adata.var.index)
-    elif sort_by is 'SVR':
-        SVRs(adata, layers=layer, total_szfactor=total_szfactor, filter_bool=filter_bool, min_expr_cells=0, min_expr_avg=0, max_expr_avg=np.inf,
-             svr_gamma=None, winsorize=False, winsor_perc=(1, 99.5), sort_inverse=False)
-
+        filter_bool = adata.var.index.isin(gene_id)
+    elif sort_by == 'SVR':
         valid_table = adata.var.loc[filter_bool, :]
         gene_id = np.argsort(-valid_table.loc[:, 'score'])[:n_top_genes]
         gene_id = valid_table.iloc[gene_id, :].index
         filter_bool = adata.var.index.isin(gene_id)
 
-    if keep_filtered:
-        adata.var['use_for_dynamo'] = np.array(filter_bool).flatten()
-    else:
-        adata = adata[:, np.array(filter_bool).flatten()]
-        adata.var['use_for_dynamo'] = True
-
-
-    return adata
+    return filter_bool
 
 
 def recipe_monocle(adata, normalized=None, layer=None, total_layers=None, genes_to_use=None, method='pca', num_dim=50, norm_method='log', pseudo_expr=1,
                    feature_selection='SVR', n_top_genes=2000, relative_expr=True, keep_filtered_cells=True, keep_filtered_genes=True,
-                   fc_kwargs=None, fg_kwargs=None):
+                   fc_kwargs=None, fg_kwargs=None, dtype=np.float64):
     """This function is partly based on Monocle R package (https://github.com/cole-trapnell-lab/monocle3).
 
+    For data that doesn't fit in memory (e.g. adata opened in backed mode) use `recipe_monocle_chunked` instead.
+
     Parameters
     ----------
         adata: :class:`~anndata.AnnData`
@@ -816,6 +949,8 @@ def recipe_monocle(adata, normalized=None, layer=None, total_layers=None, genes_
             Other Parameters passed into the filter_genes function.
         fg_kwargs: `dict` or None (default: `None`)
             Other Parameters passed into the filter_cells function.
+        dtype: `numpy.dtype` (default: `np.float64`)
+            The data type of the normalized data, `np.float32` halves the memory of the normalized layers.
 
     Returns
     -------
@@ -823,6 +958,9 @@ def recipe_monocle(adata, normalized=None, layer=None, total_layers=None, genes_
             A updated anndata object that are updated with Size_Factor, normalized expression values, X and reduced dimensions, etc.
     """
 
+    if getattr(adata, 'isbacked', False):
+        raise Exception('adata is opened in backed mode, please use recipe_monocle_chunked instead.')
+
     # automatically detect whether the data is normalized (only works for readcounts / UMI based data).
     if normalized is None:
         normalized = not np.allclose((adata.X.data[:20] if issparse(adata.X) else adata.X[:, 0]) % 1, 0, atol=1e-3)
@@ -851,7 +989,7 @@ def recipe_monocle(adata, normalized=None, layer=None, total_layers=None, genes_
     if not normalized:
         total_szfactor = 'total_Size_Factor' if total_layers is not None else None
         adata = normalize_expr_data(adata, total_szfactor=total_szfactor, norm_method=norm_method, pseudo_expr=pseudo_expr,
-                                    relative_expr=relative_expr, keep_filtered=keep_filtered_genes)
+                                    relative_expr=relative_expr, keep_filtered=keep_filtered_genes, dtype=dtype)
 
     # only use genes pass filter (based on use_for_dynamo) to perform dimension reduction.
     if layer is None:
@@ -864,15 +1002,30 @@ def recipe_monocle(adata, normalized=None, layer=None, total_layers=None, genes_
         else:
             CM = adata.layers['X_' + layer][:, adata.var.use_for_dynamo.values]
 
+    gene_bool = None if layer == 'protein' else adata.var.use_for_dynamo.values
+    _reduce_dim(adata, CM, method, num_dim, feature_selection, gene_bool)
+
+    return adata
+
+
+def _reduce_dim(adata, CM, method='pca', num_dim=50, feature_selection='SVR', gene_bool=None):
+    """Reduce the (cells x feature genes) matrix CM and store the embedding and the fitted model in adata. For pca, the
+    loadings of the genes in gene_bool (the columns of CM) are also stored in the `PCs` key of the varm attribute."""
     cm_genesums = CM.sum(axis=0)
     valid_ind = (np.isfinite(cm_genesums)) + (cm_genesums != 0)
     valid_ind = np.array(valid_ind).flatten()
     CM = CM[:, valid_ind]
 
-    if method is 'pca':
-        fit = TruncatedSVD(n_components=num_dim + 1, random_state=2019) # unscaled PCA
+    if method == 'pca':
+        from ..tools.dimension_reduction import PCA, _gene_loadings
+
+        fit = PCA(n_components=num_dim + 1, random_state=2019) # unscaled PCA
         reduce_dim = fit.fit_transform(CM)[:, 1:] # first columns is related to the total UMI (or library size)
         adata.uns['explained_variance_ratio_'] = fit.explained_variance_ratio_[1:]
+        if gene_bool is not None:
+            gene_bool = np.array(gene_bool, dtype=bool)
+            gene_bool[gene_bool] = valid_ind
+            adata.varm['PCs'] = _gene_loadings(gene_bool, fit.components_[1:])
     elif method == 'ica':
         fit=FastICA(num_dim,
                 algorithm='deflation', tol=5e-6, fun='logcosh', max_iter=1000)
@@ -881,4 +1034,409 @@ def recipe_monocle(adata, normalized=None, layer=None, total_layers=None, genes_
     adata.obsm['X_' + method.lower()] = reduce_dim
     adata.uns[method+'_fit'], adata.uns['feature_selection'] = fit, feature_selection
 
+
+def _get_layer_matrix(adata, layer):
+    """The data matrix of a layer (include X and protein) which may be a backed (h5ad/zarr) dataset."""
+    if layer == 'X':
+        return adata.X
+    elif layer == 'protein':
+        return adata.obsm['protein']
+    else:
+        return adata.layers[layer]
+
+
+def _iter_row_chunks(M, chunk_size, round_exprs=False):
+    """Iterate over blocks of rows of an in-memory or backed matrix. Sparse blocks are returned as csr copies that can
+    be modified in place."""
+    n_obs = M.shape[0]
+    for start in range(0, n_obs, chunk_size):
+        end = min(start + chunk_size, n_obs)
+        block = M[start:end]
+        if issparse(block):
+            block = csr_matrix(block, copy=True)
+            if round_exprs:
+                block.data = np.round(block.data, 0)
+        else:
+            block = np.asarray(block)
+            if round_exprs:
+                block = block.round()
+
+        yield start, end, block
+
+
+def summary_stats(adata, layers='all', round_exprs=False, chunk_size=None, recompute=False):
+    """Compute the per-cell and per-gene summary statistics of each layer in a single pass over the data and cache them
+    in the `summary_stats` key of the uns attribute. These statistics are used by szFactor, filter_cells, filter_genes,
+    Dispersion, SVRs and Gini instead of rescanning the layers. The cache of a layer is automatically refreshed when the
+    shape, number of nonzeros or total of its data changes. Checking the total costs one sum over the (nonzero) values
+    of the layer per lookup, which is much cheaper than the statistics themselves but not free; edits that keep all
+    three unchanged are not detected, use recompute=True after such edits.
+
+    Parameters
+    ----------
+        adata: :class:`~anndata.AnnData`
+            AnnData object.
+        layers: `str` or list (default: `all`)
+            The layer(s) to summarize. Default is all, including X, spliced, unspliced, protein, etc.
+        round_exprs: `bool` (default: `False`)
+            A logic flag to determine whether the gene expression should be rounded into integers before summarizing.
+        chunk_size: `int` or None (default: `None`)
+            Number of cells read per block. By default a dense block has at most 2^23 elements.
+        recompute: `bool` (default: `False`)
+            Whether to recompute the statistics even if a valid cache exists.
+
+    Returns
+    -------
+        adata: :class:`~anndata.AnnData`
+            A updated anndata object with a `summary_stats` dictionary (keyed by layer) in the uns attribute. For each
+            layer it includes `cell_total`, `cell_n_expr` (number of genes > 0), `gene_n_expr` (number of cells > 0),
+            `gene_n_detected` (number of cells > lowerDetectedLimit), `gene_sum`, `gene_sum_sq`, `gene_sum_rel` and
+            `gene_sum_sq_rel` (the first two moments after dividing each cell by its total), as well as `min` and `max`.
+    """
+    for layer in get_layer_keys(adata, layers):
+        if layer == 'protein' and 'protein' not in adata.obsm_keys():
+            continue
+        _get_layer_stats(adata, layer, round_exprs, chunk_size, recompute)
+
     return adata
+
+
+def _matrix_fingerprint(M):
+    """Description of a matrix used to decide whether its cached summary statistics are still valid. The checksum is a
+    sum over the stored values (O(nnz) without copies), which backed datasets skip because they are read only."""
+    if issparse(M):
+        return {"shape": np.array(M.shape), "nnz": M.nnz, "checksum": float(np.sum(M.data, dtype=np.float64))}
+    elif isinstance(M, np.ndarray):
+        return {"shape": np.array(M.shape), "nnz": -1, "checksum": float(np.sum(M, dtype=np.float64))}
+    else:  # backed datasets are read only
+        return {"shape": np.array(M.shape), "nnz": -1, "checksum": np.nan}
+
+
+def _compute_layer_stats(M, chunk_size=None, round_exprs=False, lower_limit=1):
+    """Per-cell and per-gene summary statistics of M computed in one pass over blocks of cells (see summary_stats)."""
+    n_obs, n_vars = M.shape
+    chunk_size = _get_chunk_size(n_vars, chunk_size)
+    stats = {"rounded": round_exprs, "is_integer": True, "lower_detected_limit": lower_limit, "min": np.inf, "max": -np.inf,
+             "cell_total": np.zeros(n_obs), "cell_n_expr": np.zeros(n_obs, dtype=int),
+             "gene_n_expr": np.zeros(n_vars, dtype=int), "gene_n_detected": np.zeros(n_vars, dtype=int),
+             "gene_sum": np.zeros(n_vars), "gene_sum_sq": np.zeros(n_vars), "gene_sum_rel": np.zeros(n_vars),
+             "gene_sum_sq_rel": np.zeros(n_vars)}
+
+    for start, end, block in _iter_row_chunks(M, chunk_size):
+        values = block.data if issparse(block) else block
+        stats['is_integer'] = stats['is_integer'] and bool(np.all(values % 1 == 0))
+        if round_exprs:
+            if issparse(block):
+                block.data = np.round(block.data, 0)
+            else:
+                block = block.round()
+            values = block.data if issparse(block) else block
+
+        if values.size > 0:
+            stats['min'], stats['max'] = min(stats['min'], values.min()), max(stats['max'], values.max())
+        if issparse(block) and block.nnz < np.prod(block.shape):
+            stats['min'], stats['max'] = min(stats['min'], 0), max(stats['max'], 0)
+
+        block = block.astype(float)
+        cell_total = np.asarray(block.sum(1)).flatten()
+        stats['cell_total'][start:end] = cell_total
+        stats['cell_n_expr'][start:end] = np.asarray((block > 0).sum(1)).flatten()
+        stats['gene_n_expr'] += np.asarray((block > 0).sum(0)).flatten()
+        stats['gene_n_detected'] += np.asarray((block > lower_limit).sum(0)).flatten()
+        stats['gene_sum'] += np.asarray(block.sum(0)).flatten()
+        stats['gene_sum_sq'] += np.asarray(block.multiply(block).sum(0) if issparse(block) else (block ** 2).sum(0)).flatten()
+
+        inv_total = 1 / (cell_total + (cell_total == 0))
+        if issparse(block):
+            sparsefuncs.inplace_row_scale(block, inv_total)
+        else:
+            block *= inv_total[:, None]
+        stats['gene_sum_rel'] += np.asarray(block.sum(0)).flatten()
+        stats['gene_sum_sq_rel'] += np.asarray(block.multiply(block).sum(0) if issparse(block) else (block ** 2).sum(0)).flatten()
+
+    return stats
+
+
+def _get_layer_stats(adata, layer, round_exprs=False, chunk_size=None, recompute=False):
+    """Return the summary statistics of a layer from the uns attribute, (re)computing and caching them if needed. Stats
+    computed from integer data are valid for both the rounded and the raw data."""
+    CM = _get_layer_matrix(adata, layer)
+    lower_limit = adata.uns['lowerDetectedLimit'] if 'lowerDetectedLimit' in adata.uns.keys() else 1
+    fingerprint = _matrix_fingerprint(CM)
+
+    cache = adata.uns['summary_stats'] if 'summary_stats' in adata.uns.keys() else {}
+    stats = cache[layer] if layer in cache.keys() else None
+    if stats is not None and not recompute:
+        valid = np.array_equal(stats['shape'], fingerprint['shape']) and stats['nnz'] == fingerprint['nnz'] and \
+                (stats['checksum'] == fingerprint['checksum'] or (np.isnan(stats['checksum']) and np.isnan(fingerprint['checksum']))) and \
+                stats['lower_detected_limit'] == lower_limit and (stats['rounded'] == round_exprs or stats['is_integer'])
+        if valid:
+            return stats
+
+    stats = _compute_layer_stats(CM, chunk_size, round_exprs, lower_limit)
+    stats.update(fingerprint)
+    if not adata.is_view:  # writing into the uns of a view would make a copy of the data
+        cache[layer] = stats
+        adata.uns['summary_stats'] = cache
+
+    return stats
+
+
+def _gene_moments(adata, layer, szfactors=None, round_exprs=False):
+    """First two moments of the size factor normalized expression of each gene, taken from the summary statistics when
+    the size factors are proportional to the cell totals of the layer (as computed by szFactor)."""
+    stats = _get_layer_stats(adata, layer, round_exprs)
+    n_obs = stats['shape'][0]
+    if szfactors is None:
+        return stats, stats['gene_sum'] / n_obs, stats['gene_sum_sq'] / n_obs
+
+    szfactors = np.asarray(szfactors, dtype=float).flatten()
+    ratio = (stats['cell_total'] + (stats['cell_total'] == 0)) / szfactors
+    if np.all(np.isfinite(ratio)) and np.allclose(ratio, ratio[0], rtol=1e-10, atol=0):
+        scale = ratio.mean()
+        return stats, scale * stats['gene_sum_rel'] / n_obs, scale ** 2 * stats['gene_sum_sq_rel'] / n_obs
+
+    norm_stats = _chunked_col_stats(_get_layer_matrix(adata, layer), _get_chunk_size(stats['shape'][1]), szfactors,
+                                    None, stats['lower_detected_limit'], round_exprs)
+    return stats, norm_stats['sum_norm'] / n_obs, norm_stats['sum_sq_norm'] / n_obs
+
+
+def _chunked_col_stats(M, chunk_size, szfactors=None, cell_bool=None, lower_limit=1, round_exprs=True):
+    """Per gene number of expressing cells (and of cells above lower_limit), total expression and the first two moments
+    of the size factor normalized expression, computed over blocks of the cells in cell_bool."""
+    n_vars = M.shape[1]
+    stats = {"n_obs": 0, "n_expr_cells": np.zeros(n_vars, dtype=int), "n_detected_cells": np.zeros(n_vars, dtype=int),
+             "sum": np.zeros(n_vars), "sum_norm": np.zeros(n_vars), "sum_sq_norm": np.zeros(n_vars)}
+
+    for start, end, block in _iter_row_chunks(M, chunk_size, round_exprs):
+        inv_sz = None if szfactors is None else 1 / szfactors[start:end]
+        if cell_bool is not None:
+            block = block[cell_bool[start:end]]
+            inv_sz = None if inv_sz is None else inv_sz[cell_bool[start:end]]
+
+        stats['n_obs'] += block.shape[0]
+        stats['n_expr_cells'] += np.asarray((block > 0).sum(0)).flatten()
+        stats['n_detected_cells'] += np.asarray((block > lower_limit).sum(0)).flatten()
+        stats['sum'] += np.asarray(block.sum(0)).flatten()
+
+        block = block.astype(float)
+        if inv_sz is not None:
+            if issparse(block):
+                sparsefuncs.inplace_row_scale(block, inv_sz)
+            else:
+                block *= inv_sz[:, None]
+        stats['sum_norm'] += np.asarray(block.sum(0)).flatten()
+        stats['sum_sq_norm'] += np.asarray(block.multiply(block).sum(0) if issparse(block) else (block ** 2).sum(0)).flatten()
+
+    return stats
+
+
+def _chunked_feature_matrix(M, chunk_size, gene_bool, cell_bool=None, szfactors=None, log_transform=False, pseudo_expr=1,
+                            round_exprs=True, dtype=np.float64):
+    """Materialize the (selected cells x selected genes) part of M by reading blocks of cells. Returns the raw data and,
+    if log_transform is True, the (size factor normalized and) log2 transformed data (otherwise None)."""
+    raw_blocks, norm_blocks = [], []
+    for start, end, block in _iter_row_chunks(M, chunk_size, round_exprs):
+        if cell_bool is not None:
+            block = block[cell_bool[start:end]]
+        block = block[:, gene_bool]
+        raw_blocks.append(block)
+
+        if log_transform:
+            block_szfactors = None if szfactors is None else szfactors[start:end] if cell_bool is None else \
+                szfactors[start:end][cell_bool[start:end]]
+            norm_blocks.append(_log_normalize(block, block_szfactors, pseudo_expr, dtype))
+
+    stack = lambda blocks: sp_vstack(blocks, format='csr') if issparse(blocks[0]) else np.vstack(blocks)
+
+    return stack(raw_blocks), stack(norm_blocks) if log_transform else None
+
+
+def recipe_monocle_chunked(adata, normalized=None, layer=None, total_layers=None, genes_to_use=None, method='pca', num_dim=50,
+                           norm_method='log', pseudo_expr=1, feature_selection='SVR', n_top_genes=2000, relative_expr=True,
+                           keep_filtered_cells=True, fc_kwargs=None, fg_kwargs=None, chunk_size=None, dtype=np.float64):
+    """Streaming version of recipe_monocle for data that doesn't fit in memory (e.g. adata opened in backed mode, i.e.
+    `anndata.read_h5ad(filename, backed='r')`).
+
+    Each layer is read in blocks of chunk_size cells, once to get its summary statistics (see summary_stats), which gives
+    the size factors, the dispersion, cell / gene filtering and SVR inputs, and once more to materialize the size factor
+    / log normalized data of the selected feature genes (the gene statistics are recomputed over the selected cells if
+    keep_filtered_cells is False). Unlike recipe_monocle, the layers of adata are never loaded in memory or modified.
+
+    Parameters
+    ----------
+        adata: :class:`~anndata.AnnData`
+            AnnData object, which may be opened in backed mode.
+        normalized: `None` or `bool` (default: `None`)
+            Whether the data is already normalized, see recipe_monocle.
+        layer: str (default: `None`)
+            The layer used for the dimension reduction, see recipe_monocle.
+        total_layers: list or None (default `None`)
+            The layer(s) that can be summed up to get the total mRNA, see recipe_monocle.
+        genes_to_use: `list` (default: `None`)
+            A list genes of gene names that will be used to set as the feature genes for downstream analysis.
+        method: `str` (default: `pca`)
+            The linear dimension reduction methods to be used.
+        num_dim: `int` (default: `50`)
+            The number of linear dimensions reduced to.
+        norm_method: `str` (default: `log`)
+            The method to normalize the data.
+        pseudo_expr: `int` (default: `1`)
+            A pseudocount added to the gene expression value before log2 normalization.
+        feature_selection: `str` (default: `SVR`)
+            Which soring method, either dispersion, SVR or Gini index, to be used to select genes.
+        n_top_genes: `int` (default: `2000`)
+            How many top genes based on scoring method (specified by sort_by) will be selected as feature genes.
+        relative_expr: `bool` (default: `True`)
+            A logic flag to determine whether we need to divide gene expression values first by size factor before normalization.
+        keep_filtered_cells: `bool` (default: `True`)
+            Whether to keep cells that don't pass the filtering in the returned object.
+        fc_kwargs: `dict` or None (default: `None`)
+            Other Parameters passed into the filter_cells function.
+        fg_kwargs: `dict` or None (default: `None`)
+            Other Parameters passed into the filter_genes function.
+        chunk_size: `int` or None (default: `None`)
+            Number of cells read at once. By default it is chosen such that a dense block has at most 2^23 elements.
+        dtype: `numpy.dtype` (default: `np.float64`)
+            The data type of the normalized data, `np.float32` halves the memory of the normalized layers.
+
+    Returns
+    -------
+        feature_adata: :class:`~anndata.AnnData`
+            A new anndata object of the feature genes (use_for_dynamo) only, with the raw and the normalized layers, X,
+            the obs/var columns (Size_Factor, use_for_dynamo, etc.) and the reduced dimensions of recipe_monocle. The
+            same obs/var columns and uns entries are also written into adata.
+    """
+    from anndata import AnnData
+
+    chunk_size = _get_chunk_size(adata.n_vars, chunk_size)
+    layers = [i for i in get_layer_keys(adata, 'all') if i != 'protein']
+
+    if normalized is None:
+        _, _, block = next(_iter_row_chunks(adata.X, chunk_size))
+        normalized = not np.allclose((block.data[:20] if issparse(block) else block[:, 0]) % 1, 0, atol=1e-3)
+    round_exprs = not normalized
+
+    stats = {}
+    for key in layers + (['protein'] if 'protein' in adata.obsm.keys() else []):
+        stats[key] = _get_layer_stats(adata, key, round_exprs, chunk_size)
+
+    if not normalized:
+        # size factors (see szFactor)
+        has_total = total_layers is not None and len(set(adata.layers.keys()).difference(total_layers)) == 0
+        for key in stats.keys():
+            if key == 'X' and has_total:
+                adata.obs['total_Size_Factor'] = _size_factor(np.sum([stats[key]['cell_total'] for key in total_layers], 0))
+            adata.obs['Size_Factor' if key == 'X' else key + '_Size_Factor'] = _size_factor(stats[key]['cell_total'])
+
+        # dispersion of X (see Dispersion and disp_calc_helper_NB with min_cells_detected=1)
+        adata.obs['rowname'] = adata.obs.index.values
+        szfactors = adata.obs['Size_Factor'].values
+        _, mean, mean_sq = _gene_moments(adata, 'X', szfactors, round_exprs)
+        nzGenes, n_obs = stats['X']['gene_n_detected'] > 1, stats['X']['shape'][0]
+        f_expression_mean = mean[nzGenes]
+        f_expression_var = (mean_sq[nzGenes] - f_expression_mean ** 2) * n_obs / (n_obs - 1)
+        disp_table = _disp_table(f_expression_mean, f_expression_var, np.mean(1 / szfactors), adata.var_names[nzGenes])
+        _fit_dispersion(adata, ['X'], [disp_table])
+
+    # filter cells (see filter_cells)
+    filter_cells_kwargs = {"filter_bool": None, "layer": 'all', "min_expr_genes_s": 50, "min_expr_genes_u": 25, "min_expr_genes_p": 1,
+                 "max_expr_genes_s": np.inf, "max_expr_genes_u": np.inf, "max_expr_genes_p": np.inf}
+    if fc_kwargs is not None: filter_cells_kwargs.update(fc_kwargs)
+    cell_bool, fc_layer = filter_cells_kwargs.pop('filter_bool'), filter_cells_kwargs.pop('layer')
+
+    detected_bool = _cell_filter_bool({key: stats[key]['cell_n_expr'] for key in ['X', 'spliced', 'unspliced', 'protein'] if key in
+                                       stats.keys() and (key == 'X' or fc_layer == key or fc_layer == 'all')}, **filter_cells_kwargs)
+    cell_bool = cell_bool & detected_bool if cell_bool is not None else detected_bool
+    adata.obs['use_for_dynamo'] = np.array(cell_bool).flatten()
+    obs_bool = None if keep_filtered_cells else adata.obs['use_for_dynamo'].values
+
+    # filter and select genes (see filter_genes)
+    if genes_to_use is None:
+        filter_genes_kwargs = {"filter_bool": None, "layer": 'X', "min_cell_s": 5, "min_cell_u": 5, "min_cell_p": 5,
+                     "min_avg_exp_s": 1e-2, "min_avg_exp_u": 1e-4, "min_avg_exp_p": 1e-4, "max_avg_exp": 100.}
+        if fg_kwargs is not None: filter_genes_kwargs.update(fg_kwargs)
+        gene_bool, fg_layer = filter_genes_kwargs.pop('filter_bool'), filter_genes_kwargs.pop('layer')
+        total_szfactor = filter_genes_kwargs.pop('total_szfactor', None)
+
+        # number of expressing cells, mean and the first two moments of the size factor normalized data of each gene
+        gene_stats = {}
+        for key in ['X', 'spliced', 'unspliced']:
+            if key == 'X' or (key == fg_layer and key in adata.layers.keys()):
+                sz_key = 'Size_Factor' if key == 'X' else key + '_Size_Factor'
+                sz_key = total_szfactor if total_szfactor is not None and total_szfactor in adata.obs.keys() else sz_key
+                szfactors = adata.obs[sz_key].values if sz_key in adata.obs.keys() else None
+                if obs_bool is None:
+                    _, mean_norm, mean_sq_norm = _gene_moments(adata, key, szfactors, round_exprs)
+                    gene_stats[key] = (stats[key]['gene_n_expr'], stats[key]['gene_sum'] / stats[key]['shape'][0],
+                                       mean_norm, mean_sq_norm)
+                else:
+                    col_stats = _chunked_col_stats(_get_layer_matrix(adata, key), chunk_size, szfactors, obs_bool, 1, round_exprs)
+                    n_obs = col_stats['n_obs']
+                    gene_stats[key] = (col_stats['n_expr_cells'], col_stats['sum'] / n_obs, col_stats['sum_norm'] / n_obs,
+                                       col_stats['sum_sq_norm'] / n_obs)
+
+        detected_bool = _gene_filter_bool({key: gene_stats[key][0] for key in gene_stats.keys()},
+                                          {key: gene_stats[key][1] for key in gene_stats.keys()}, **filter_genes_kwargs)
+        gene_bool = gene_bool & detected_bool if gene_bool is not None else detected_bool
+        adata.var['pass_basic_filter'] = np.array(gene_bool).flatten()
+
+        if feature_selection == 'SVR':
+            # see SVRs with min_expr_cells=0, min_expr_avg=0, max_expr_avg=np.inf
+            n_expr_cells, _, mu, mu_sq = gene_stats[fg_layer] if fg_layer in gene_stats.keys() else gene_stats['X']
+            svr_bool = gene_bool & (n_expr_cells > 0) & (mu < np.inf) & (mu > 0)
+            mu = mu[svr_bool]
+            sigma = np.sqrt(mu_sq[svr_bool] - mu ** 2)
+            _fit_svr(adata, fg_layer, mu, sigma, svr_bool)
+
+        gene_bool = _top_genes(adata, gene_bool, fg_layer, feature_selection, n_top_genes)
+        adata.var['use_for_dynamo'] = np.array(gene_bool).flatten()
+    else:
+        adata.var['use_for_dynamo'] = adata.var.index.isin(genes_to_use)
+    gene_bool = adata.var['use_for_dynamo'].values
+
+    # normalize and materialize the feature genes (see normalize_expr_data)
+    total_szfactor = 'total_Size_Factor' if total_layers is not None else None
+    X, new_layers = None, {}
+    for key in layers:
+        szfactors, log_transform = None, False
+        if not normalized:
+            if norm_method == 'log':
+                log_transform = True
+                if relative_expr:
+                    sz_key = 'Size_Factor' if key == 'X' else key + '_Size_Factor'
+                    sz_key = total_szfactor if total_szfactor is not None and total_szfactor in adata.obs.keys() else sz_key
+                    szfactors = adata.obs[sz_key].values
+            else:
+                warnings.warn(norm_method + ' is not implemented yet')
+
+        raw, norm = _chunked_feature_matrix(_get_layer_matrix(adata, key), chunk_size, gene_bool, obs_bool, szfactors,
+                                            log_transform, pseudo_expr, round_exprs, dtype)
+        if key == 'X':
+            X = raw if norm is None else norm
+        else:
+            new_layers[key] = raw
+            if norm is not None: new_layers['X_' + key] = norm
+
+    obs_index = slice(None) if obs_bool is None else obs_bool
+    res = AnnData(X=X, obs=adata.obs.loc[obs_index, :].copy(), var=adata.var.loc[gene_bool, :].copy(), layers=new_layers,
+                  obsm={key: np.asarray(adata.obsm[key])[obs_index] for key in adata.obsm.keys()},
+                  uns={key: val for key, val in adata.uns.items() if key != 'summary_stats'})
+    if obs_bool is not None:
+        res.obs['use_for_dynamo'] = True
+    if not normalized and 'protein' in res.obsm.keys():
+        if norm_method != 'clr':
+            warnings.warn('For protein data, log transformation is not recommended. Using clr normalization by default.')
+        res.obsm['X_protein'] = _clr_normalize(res.obsm['protein'], dtype)
+
+    if layer is None or layer == 'X':
+        CM = res.X
+    elif layer == 'protein':
+        CM = res.obsm['X_protein']
+    else:
+        CM = res.layers['X_' + layer]
+
+    gene_bool = None if layer == 'protein' else np.ones(res.n_vars, dtype=bool)
+    _reduce_dim(res, CM, method, num_dim, feature_selection, gene_bool)
+
+    return res
@@ -99,7 +99,8 @@ def eye (m, n):
     mat = np.eye(m, n)
     return mat
 
-def DDRTree_py(X, maxIter, sigma, gamma, eps=0, dim=2, Lambda=1.0, ncenter=None, keep_history=False):
+def DDRTree_py(X, maxIter, sigma, gamma, eps=0, dim=2, Lambda=1.0, ncenter=None, keep_history=False, fast=False,
+               n_mst_neighbors=10, R_tol=1e-6, dtype=None, chunk_size=None, random_state=19491001, init=None):
     '''
     Arguments
     ---------
@@ -117,12 +118,41 @@ def DDRTree_py(X, maxIter, sigma, gamma, eps=0, dim=2, Lambda=1.0, ncenter=None,
         gamma:'float'
                 regularization parameter for k-means
         ncenter :(int)
+        keep_history: 'bool'
+                whether to return a DataFrame with the W, Z, Y, stree, R and objs of each iteration. In the fast mode, only
+                the objective and the run time of each iteration are kept.
+        fast: 'bool'
+                performance mode for large datasets. The centers are initialized with k-means++, the minimum spanning
+                tree is built from a kNN graph among the centers, R is kept sparse by truncating negligible
+                responsibilities and computed over blocks of cells, and the N x N matrix Q is never formed (W, Z and Y
+                are updated with D x K and K x K products instead). ncenter defaults to cal_ncenter(N). Q and C are
+                returned as None, stree and R as sparse matrices.
+        n_mst_neighbors: 'int'
+                number of nearest centers used to build the spanning tree in the fast mode.
+        R_tol: 'float'
+                responsibilities smaller than R_tol (relative to the largest one of the cell) are set to zero in the
+                fast mode.
+        dtype: 'np.dtype' or None
+                floating point precision of the fast mode (np.float32 by default).
+        chunk_size: 'int' or None
+                number of cells processed at once in the fast mode. By default a (chunk_size x K) block has at most
+                2^23 elements.
+        random_state: 'int'
+                random seed of the k-means++ initialization in the fast mode.
+        init: 'np.ndarray' or None
+                indices of the cells whose reduced coordinates are the initial centers, which replaces the k-means
+                initialization and sets ncenter to len(init).
 
     Returns
     -------
         history: 'DataFrame'
-                the results dataframe of return
+                the results dataframe of return if keep_history is True, otherwise the tuple
+                (Z, Y, stree, R, W, Q, C, objs).
     '''
+    if fast:
+        return _DDRTree_fast(X, maxIter, sigma, gamma, eps, dim, Lambda, ncenter, keep_history, n_mst_neighbors, R_tol,
+                             dtype, chunk_size, random_state, init)
+
     X = np.array(X)
     (D,N) = X.shape
 
@@ -130,7 +160,10 @@ def DDRTree_py(X, maxIter, sigma, gamma, eps=0, dim=2, Lambda=1.0, ncenter=None,
     W = pca_projection(np.dot(X,X.T),dim)
     Z = np.dot(W.T,X)
 
-    if ncenter is None:
+    if init is not None:
+        K = len(init)
+        Y = Z[:, init]
+    elif ncenter is None:
         K = N
         Y = Z.T[0:K].T
     else:
@@ -142,7 +175,7 @@ def DDRTree_py(X, maxIter, sigma, gamma, eps=0, dim=2, Lambda=1.0, ncenter=None,
     #main loop
     objs = []
     if keep_history:
-        history = pd.DataFrame(index= [i for i in range(maxIter)],columns=['W', 'Z', 'Y', 'stree', 'R','objs'])
+        history = []
     for iter in range(maxIter):
 
         #Kruskal method to find optimal B
@@ -168,11 +201,7 @@ def DDRTree_py(X, maxIter, sigma, gamma, eps=0, dim=2, Lambda=1.0, ncenter=None,
         print('iter = ',iter,'obj = ', objs[iter])
 
         if keep_history:
-            history.iloc[iter]['W'] = W
-            history.iloc[iter]['Z'] = Z
-            history.iloc[iter]['Y'] = Y
-            history.iloc[iter]['stree'] = stree
-            history.iloc[iter]['R'] = R
+            history.append({'W': W, 'Z': Z, 'Y': Y, 'stree': stree, 'R': R, 'objs': objs[iter]})
 
         if iter>0:
             if abs((objs[iter] - objs[iter-1])/abs(objs[iter-1])) < eps:
@@ -189,8 +218,129 @@ def DDRTree_py(X, maxIter, sigma, gamma, eps=0, dim=2, Lambda=1.0, ncenter=None,
         Y = np.dot(np.dot(Z,R),inv(csr_matrix((Lambda / gamma)*L + Gamma)).toarray())
 
     if keep_history:
-        history.iloc[iter]['obs'] = objs
+        history = pd.DataFrame(history, columns=['W', 'Z', 'Y', 'stree', 'R', 'objs'])
 
         return history
     else:
         return Z, Y, stree, R, W, Q, C, objs
+
+
+def _DDRTree_fast(X, maxIter, sigma, gamma, eps=0, dim=2, Lambda=1.0, ncenter=None, keep_history=False,
+                  n_mst_neighbors=10, R_tol=1e-6, dtype=None, chunk_size=None, random_state=19491001, init=None):
+    """The performance mode of DDRTree_py, see its documentation for the arguments.
+
+    With M = ((gamma + 1) / gamma) * ((Lambda / gamma) * L + Gamma) - R^T R, the N x N matrix of the exact version is
+    Q = (I + R inv(M) R^T) / (gamma + 1), so that C = X Q, C X^T and Z = W^T C only need the D x K matrix X R.
+    """
+    import time
+    from .utils import _get_chunk_size
+
+    dtype = np.float32 if dtype is None else dtype
+    X = np.asarray(X, dtype=dtype)
+    (D, N) = X.shape
+    K = len(init) if init is not None else int(cal_ncenter(N) if ncenter is None else ncenter)
+    chunk_size = _get_chunk_size(K, chunk_size)
+
+    # initialization
+    XXt = X.dot(X.T).astype(np.float64)
+    W = _top_eigenvectors(XXt, dim)
+    Z = W.T.astype(dtype).dot(X)
+    if init is not None:
+        Y = Z[:, init].astype(np.float64)
+    else:
+        Y, _ = kmeans2(Z.T.astype(np.float64), K, minit='++', seed=random_state)
+        Y = Y.T
+
+    objs, times = [], []
+    for iter in range(maxIter):
+        start = time.time()
+
+        stree = _center_spanning_tree(Y, n_mst_neighbors)
+        B = (stree != 0).astype(np.float64)
+        L = np.asarray(np.diag(np.asarray(B.sum(0)).flatten()) - B.toarray())
+
+        R, obj1 = _soft_assignment(Z, Y.astype(dtype), sigma, R_tol, chunk_size)
+        Gamma = np.asarray(R.sum(0)).flatten().astype(np.float64)
+
+        # termination condition: ||X - W Z||_2^2 from the D x D matrix (X - W Z)(X - W Z)^T
+        XZt = X.dot(Z.T).astype(np.float64)
+        WZXt = W.dot(XZt.T)
+        E = XXt - WZXt - WZXt.T + W.dot(Z.dot(Z.T).astype(np.float64)).dot(W.T)
+        xwz = np.max(np.linalg.eigvalsh((E + E.T) / 2))
+        objs.append(xwz + Lambda * np.trace(Y.dot(L).dot(Y.T)) + gamma * obj1)
+
+        if iter > 0 and abs((objs[iter] - objs[iter - 1]) / abs(objs[iter - 1])) < eps:
+            times.append(time.time() - start)
+            print('iter = ', iter, 'obj = ', objs[iter], 'time = ', times[iter])
+            break
+
+        # compute low dimension projection matrix
+        RtR = R.T.dot(R).toarray()
+        M = ((gamma + 1) / gamma) * ((Lambda / gamma) * L + np.diag(Gamma)) - RtR
+        XR = np.asarray(R.T.dot(X.T).T, dtype=np.float64)
+        invM_RtXt = np.linalg.solve(M, XR.T)
+        tmp1 = (XXt + XR.dot(invM_RtXt)) / (gamma + 1)
+        W = _top_eigenvectors((tmp1 + tmp1.T) / 2, dim)
+        Z = (W.T.astype(dtype).dot(X) + R.dot(invM_RtXt.dot(W)).T.astype(dtype)) / (gamma + 1)
+        Y = np.linalg.solve((Lambda / gamma) * L + np.diag(Gamma), (R.T.dot(Z.T)).astype(np.float64)).T
+
+        times.append(time.time() - start)
+        print('iter = ', iter, 'obj = ', objs[iter], 'time = ', times[iter])
+
+    if keep_history:
+        return pd.DataFrame({'objs': objs, 'time': times})
+    else:
+        return Z, Y, stree, R, W, None, None, objs
+
+
+def _top_eigenvectors(C, L):
+    """The eigenvectors of the L largest eigenvalues of the symmetric matrix C."""
+    V, U = np.linalg.eigh(C)
+    return U[:, np.argsort(V)[::-1][:L]]
+
+
+def _center_spanning_tree(Y, n_neighbors=10):
+    """The (symmetric, sparse) minimum spanning tree of the centers Y (dim x K) over squared distances, learned from the
+    kNN graph among the centers. The complete graph is used if the kNN graph is not connected."""
+    from scipy.sparse.csgraph import connected_components
+    from .connectivity import NeighborIndex
+
+    K = Y.shape[1]
+    dists, indices = NeighborIndex(n_neighbors=min(n_neighbors + 1, K), method='exact').fit(Y.T).kneighbors()
+    rows, cols = np.repeat(np.arange(K), indices.shape[1]), indices.flatten()
+    mask = rows != cols
+    # the tiny offset keeps the edges between duplicated centers
+    knn = csr_matrix((dists.flatten()[mask] ** 2 + np.finfo(float).tiny, (rows[mask], cols[mask])), shape=(K, K))
+    knn = knn.maximum(knn.T)
+    if connected_components(knn, directed=False)[0] > 1:
+        knn = csr_matrix(np.tril(sqdist(Y, Y)))
+    stree = minimum_spanning_tree(knn)
+
+    return (stree + stree.T).tocsr()
+
+
+def _soft_assignment(Z, Y, sigma, R_tol, chunk_size):
+    """The sparse responsibilities R (N x K) of the centers Y for the points Z with the mean-shift update rule, computed
+    over blocks of points, and the k-means part of the objective."""
+    N, K = Z.shape[1], Y.shape[1]
+    yy = np.sum(Y ** 2, 0)
+    obj1 = 0
+    data, indices, indptr = [], [], [np.zeros(1, dtype=np.int64)]
+    for start in range(0, N, chunk_size):
+        Zc = Z[:, start:start + chunk_size]
+        distZY = np.abs(np.sum(Zc ** 2, 0)[:, None] + yy[None, :] - 2 * Zc.T.dot(Y))
+        min_dist = np.min(distZY, 1)
+        tmp_R = np.exp(-(distZY - min_dist[:, None]) / sigma)
+        sum_R = np.sum(tmp_R, 1)
+        obj1 -= sigma * np.sum(np.log(sum_R.astype(np.float64)) - min_dist / sigma)
+
+        tmp_R[tmp_R < R_tol] = 0  # the largest one of each row is 1
+        tmp_R /= np.sum(tmp_R, 1)[:, None]
+        rows, cols = np.nonzero(tmp_R)
+        data.append(tmp_R[rows, cols])
+        indices.append(cols)
+        indptr.append(indptr[-1][-1] + np.cumsum(np.bincount(rows, minlength=Zc.shape[1])))
+
+    R = csr_matrix((np.hstack(data), np.hstack(indices), np.hstack(indptr)), shape=(N, K))
+
+    return R, obj1
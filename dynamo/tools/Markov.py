@@ -1,8 +1,10 @@
 # create by Yan Zhang, minor adjusted by Xiaojie Qiu
 
+import warnings
 import numpy as np
 import scipy.sparse as sp
-from sklearn.neighbors import NearestNeighbors
+from .connectivity import _get_nbrs
+from .utils import _get_chunk_size, _get_n_jobs, _run_chunks
 from scipy.stats import norm
 from scipy.linalg import eig, null_space
 from numba import jit
@@ -57,6 +59,115 @@ def compute_markov_trans_prob(x, v, X, s=None, cont_time=False):
     return p
 
 
+def compute_markov_trans_prob_batch(D, V, s=None, cont_time=False, maxiter=None):
+    """Vectorized version of `compute_markov_trans_prob` for a block of cells, which solves the QPs of all cells in one
+    compiled call with an active set method instead of one cvxopt QP per cell.
+
+    Each cell solves min_p 0.5 * ||A^T p - b||^2 subject to p >= 0 and, for discrete time chains, sum(p) <= 1, where the
+    rows of A are the (normalized) displacements to the neighbors and b is the (normalized) velocity. The non-negative
+    least squares problem is solved with the Lawson-Hanson algorithm; if its solution violates sum(p) <= 1, the
+    constraint is active and the problem becomes the minimum norm point of the convex hull of the points A_j - b and
+    -b, which is again a non-negative least squares problem. The problems are usually degenerate (more neighbors than
+    dimensions), so the probabilities can differ from those of the interior point solver while the objective and the
+    drift A^T p agree.
+
+    Arguments
+    ---------
+        D: `np.ndarray` (dimension: n_cells x k x n_dims)
+            Displacements from each cell to its k nearest neighbors.
+        V: `np.ndarray` (dimension: n_cells x n_dims)
+            Velocity vectors of the cells.
+        s: `np.ndarray` or None (default: None)
+            The diffusion coefficient of each dimension.
+        cont_time: `bool` (default: False)
+            Whether the probabilities are the transition rates of a continuous time chain (no sum constraint).
+        maxiter: `int` or None (default: None)
+            The maximal number of active set iterations per cell (3 * (k + 1) if None).
+
+    Returns
+    -------
+        p: `np.ndarray` (dimension: n_cells x k)
+            The transition probabilities of each cell to its neighbors.
+    """
+    # normalize R, v, and s
+    scale = np.abs(np.max(D, 1) - np.min(D, 1))
+    scale[scale == 0] = 1
+    Rn = D / scale[:, None, :]
+    vn = V / scale
+    if s is not None:
+        sn = np.asarray(s) / scale
+        A = np.concatenate((Rn, 0.5 * Rn * Rn), axis=2)
+        b = np.hstack((vn, 0.5 * sn * sn))
+    else:
+        A, b = Rn, vn
+
+    maxiter = 3 * (A.shape[1] + 1) if maxiter is None else maxiter
+    return _markov_trans_prob_nnls(np.ascontiguousarray(A, dtype=np.float64), np.ascontiguousarray(b, dtype=np.float64),
+                                   cont_time, maxiter)
+
+
+@jit(nopython=True)
+def _markov_trans_prob_nnls(A, b, cont_time, maxiter):
+    n, k, m = A.shape
+    P = np.zeros((n, k))
+    for i in range(n):
+        C = np.ascontiguousarray(A[i].T)
+        p = _nnls(C, b[i], maxiter)
+        if not cont_time and np.sum(p) > 1:
+            # minimum norm point of the convex hull of the columns of Q: min ||Q mu||^2 + (sum(mu) - 1)^2, mu >= 0
+            Q = np.ones((m + 1, k + 1))
+            for j in range(k):
+                Q[:m, j] = C[:, j] - b[i]
+            Q[:m, k] = - b[i]
+            rhs = np.zeros(m + 1)
+            rhs[m] = 1
+            mu = _nnls(Q, rhs, maxiter)
+            p = mu[:k] / np.sum(mu)
+        P[i] = p
+    return P
+
+
+@jit(nopython=True)
+def _nnls(C, d, maxiter):
+    """The Lawson-Hanson active set algorithm for min ||C x - d|| subject to x >= 0."""
+    m, n = C.shape
+    x = np.zeros(n)
+    passive = np.zeros(n, dtype=np.bool_)
+    tol = 10 * max(m, n) * np.finfo(np.float64).eps * max(1.0, np.max(np.abs(C)) * np.max(np.abs(d)))
+    w = C.T.dot(d - C.dot(x))
+    it = 0
+    while it < maxiter:
+        # add the variable with the most positive gradient to the passive set
+        j, w_max = -1, tol
+        for l in range(n):
+            if not passive[l] and w[l] > w_max:
+                j, w_max = l, w[l]
+        if j < 0:
+            break
+        passive[j] = True
+
+        while it < maxiter:
+            it += 1
+            idx = np.nonzero(passive)[0]
+            z = np.zeros(n)
+            z[idx] = np.linalg.lstsq(np.ascontiguousarray(C[:, idx]), d)[0]
+            if np.all(z[idx] > 0):
+                x = z
+                break
+            # move towards z until a passive variable hits zero and drop it
+            alpha = 1.0
+            for l in idx:
+                if z[l] <= 0:
+                    alpha = min(alpha, x[l] / (x[l] - z[l]))
+            x = x + alpha * (z - x)
+            for l in idx:
+                if x[l] <= tol:
+                    x[l] = 0
+                    passive[l] = False
+        w = C.T.dot(d - C.dot(x))
+    return x
+
+
 @jit(nopython=True)
 def compute_kernel_trans_prob(x, v, X, inv_s, cont_time=False):
     n = X.shape[0]
@@ -139,6 +250,233 @@ def compute_density_kernel(x, X, inv_eps):
     return k
 
 
+def compute_drift_kernel_batch(D, V, inv_s):
+    """Vectorized version of `compute_drift_kernel` for a block of cells.
+
+    Arguments
+    ---------
+        D: `np.ndarray` (dimension: n_cells x k x n_dims)
+            Displacements from each cell to its k nearest neighbors.
+        V: `np.ndarray` (dimension: n_cells x n_dims)
+            Velocity vectors of the cells.
+        inv_s: `np.ndarray` (dimension: n_dims x n_dims)
+            Inverse of the diffusion matrix.
+
+    Returns
+    -------
+        k: `np.ndarray` (dimension: n_cells x k)
+            The drift kernel of each cell evaluated on its neighbors.
+    """
+    E = D - V[:, None, :]
+    return np.exp(-0.25 * np.sum((E @ inv_s) * E, axis=2))
+
+
+def compute_drift_local_kernel_batch(D, V, inv_s):
+    """Vectorized version of `compute_drift_local_kernel` for a block of cells.
+
+    Arguments
+    ---------
+        D: `np.ndarray` (dimension: n_cells x k x n_dims)
+            Displacements from each cell to its k nearest neighbors.
+        V: `np.ndarray` (dimension: n_cells x n_dims)
+            Velocity vectors of the cells.
+        inv_s: `np.ndarray` (dimension: n_dims x n_dims)
+            Inverse of the diffusion matrix.
+
+    Returns
+    -------
+        k: `np.ndarray` (dimension: n_cells x k)
+            The adaptive local drift kernel of each cell evaluated on its neighbors.
+        tau: `np.ndarray` (dimension: n_cells, )
+            The time scale estimated for each cell (`nan` when no neighbor lies along the velocity direction).
+    """
+    dists = np.linalg.norm(D, axis=2)
+    vds = np.einsum('ikd,id->ik', D, V)
+    np.divide(vds, dists, out=vds, where=dists > 0)
+    vds[dists <= 0] = 0
+
+    i_dir = np.logical_and(vds >= np.quantile(vds, 0.7, axis=1)[:, None], vds > 0)
+    n_dir = i_dir.sum(1)
+    ratio = np.zeros_like(vds)
+    np.divide(dists, vds, out=ratio, where=i_dir)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tau = np.minimum(ratio.sum(1) / n_dir, 1e2)
+    has_dir = n_dir > 0
+
+    v_norm = np.linalg.norm(V, axis=1)
+    tau_v = np.where(has_dir[:, None], tau[:, None] * V, 0)
+    with np.errstate(divide='ignore'):
+        scale = 1 / (np.where(has_dir, tau, 1e2) * v_norm)
+    E = D - tau_v[:, None, :]
+    k = np.exp(-0.25 * scale[:, None] * np.sum((E @ inv_s) * E, axis=2))
+    tau[~has_dir] = np.nan
+    return k, tau
+
+
+def compute_density_kernel_batch(D, inv_eps):
+    """Vectorized version of `compute_density_kernel` for a block of cells.
+
+    Arguments
+    ---------
+        D: `np.ndarray` (dimension: n_cells x k x n_dims)
+            Displacements from each cell to its k nearest neighbors.
+        inv_eps: `float`
+            Inverse of the bandwidth of the density kernel.
+
+    Returns
+    -------
+        k: `np.ndarray` (dimension: n_cells x k)
+            The density kernel of each cell evaluated on its neighbors.
+    """
+    return np.exp(-0.25 * inv_eps * np.sum(D * D, axis=2))
+
+
+def _normalize_rows(M):
+    """Normalize the rows of the sparse matrix M to sum to one, rows without entries stay zero."""
+    row_sums = np.asarray(M.sum(1)).flatten()
+    row_sums[row_sums == 0] = 1
+
+    return sp.diags(1 / row_sums).dot(M).tocsr()
+
+
+def _steady_state(M, method='auto', tol=1e-10, maxiter=None):
+    """The steady state distribution (the left eigenvector of eigenvalue 1) of the row-stochastic sparse matrix M, see
+    `diffusion` for the methods."""
+    n = M.shape[0]
+    method = ('eig' if n <= 2000 else 'arpack') if method == 'auto' else method
+    MT = M.T.tocsr()
+
+    if method == 'eig':
+        # code inspired from  https://github.com/prob140/prob140/blob/master/prob140/markov_chains.py#L284
+        eigenvalue, eigenvector = eig(M.toarray(), left=True, right=False) # source is on the row
+        mu = np.real(eigenvector[:, np.argmin(np.abs(eigenvalue - 1))])
+    elif method == 'arpack':
+        from scipy.sparse.linalg import eigs
+        eigenvalue, eigenvector = eigs(MT, k=1, which='LR', v0=np.full(n, 1 / n), tol=tol, maxiter=maxiter)
+        mu = np.real(eigenvector[:, 0])
+    elif method == 'gmres':
+        from scipy.sparse.linalg import gmres, LinearOperator
+        # (I - M^T) pi + 1 sum(pi) / n = 1 / n has the steady state as its unique solution for an irreducible chain
+        A = LinearOperator((n, n), matvec=lambda x: x - MT.dot(x) + np.sum(x) / n, dtype=float)
+        mu, info = gmres(A, np.full(n, 1 / n), x0=np.full(n, 1 / n), tol=tol, restart=min(n, 50), maxiter=maxiter)
+        if info != 0:
+            warnings.warn('GMRES did not converge ({}), the steady state is computed with ARPACK '
+                          'instead.'.format(info))
+            return _steady_state(M, method='arpack', tol=tol)
+    elif method == 'power':
+        mu = np.full(n, 1 / n)
+        for _ in range(100 * n if maxiter is None else maxiter):
+            # the lazy chain (I + M) / 2 has the same steady state and does not oscillate for periodic chains
+            mu_new = (mu + MT.dot(mu)) / 2
+            mu_new /= np.sum(mu_new)
+            converged = np.abs(mu_new - mu).sum() < tol
+            mu = mu_new
+            if converged:
+                break
+        else:
+            warnings.warn('The power iterations did not converge, the steady state may be inaccurate.')
+    else:
+        raise Exception('method {} is not supported.'.format(method))
+
+    return mu / np.sum(mu)
+
+
+
+def _csc_values_at(P, Idx):
+    """The entries P[Idx[i, j], i] of the CSC matrix P (zero if not stored), read from its indptr/indices arrays.
+
+    The stored entries are keyed by column * n_rows + row, which is sorted for a CSC matrix with sorted indices, so that
+    all the entries are found with a single binary search.
+    """
+    P = sp.csc_matrix(P)
+    if not P.has_sorted_indices:
+        P = P.sorted_indices()
+    n = P.shape[0]
+    keys = np.repeat(np.arange(P.shape[1], dtype=np.int64) * n, np.diff(P.indptr)) + P.indices
+    query = np.arange(Idx.shape[0], dtype=np.int64)[:, None] * n + Idx
+    pos = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+
+    return np.where(keys[pos] == query, P.data[pos], 0) if len(keys) > 0 else np.zeros(Idx.shape)
+
+
+@jit(nopython=True)
+def _density_corrected_drift_numba(X, Idx, indptr, indices, data, inv_k, norm_ord):
+    """The numba version of `density_corrected_drift`, which finds the entries of P with a binary search in each
+    column (with sorted indices) and does not allocate the block of neighbor displacements."""
+    n, n_nbrs = Idx.shape
+    n_dims = X.shape[1]
+    V = np.zeros((n, n_dims))
+    D = np.zeros((n_nbrs, n_dims))
+    for i in range(n):
+        start, end = indptr[i], indptr[i + 1]
+        for j in range(n_nbrs):
+            D[j] = X[Idx[i, j]] - X[i]
+        scale = 1.
+        if norm_ord == 1:
+            scale = np.max(np.sum(np.abs(D), axis=0))
+        elif norm_ord == 2:
+            scale = np.sqrt(np.sum(D ** 2))
+        for j in range(n_nbrs):
+            pos = start + np.searchsorted(indices[start:end], Idx[i, j])
+            p = data[pos] if pos < end and indices[pos] == Idx[i, j] else 0.
+            V[i] += D[j] * (p - inv_k)
+        V[i] /= scale
+    return V
+
+
+def density_corrected_drift(X, Idx, P, k=None, norm_ord=None, chunk_size=None, use_numba=False):
+    """The density corrected drift V[i] = sum_j (X[Idx[i, j]] - X[i]) (P[Idx[i, j], i] - 1 / k) of all the cells.
+
+    The neighbor displacements of blocks of cells are gathered as (chunk_size x n_neighbors x n_dims) arrays and the
+    transition probabilities are read directly from the CSC arrays of P in the order of Idx.
+
+    Arguments
+    ---------
+        X: `np.ndarray` (dimension: n_cells x n_dims)
+            The cell states.
+        Idx: `np.ndarray` (dimension: n_cells x n_neighbors)
+            The kNN indices of the cells.
+        P: `scipy.sparse.csc_matrix` (dimension: n_cells x n_cells)
+            The column stochastic transition matrix.
+        k: `int` or None (default: None)
+            The number of neighbors of the uniform correction 1 / k. The number of columns of Idx is used if None.
+        norm_ord: `None`, `1` or `fro` (default: None)
+            The matrix norm (see numpy.linalg.norm) that divides the displacements of each cell. No normalization if
+            None.
+        chunk_size: `int` or None (default: None)
+            Number of cells processed at once.
+        use_numba: `bool` (default: False)
+            Whether to use the numba kernel, which loops over the cells instead of allocating the blocks.
+
+    Returns
+    -------
+        V: `np.ndarray` (dimension: n_cells x n_dims)
+            The density corrected drift.
+    """
+    n, n_nbrs = Idx.shape
+    inv_k = 1 / (n_nbrs if k is None else k)
+    Idx = np.asarray(Idx, dtype=np.int64)
+
+    if use_numba:
+        P = sp.csc_matrix(P)
+        if not P.has_sorted_indices:
+            P = P.sorted_indices()
+        norm_ord = {None: 0, 1: 1, 'fro': 2}[norm_ord]
+        return _density_corrected_drift_numba(np.asarray(X, dtype=float), Idx, P.indptr.astype(np.int64),
+                                              P.indices.astype(np.int64), P.data.astype(float), inv_k, norm_ord)
+
+    p = _csc_values_at(P, Idx) - inv_k
+    V = np.zeros(X.shape)
+    chunk_size = _get_chunk_size(n_nbrs * X.shape[1], chunk_size)
+    for i in range(0, n, chunk_size):
+        D = X[Idx[i:i + chunk_size]] - X[i:i + chunk_size, None, :]
+        if norm_ord == 1:
+            D /= np.abs(D).sum(1).max(1)[:, None, None]
+        elif norm_ord == 'fro':
+            D /= np.linalg.norm(D, axis=(1, 2))[:, None, None]
+        V[i:i + chunk_size] = np.einsum('ikd,ik->id', D, p[i:i + chunk_size])
+    return V
+
 @jit(nopython=True)
 def makeTransitionMatrix(Qnn, I, tol=0.):
     n = Qnn.shape[0]
@@ -152,18 +490,11 @@ def makeTransitionMatrix(Qnn, I, tol=0.):
     return M
 
 
-@jit(nopython=True)
-def compute_tau(X, V, k=100, nbr_idx=None):
+def compute_tau(X, V, k=100, nbr_idx=None, nbrs=None):
     if nbr_idx is None:
-        nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(X)
-        dists, _ = nbrs.kneighbors(X)
+        dists, _ = _get_nbrs(X, k, nbrs, method='exact').kneighbors(X, n_neighbors=k)
     else:
-        dists = np.zeros(nbr_idx.shape)
-        for i in range(nbr_idx.shape[0]):
-            for j in range(nbr_idx.shape[1]):
-                x = X[i]
-                y = X[nbr_idx[i, j]]
-                dists[i, j] = np.sqrt((x - y).dot(x - y))
+        dists = np.linalg.norm(X[nbr_idx] - X[:, None, :], axis=2)
     d = np.mean(dists[:, 1:], 1)
     v = np.linalg.norm(V, axis=1)
     tau = d / v
@@ -176,62 +507,133 @@ def diffusionMatrix(V_mat):
     Parameters
     ----------
         V_mat: `np.ndarray`
-            velocity vectors of neighbors
+            velocity vectors of neighbors (n_cells x n_neighbors x n_dims)
 
     Returns
     -------
-        Return the cell-specific diffusion matrix
+        Return the cell-specific diffusion matrix (n_cells x n_dims x n_dims), half the covariance of the velocity vectors
+        of the neighbors.
     """
 
-    D = np.zeros((V_mat.shape[0], 2, 2))  # this one works for two dimension -- generalize it to high dimensions
-    D[:, 0, 0] = np.mean((V_mat[:, :, 0] - np.mean(V_mat[:, :, 0], axis=1)[:, None]) ** 2, axis=1)
-    D[:, 1, 1] = np.mean((V_mat[:, :, 1] - np.mean(V_mat[:, :, 1], axis=1)[:, None]) ** 2, axis=1)
-    D[:, 0, 1] = np.mean((V_mat[:, :, 0] - np.mean(V_mat[:, :, 0], axis=1)[:, None]) * (
-                V_mat[:, :, 0] - np.mean(V_mat[:, :, 0], axis=1)[:, None]), axis=1)
-    D[:, 1, 0] = D[:, 0, 1]
+    V_centered = V_mat - np.mean(V_mat, axis=1)[:, None, :]
+    D = np.einsum('ikd,ike->ide', V_centered, V_centered) / V_mat.shape[1]
 
     return D / 2
 
 
-def velocity_on_grid(X_emb, V_emb, xy_grid_nums, density=None, smooth=None, n_neighbors=None, min_mass=None, autoscale=False,
-                             adjust_for_stream=True, V_threshold=None):
-    """Function to calculate the velocity vectors on a grid for grid vector field  quiver plot and streamplot, adapted from scVelo
+class VelocityGrid:
+    """The map from the points of a regular grid over an embedding to their nearest cells, which is used to compute the
+    velocity vectors (Gaussian kernel weighted averages) and the diffusion matrices on the grid, adapted from scVelo.
+
+    The map is stored as two sparse (n_grid x n_cells) matrices sharing the same neighbors: the normalized Gaussian
+    weights and the uniform weights of the neighbors. Once it is fitted, the grid quantities of any velocity (for
+    example the real and the randomized ones) are sparse matrix products and the kNN search is not repeated.
+
+    Arguments
+    ---------
+        xy_grid_nums: `tuple` or `list`
+            Number of grid points along each dimension of the embedding, of any length.
+        density: `float` or None (default: `None`)
+            The grid points along each dimension are multiplied by density (1 if None).
+        smooth: `float` or None (default: `None`)
+            The bandwidth of the Gaussian kernel relative to the grid spacing (0.5 if None).
+        n_neighbors: `int` or None (default: `None`)
+            Number of nearest cells of each grid point (n_cells / 50 if None).
+        chunk_size: `int` or None (default: `None`)
+            Number of grid points searched at once. By default a (chunk_size x n_neighbors) block has at most 2^23
+            elements.
     """
 
-    n_obs, n_dim = X_emb.shape
-    density = 1 if density is None else density
-    smooth = .5 if smooth is None else smooth
+    def __init__(self, xy_grid_nums, density=None, smooth=None, n_neighbors=None, chunk_size=None):
+        self.xy_grid_nums = xy_grid_nums
+        self.density = 1 if density is None else density
+        self.smooth = .5 if smooth is None else smooth
+        self.n_neighbors = n_neighbors
+        self.chunk_size = chunk_size
+
+    def fit(self, X_emb, nbrs=None, n_jobs=-1):
+        """Build the grid over X_emb (n_cells x n_dims) and find the nearest cells of each grid point, using the kNN
+        index nbrs of X_emb if given. Otherwise an exact (tree based) index is built, which is fast for the low
+        dimensional embeddings and does not compute the kNN graph of the cells."""
+        from sklearn.neighbors import NearestNeighbors
+        from .connectivity import _checksum
+
+        n_obs, n_dim = X_emb.shape
+        self.checksum_ = _checksum(X_emb)
+
+        grs = []
+        for dim_i in range(n_dim):
+            m, M = np.min(X_emb[:, dim_i]), np.max(X_emb[:, dim_i])
+            m = m - .01 * np.abs(M - m)
+            M = M + .01 * np.abs(M - m)
+            gr = np.linspace(m, M, int(self.xy_grid_nums[dim_i] * self.density))
+            grs.append(gr)
+        self.grs_ = grs
+
+        meshes_tuple = np.meshgrid(*grs)
+        self.grid_shape_ = meshes_tuple[0].shape
+        self.X_grid_ = np.vstack([i.flat for i in meshes_tuple]).T
+
+        # estimate grid velocities
+        n_neighbors = int(n_obs / 50) if self.n_neighbors is None else self.n_neighbors
+        nn = NearestNeighbors(n_neighbors=n_neighbors, n_jobs=_get_n_jobs(n_jobs)).fit(X_emb) if nbrs is None else nbrs
+        scale = np.mean([(g[1] - g[0]) for g in grs]) * self.smooth
+
+        n_grid = self.X_grid_.shape[0]
+        chunk_size = _get_chunk_size(n_neighbors, self.chunk_size)
+        weight, neighs = np.zeros((n_grid, n_neighbors)), np.zeros((n_grid, n_neighbors), dtype=np.int64)
+        for i in range(0, n_grid, chunk_size):
+            dists, neighs[i:i + chunk_size] = nn.kneighbors(self.X_grid_[i:i + chunk_size], n_neighbors=n_neighbors)
+            weight[i:i + chunk_size] = norm.pdf(x=dists, scale=scale)
+        self.p_mass_ = weight.sum(1)
+
+        indptr = np.arange(0, n_grid * n_neighbors + 1, n_neighbors)
+        self.weight_ = sp.csr_matrix(((weight / np.maximum(1, self.p_mass_)[:, None]).flatten(), neighs.flatten(),
+                                      indptr), shape=(n_grid, n_obs))
+        self.uniform_ = sp.csr_matrix((np.full(n_grid * n_neighbors, 1 / n_neighbors), neighs.flatten(), indptr),
+                                      shape=(n_grid, n_obs))
+
+        return self
+
+    def transform(self, V_emb):
+        """The velocity vectors (n_grid x n_dims) on the grid points of the cell velocities V_emb."""
+        return self.weight_.dot(V_emb)
+
+    def diffusion(self, V_emb):
+        """The diffusion matrices (n_grid x n_dims x n_dims) on the grid points, half the covariance of the velocities
+        of the nearest cells, see diffusionMatrix."""
+        V_emb = V_emb - V_emb.mean(0)  # centering keeps the second moments accurate
+        n_dim = V_emb.shape[1]
+        mean = self.uniform_.dot(V_emb)
+        D = np.zeros((mean.shape[0], n_dim, n_dim))
+        for i in range(n_dim):
+            D[:, i, i:] = self.uniform_.dot(V_emb[:, i:] * V_emb[:, [i]]) - mean[:, i:] * mean[:, [i]]
+            D[:, i:, i] = D[:, i, i:]
+
+        return D / 2
 
-    grs = []
-    for dim_i in range(n_dim):
-        m, M = np.min(X_emb[:, dim_i]), np.max(X_emb[:, dim_i])
-        m = m - .01 * np.abs(M - m)
-        M = M + .01 * np.abs(M - m)
-        gr = np.linspace(m, M, xy_grid_nums[dim_i] * density)
-        grs.append(gr)
 
-    meshes_tuple = np.meshgrid(*grs)
-    X_grid = np.vstack([i.flat for i in meshes_tuple]).T
+def velocity_on_grid(X_emb, V_emb, xy_grid_nums, density=None, smooth=None, n_neighbors=None, min_mass=None, autoscale=False,
+                             adjust_for_stream=True, V_threshold=None, nbrs=None, grid=None):
+    """Function to calculate the velocity vectors on a grid for grid vector field  quiver plot and streamplot, adapted from scVelo
 
-    # estimate grid velocities
-    if n_neighbors is None: n_neighbors = int(n_obs / 50)
-    nn = NearestNeighbors(n_neighbors=n_neighbors, n_jobs=-1)
-    nn.fit(X_emb)
-    dists, neighs = nn.kneighbors(X_grid)
+    A fitted :class:`VelocityGrid` of X_emb (for example from velocity_grid, which caches it in adata) can be passed as
+    grid, in which case density, smooth, n_neighbors and nbrs are not used and only the weighted averages are computed.
+    The grid can have any number of dimensions.
+    """
 
-    scale = np.mean([(g[1] - g[0]) for g in grs]) * smooth
-    weight = norm.pdf(x=dists, scale=scale)
-    p_mass = weight.sum(1)
+    if grid is None:
+        grid = VelocityGrid(xy_grid_nums, density, smooth, n_neighbors).fit(X_emb, nbrs)
+    X_grid, p_mass = grid.X_grid_, grid.p_mass_
 
-    V_grid = (V_emb[neighs] * weight[:, :, None]).sum(1) / np.maximum(1, p_mass)[:, None]
+    V_grid = grid.transform(V_emb)
 
     # calculate diffusion matrix D
-    D = diffusionMatrix(V_emb[neighs])
+    D = grid.diffusion(V_emb)
 
     if adjust_for_stream:
-        X_grid = np.stack([np.unique(X_grid[:, 0]), np.unique(X_grid[:, 1])])
-        ns = int(np.sqrt(len(V_grid[:, 0])))
-        V_grid = V_grid.T.reshape(2, ns, ns)
+        X_grid = np.stack(grid.grs_)
+        V_grid = V_grid.T.reshape(V_grid.shape[1], *grid.grid_shape_)
 
         mass = np.sqrt((V_grid ** 2).sum(0))
         if V_threshold is not None:
@@ -246,6 +648,57 @@ def velocity_on_grid(X_emb, V_emb, xy_grid_nums, density=None, smooth=None, n_ne
 
     return X_grid, V_grid, D
 
+
+def velocity_grid(adata, basis='umap', xy_grid_nums=(50, 50), density=None, smooth=None, n_neighbors=None, dims=None,
+                  n_jobs=1, recompute=False):
+    """Get the grid-to-cell neighbor map of an embedding, building it once and caching it in adata so that the grid
+    velocities of the real and the randomized velocities and of every plot only need the weighted averages.
+
+    Arguments
+    ---------
+        adata: :class:`~anndata.AnnData`
+            an Annodata object.
+        basis: `str` (default: `umap`)
+            The embedding in the obsm attribute (`X_` + basis).
+        xy_grid_nums: `tuple` (default: `(50, 50)`)
+            Number of grid points along each dimension.
+        density: `float` or None (default: `None`)
+            See :class:`VelocityGrid`.
+        smooth: `float` or None (default: `None`)
+            See :class:`VelocityGrid`.
+        n_neighbors: `int` or None (default: `None`)
+            See :class:`VelocityGrid`.
+        dims: `list` or None (default: `None`)
+            The columns of the embedding used for the grid, the first len(xy_grid_nums) ones if None.
+        n_jobs: `int` (default: `1`)
+            Number of threads used to search the nearest cells. -1 means using all cores.
+        recompute: `bool` (default: `False`)
+            Whether to rebuild the grid even if a valid one exists.
+
+    Returns
+    -------
+        grid: :class:`VelocityGrid`
+            The fitted grid, which is cached with adata for the current session (keyed by basis, dimensions, grid size,
+            density, smooth and n_neighbors, see `_get_adata_cache`) and rebuilt automatically when the embedding
+            changes.
+    """
+    from .connectivity import _checksum
+    from .utils import _get_adata_cache
+
+    dims = list(range(len(xy_grid_nums))) if dims is None else list(dims)
+    X = adata.obsm['X_' + basis][:, dims]
+    key = '{}_{}_{}_{}_{}_{}'.format(basis, '-'.join(map(str, dims)), '-'.join(map(str, xy_grid_nums)), density, smooth,
+                                     n_neighbors)
+
+    cache = _get_adata_cache(adata, 'velocity_grid')
+    grid = cache.get(key, None)
+
+    if recompute or grid is None or grid.checksum_ != _checksum(X):
+        grid = VelocityGrid(xy_grid_nums, density, smooth, n_neighbors).fit(X, n_jobs=n_jobs)
+        cache[key] = grid
+
+    return grid
+
 def smoothen_drift_on_grid(X, V, n_grid, nbrs=None, k=None, smoothness=1):
     # These codes are borrowed from velocyto. Need to be rewritten later.
     # Prepare the grid
@@ -259,9 +712,8 @@ def smoothen_drift_on_grid(X, V, n_grid, nbrs=None, k=None, smoothness=1):
     meshes_tuple = np.meshgrid(*grs)
     gridpoints_coordinates = np.vstack([i.flat for i in meshes_tuple]).T
 
-    if nbrs is None:
-        if k is None: k = 100
-        nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(X)
+    if nbrs is None and k is None: k = 100
+    nbrs = _get_nbrs(X, k, nbrs, method='exact')
     dists, neighs = nbrs.kneighbors(gridpoints_coordinates)
 
     from scipy.stats import norm as normal
@@ -280,13 +732,130 @@ class MarkovChain:
         self.D = None  # eigenvalues
         self.U = None  # left eigenvectors
         self.W = None  # right eigenvectors
+        self._P_cache, self._P_cache_src = {}, None  # powers of P keyed by (num_prop, threshold)
+        self._spectrum = None  # the source P, number, tolerance and symmetrization of the cached eigenpairs
+
+    def propagate_P(self, num_prop, threshold=None, cache=True):
+        """The num_prop-step transition matrix P^num_prop (sparse).
+
+        The powers are cached (keyed by num_prop and threshold) until P is refitted or replaced, and a new power starts
+        from the largest cached one. With a threshold, the entries of each intermediate product that are not larger
+        than threshold are dropped and the columns renormalized, which keeps the powers sparse.
+
+        Arguments
+        ---------
+            num_prop: `int`
+                Number of steps.
+            threshold: `float` or None (default: None)
+                The truncation threshold of the intermediate products. No truncation if None.
+            cache: `bool` (default: True)
+                Whether to cache the result.
+        """
+        if getattr(self, '_P_cache_src', None) is not self.P:
+            self._P_cache, self._P_cache_src = {}, self.P
+        if (num_prop, threshold) in self._P_cache:
+            return self._P_cache[(num_prop, threshold)]
+
+        P = sp.csc_matrix(self.P)
+        cached = [i for (i, t) in self._P_cache.keys() if t == threshold and i < num_prop]
+        start = max(cached) if len(cached) > 0 else 1
+        ret = self._P_cache[(start, threshold)] if len(cached) > 0 else sp.csc_matrix(P, copy=True)
+        for i in range(num_prop - start):
+            ret = P.dot(ret)
+            if threshold is not None:
+                ret.data[np.abs(ret.data) <= threshold] = 0
+                ret.eliminate_zeros()
+                col_sums = np.asarray(ret.sum(0)).flatten()
+                col_sums[col_sums == 0] = 1
+                ret = ret.dot(sp.diags(1 / col_sums)).tocsc()
+        if cache:
+            self._P_cache[(num_prop, threshold)] = ret
+        return ret
+
+    def apply_P(self, X, num_prop=1, transpose=False):
+        """Apply P^num_prop (or its transpose) to the vector or the columns of the matrix X with num_prop sparse
+        matrix-vector products, without forming the power of P."""
+        P = sp.csc_matrix(self.P)
+        P = P.T.tocsr() if transpose else P
+        ret = X
+        for i in range(num_prop):
+            ret = P.dot(ret)
+        return ret
+
+    def eigsys(self, k=None, which='LR', sigma=None, tol=0, symmetrize=False, method='arpack'):
+        """Compute the eigenvalues (D), left (U) and right (W) eigenvectors of P, sorted by decreasing eigenvalues.
+
+        With k set, only k eigenpairs are computed with ARPACK on the sparse matrix: the leading ones by `which`, or the
+        ones closest to sigma with the shift-invert mode (see scipy.sparse.linalg.eigs), which converges much faster
+        for the clustered eigenvalues of transition matrices. Otherwise the full dense eigendecomposition is computed.
 
-    def eigsys(self):
-        D, U, W = eig(self.P, left=True, right=True)
+        With symmetrize, P (column stochastic) is replaced by its reversible part P_s = (P Pi + Pi P^T) / 2 Pi^-1, where
+        Pi is the diagonal of the stationary distribution pi. The symmetric matrix Pi^-1/2 P_s Pi^1/2 is decomposed with
+        ARPACK (`eigsh`) or LOBPCG, which gives real eigenpairs with U = Pi^-1/2 phi and W = Pi^1/2 phi, and W[:, 0] = pi.
+
+        The eigenpairs are cached together with k, tol and symmetrize until P is refitted or replaced, see `_eigsys`.
+        """
+        n = self.get_num_states()
+        if symmetrize:
+            from scipy.sparse.linalg import eigsh, lobpcg
+
+            k = n if k is None else k
+            pi = _steady_state(sp.csr_matrix(self.P.T), method='gmres', tol=1e-10 if tol == 0 else tol)
+            pi = np.maximum(pi, np.finfo(float).tiny)
+            F = sp.csr_matrix(self.P).multiply(pi[None, :])
+            d = sp.diags(1 / np.sqrt(pi))
+            S = (d.dot(F + F.T).dot(d) / 2).tocsc()
+            if k >= n - 1 or (method == 'lobpcg' and 5 * k > n):
+                D, phi = np.linalg.eigh(S.toarray())
+            elif method == 'lobpcg':
+                X0 = np.random.RandomState(0).normal(size=(n, k))
+                X0[:, 0] = np.sqrt(pi)
+                D, phi = lobpcg(S, X0, tol=None if tol == 0 else tol, largest=True, maxiter=max(200, 2 * k))
+            else:
+                D, phi = eigsh(S, k=k, sigma=1 + 1e-6 if sigma is None else sigma, which='LM', tol=tol)
+            U, W = phi / np.sqrt(pi)[:, None], phi * np.sqrt(pi)[:, None]
+        elif k is None or k >= n - 1:
+            D, U, W = eig(self.P.toarray() if sp.issparse(self.P) else self.P, left=True, right=True)
+        else:
+            which = which if sigma is None else 'LM'
+            D, W = sp.linalg.eigs(sp.csc_matrix(self.P), k=k, which=which, sigma=sigma, tol=tol)
+            D_left, U = sp.linalg.eigs(sp.csc_matrix(self.P.T), k=k, which=which, sigma=sigma, tol=tol)
+            # pair the left with the right eigenvectors: after the sorting below, both are ordered by eigenvalue
+            U = U[:, np.argsort(D_left)[::-1]][:, np.argsort(np.argsort(D)[::-1])]
         idx = D.argsort()[::-1]
         self.D = D[idx]
         self.U = U[:, idx]
         self.W = W[:, idx]
+        self._spectrum = {'P': self.P, 'k': len(self.D), 'tol': tol, 'symmetrize': symmetrize}
+
+    def _eigsys(self, k, sigma=None, tol=0, symmetrize=False, method='arpack', n_eigs=None):
+        """Make sure that at least the k leading eigenpairs are computed, computing max(k, n_eigs) of them if needed.
+
+        The cached eigenpairs are reused if P is unchanged, there are at least k of them, they were computed with a
+        tolerance not looser than tol (0 means machine precision) and with the same symmetrize option (None accepts
+        either, for the quantities the reversible part shares with P, e.g. the stationary distribution).
+        """
+        cache = getattr(self, '_spectrum', None)
+        valid = self.D is not None and cache is not None and cache['P'] is self.P and cache['k'] >= k and \
+            (cache['tol'] == 0 or 0 < cache['tol'] <= tol) and (symmetrize is None or cache['symmetrize'] == symmetrize)
+        if not valid:
+            k = k if n_eigs is None else min(max(k, n_eigs), self.get_num_states())
+            self.eigsys(k, sigma=sigma, tol=tol, symmetrize=bool(symmetrize), method=method)
+
+    def diffusion_map_embedding(self, n_dims=2, t=1, symmetrize=False, tol=0, method='arpack', n_eigs=None):
+        """The diffusion map embedding Y_t = D^t U of the cells by the n_dims leading nontrivial eigenpairs of P.
+
+        n_eigs (default: max(n_dims + 1, 11)) eigenpairs are computed once (see `eigsys`) and reused for any n_dims up
+        to n_eigs - 1 and any diffusion time, so that t can also be a list of times, which returns an array of dimension
+        len(t) x n_cells x n_dims.
+        """
+        self._eigsys(n_dims + 1, sigma=1 + 1e-6, tol=tol, symmetrize=symmetrize, method=method,
+                     n_eigs=11 if n_eigs is None else n_eigs)
+        D, U = np.real(self.D[1:n_dims + 1]), np.real(self.U[:, 1:n_dims + 1])
+        if np.ndim(t) > 0:
+            return np.stack([D ** t_i * U for t_i in t])
+        Y = D ** t * U
+        return Y
 
     def get_num_states(self):
         return self.P.shape[0]
@@ -295,6 +864,8 @@ class MarkovChain:
         self.D = None
         self.U = None
         self.W = None
+        self._P_cache, self._P_cache_src = {}, None
+        self._spectrum = None
 
 
 class KernelMarkovChain(MarkovChain):
@@ -304,11 +875,46 @@ class KernelMarkovChain(MarkovChain):
         self.Idx = None
 
     def fit(self, X, V, M_diff, neighbor_idx=None, k=200, epsilon=None, adaptive_local_kernel=False, tol=1e-4,
-            sparse_construct=True, sample_fraction=None):
+            sparse_construct=True, sample_fraction=None, chunk_size=None, n_jobs=1, nbrs=None):
+        """Learn the transition matrix of the Markov chain from the Itô kernel.
+
+        The kernels of all cells are evaluated in blocks of `chunk_size` cells as (chunk_size x k x n_dims) tensor
+        operations, and the transition matrix is assembled directly in CSC format from COO index arrays.
+
+        Arguments
+        ---------
+            X: `np.ndarray` (dimension: n_cells x n_dims)
+                The cell states.
+            V: `np.ndarray` (dimension: n_cells x n_dims)
+                The velocity vectors of the cells.
+            M_diff: `np.ndarray` (dimension: n_dims x n_dims)
+                The diffusion matrix.
+            neighbor_idx: `np.ndarray` or None (default: None)
+                The kNN indices of the cells. If None, a kNN graph with k neighbors will be built or queried from nbrs.
+            k: `int` (default: 200)
+                Number of nearest neighbors used when neighbor_idx is None.
+            epsilon: `float` or None (default: None)
+                The bandwidth of the density kernel. The density correction is skipped when it is None.
+            adaptive_local_kernel: `bool` (default: False)
+                Whether to use the adaptive local drift kernel.
+            tol: `float` (default: 1e-4)
+                Transition probabilities no larger than tol are set to zero.
+            sparse_construct: `bool` (default: True)
+                Kept for backward compatibility; the transition matrix is always assembled in sparse format.
+            sample_fraction: `None` or `float` (default: None)
+                The downsampled fraction of kNN for the purpose of acceleration.
+            chunk_size: `int` or None (default: None)
+                Number of cells whose kernels are evaluated at once, which bounds the peak memory. By default it is
+                chosen so that each (chunk_size x k x n_dims) block holds about 8 million elements.
+            n_jobs: `int` (default: 1)
+                Number of threads used to process the blocks of cells. -1 means using all cores.
+            nbrs: :class:`~dynamo.tools.connectivity.NeighborIndex` or None (default: None)
+                A prebuilt kNN index of X (see `neighbor_index`) that is queried when neighbor_idx is None. If None, an
+                exact index is built; pass an index built with `method='pynndescent'` to use approximate neighbors.
+        """
         # compute connectivity
         if neighbor_idx is None:
-            nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(X)
-            _, self.Idx = nbrs.kneighbors(X)
+            _, self.Idx = _get_nbrs(X, k, nbrs, method='exact').kneighbors(X, n_neighbors=k)
         else:
             self.Idx = neighbor_idx
         # apply kNN downsampling to accelerate calculation (adapted from velocyto)
@@ -317,165 +923,171 @@ class KernelMarkovChain(MarkovChain):
             p = np.linspace(0.5, 1, neighbor_idx.shape[1])
             p = p / p.sum()
 
-            sampling_ixs = np.stack((np.random.choice(np.arange(1,neighbor_idx.shape[1]-1),
+            sampling_ixs = np.stack([np.random.choice(np.arange(1,neighbor_idx.shape[1]-1),
                                                       size=int(sample_fraction * (neighbor_idx.shape[1] + 1)),
                                                       replace=False,
-                                                      p=p) for i in range(neighbor_idx.shape[0])), 0)
+                                                      p=p) for i in range(neighbor_idx.shape[0])], 0)
             self.Idx = self.Idx[np.arange(neighbor_idx.shape[0])[:, None], sampling_ixs]
-        n = X.shape[0]
-        if sparse_construct:
-            self.P = sp.lil_matrix((n, n))
-        else:
-            self.P = np.zeros((n, n))
+        n, n_nbrs = X.shape[0], self.Idx.shape[1]
+        chunk_size = _get_chunk_size(n_nbrs * X.shape[1], chunk_size)
+        cols = np.repeat(np.arange(n), n_nbrs)
 
         # compute density kernel
         if epsilon is not None:
-            if sparse_construct:
-                self.Kd = sp.lil_matrix((n, n))
-            else:
-                self.Kd = np.zeros((n, n))
             inv_eps = 1 / epsilon
-            for i in range(n):
-                self.Kd[i, self.Idx[i]] = compute_density_kernel(X[i], X[self.Idx[i]], inv_eps)
-            self.Kd = sp.csc_matrix(self.Kd)
-            D = np.sum(self.Kd, 0)
+            kd = np.zeros((n, n_nbrs))
+
+            def density_chunk(i):
+                Idx = self.Idx[i:i + chunk_size]
+                kd[i:i + chunk_size] = compute_density_kernel_batch(X[Idx] - X[i:i + chunk_size, None, :], inv_eps)
+
+            _run_chunks(density_chunk, n, chunk_size, n_jobs)
+            self.Kd = sp.csc_matrix((kd.ravel(), (cols, self.Idx.ravel())), shape=(n, n))
+            self.Kd.eliminate_zeros()
+            D = np.bincount(self.Idx.ravel(), weights=kd.ravel(), minlength=n)
+            del kd
 
         # compute transition prob.
         inv_s = np.linalg.inv(M_diff)
-        for i in range(n):
-            y = X[i]
-            v = V[i]
-            Y = X[self.Idx[i]]
+        vals = np.zeros((n, n_nbrs))
+
+        def transition_chunk(i):
+            Idx = self.Idx[i:i + chunk_size]
+            Dx = X[Idx] - X[i:i + chunk_size, None, :]
             if adaptive_local_kernel:
-                k, tau = compute_drift_local_kernel(y, v, Y, inv_s)
+                k, tau = compute_drift_local_kernel_batch(Dx, V[i:i + chunk_size], inv_s)
             else:
-                k = compute_drift_kernel(y, v, Y, inv_s)
+                k = compute_drift_kernel_batch(Dx, V[i:i + chunk_size], inv_s)
             if epsilon is not None:
-                k = k / D[0, self.Idx[i]]
-            else:
-                k = np.matrix(k)
-            # if np.sum(k) == 0:
-            #     print(i)
-            #     print(tau)
-            p = k / np.sum(k)
+                k = k / D[Idx]
+            p = k / np.sum(k, 1)[:, None]
             p[p <= tol] = 0  # tolerance check
-            p = p / np.sum(p)
-            self.P[self.Idx[i], i] = p.A[0]
+            vals[i:i + chunk_size] = p / np.sum(p, 1)[:, None]
 
-        self.P = sp.csc_matrix(self.P)
+        _run_chunks(transition_chunk, n, chunk_size, n_jobs)
 
-    def propagate_P(self, num_prop):
-        ret = sp.csc_matrix(self.P, copy=True)
-        for i in range(num_prop - 1):
-            ret = self.P * ret # sparse matrix (ret) is a `np.matrix`
-        return ret
+        self.P = sp.csc_matrix((vals.ravel(), (self.Idx.ravel(), cols)), shape=(n, n))
+        self.P.eliminate_zeros()
 
     def compute_drift(self, X, num_prop=1):
-        n = self.get_num_states()
-        V = np.zeros_like(X)
-        P = self.propagate_P(num_prop)
-        for i in range(n):
-            V[i] = (X - X[i]).T.dot(P[:, i].A.flatten())
+        # V[i] = sum_j P^num_prop[j, i] (X[j] - X[i]), with P^num_prop applied by sparse matrix-vector products
+        V = self.apply_P(X, num_prop, transpose=True) - X * self.apply_P(np.ones(X.shape[0]), num_prop,
+                                                                          transpose=True)[:, None]
         return V
 
-    def compute_density_corrected_drift(self, X, neighbor_idx, k=None, num_prop=1, normalize_vector=False):
-        n = self.get_num_states()
-        V = np.zeros_like(X)
-        P = self.propagate_P(num_prop)
-        if k is None:
-            k = neighbor_idx.shape[1]
-        for i in range(n):
-            Idx = neighbor_idx[i]
-            D = X[Idx] - X[i]
-            if normalize_vector:
-                D = D / np.linalg.norm(D, 1)
-            p = P[Idx, i].A.flatten() - 1 / k
-            V[i] = D.T.dot(p)
+    def compute_density_corrected_drift(self, X, neighbor_idx, k=None, num_prop=1, normalize_vector=False,
+                                        threshold=None, use_numba=False):
+        # the displacements of each cell are normalized by their matrix 1-norm
+        P = self.propagate_P(num_prop, threshold)
+        V = density_corrected_drift(X, neighbor_idx, P, k, norm_ord=1 if normalize_vector else None,
+                                    use_numba=use_numba)
         return V
 
     def compute_stationary_distribution(self):
-        # if self.W is None:
-        # self.eigsys()
-        _, vecs = sp.linalg.eigs(self.P, k=1, which='LR')
-        p = np.abs(np.real(vecs[:, 0]))
+        # served by any cached decomposition, since the reversible part of P has the same stationary distribution
+        self._eigsys(1, sigma=1 + 1e-6, symmetrize=None)
+        p = np.abs(np.real(self.W[:, 0]))
         p = p / np.sum(p)
         return p
 
-    def diffusion_map_embedding(self, n_dims=2, t=1):
-        # if self.W is None:
-        #    self.eigsys()
-        vals, vecs = sp.linalg.eigs(self.P.T, k=n_dims + 1, which='LR')
-        Y = np.real(vals[1:n_dims + 1] ** t) * np.real(vecs[:, 1:n_dims + 1])
-        return Y
-
 
 class DiscreteTimeMarkovChain(MarkovChain):
     def __init__(self, P=None):
         super().__init__(P)
         self.Kd = None
 
-    def fit(self, X, V, k, s=None, method='qp', eps=None, tol=1e-4): # pass index
+    def fit(self, X, V, k, s=None, method='qp', eps=None, tol=1e-4, nbrs=None, chunk_size=None, n_jobs=1): # pass index
+        """Learn the (sparse, column stochastic) transition matrix of the chain from the cell states and velocities.
+
+        The transition probabilities of blocks of cells are computed at once, with the batched QP solver
+        (`compute_markov_trans_prob_batch`) or the drift kernel, and P is assembled in CSC format.
+
+        Arguments
+        ---------
+            X: `np.ndarray` (dimension: n_cells x n_dims)
+                The cell states.
+            V: `np.ndarray` (dimension: n_cells x n_dims)
+                The velocity vectors of the cells.
+            k: `int`
+                Number of nearest neighbors (including the cell itself).
+            s: `np.ndarray` or None (default: None)
+                The diffusion coefficients (qp) or the diffusion matrix (kernel).
+            method: `str` (default: `qp`)
+                `qp` or `kernel`.
+            eps: `float` or None (default: None)
+                The bandwidth of the density kernel of the `kernel` method.
+            tol: `float` (default: 1e-4)
+                Transition probabilities no larger than tol are set to zero.
+            nbrs: :class:`~dynamo.tools.connectivity.NeighborIndex` or None (default: None)
+                A prebuilt kNN index of X. If None, an exact index is built; pass an index built with
+                `method='pynndescent'` to use approximate neighbors.
+            chunk_size: `int` or None (default: None)
+                Number of cells processed at once.
+            n_jobs: `int` (default: 1)
+                Number of threads used to process the blocks of cells. -1 means using all cores.
+        """
         # the parameter k will be replaced by a connectivity matrix in the future.
         self.__reset__()
-        # knn clustering
-        nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(X)
-        _, Idx = nbrs.kneighbors(X)
+        # knn clustering (nbrs: a prebuilt kNN index of X)
+        _, Idx = _get_nbrs(X, k, nbrs, method='exact').kneighbors(X, n_neighbors=k)
         # compute transition prob.
-        n = X.shape[0]
-        self.P = np.zeros((n, n))
+        n, k = X.shape[0], Idx.shape[1]
+        chunk_size = _get_chunk_size(k * X.shape[1], chunk_size)
+        cols = np.repeat(np.arange(n), k)
+        vals = np.zeros((n, k))
         if method == 'kernel':
             inv_s = np.linalg.inv(s)
             # compute density kernel
             if eps is not None:
-                self.Kd = np.zeros((n, n))
                 inv_eps = 1 / eps
-                for i in range(n):
-                    self.Kd[i, Idx[i]] = compute_density_kernel(X[i], X[Idx[i]], inv_eps)
-                D = np.sum(self.Kd, 0)
-        for i in range(n):
-            y = X[i]
-            v = V[i]
+                kd = np.zeros((n, k))
+
+                def density_chunk(i):
+                    kd[i:i + chunk_size] = compute_density_kernel_batch(X[Idx[i:i + chunk_size]] -
+                                                                        X[i:i + chunk_size, None, :], inv_eps)
+
+                _run_chunks(density_chunk, n, chunk_size, n_jobs)
+                self.Kd = sp.csc_matrix((kd.ravel(), (cols, Idx.ravel())), shape=(n, n))
+                D = np.bincount(Idx.ravel(), weights=kd.ravel(), minlength=n)
+
+        def transition_chunk(i):
+            Dx = X[Idx[i:i + chunk_size]] - X[i:i + chunk_size, None, :]
             if method == 'qp':
-                Y = X[Idx[i, 1:]]
-                p = compute_markov_trans_prob(y, v, Y, s)
+                p = compute_markov_trans_prob_batch(Dx[:, 1:], V[i:i + chunk_size], s)
                 p[p <= tol] = 0  # tolerance check
-                self.P[Idx[i, 1:], i] = p
-                self.P[i, i] = 1 - np.sum(p)
+                vals[i:i + chunk_size] = np.hstack((1 - np.sum(p, 1)[:, None], p))
             else:
-                Y = X[Idx[i]]
-                # p = compute_kernel_trans_prob(y, v, Y, inv_s)
-                k = compute_drift_kernel(y, v, Y, inv_s)
+                k = compute_drift_kernel_batch(Dx, V[i:i + chunk_size], inv_s)
                 if eps is not None:
-                    k /= D[Idx[i]]
-                p = k / np.sum(k)
+                    k = k / D[Idx[i:i + chunk_size]]
+                p = k / np.sum(k, 1)[:, None]
                 p[p <= tol] = 0  # tolerance check
-                p = p / np.sum(p)
-                self.P[Idx[i], i] = p
+                vals[i:i + chunk_size] = p / np.sum(p, 1)[:, None]
 
-    def propagate_P(self, num_prop):
-        ret = np.array(self.P, copy=True)
-        for i in range(num_prop - 1):
-            ret = self.P @ ret
-        return ret
+        _run_chunks(transition_chunk, n, chunk_size, n_jobs)
+
+        # the first neighbor of a cell is the cell itself, which takes the remaining probability in the qp method
+        rows = Idx.ravel() if method != 'qp' else np.hstack((np.arange(n)[:, None], Idx[:, 1:])).ravel()
+        self.P = sp.csc_matrix((vals.ravel(), (rows, cols)), shape=(n, n))
+        self.P.eliminate_zeros()
 
     def compute_drift(self, X, num_prop=1):
-        n = self.get_num_states()
-        V = np.zeros_like(X)
-        P = self.propagate_P(num_prop)
-        for i in range(n):
-            V[i] = (X - X[i]).T.dot(P[:, i])
+        # V[i] = sum_j P^num_prop[j, i] (X[j] - X[i]), with P^num_prop applied by sparse matrix-vector products
+        V = self.apply_P(X, num_prop, transpose=True) - X * self.apply_P(np.ones(X.shape[0]), num_prop,
+                                                                          transpose=True)[:, None]
         return V
 
     def compute_density_corrected_drift(self, X, k=None, normalize_vector=False):
         n = self.get_num_states()
         if k is None:
             k = n
-        V = np.zeros_like(X)
-        for i in range(n):
-            d = X - X[i] ###############################no self.nbrs_idx[i] is here.... may be wrong?
-            if normalize_vector:
-                d /= np.linalg.norm(d)
-            V[i] = d.T.dot(self.P[:, i] - 1 / k)
+        P = sp.csc_matrix(self.P)
+        # V[i] = (X - X[i]).T.dot(P[:, i] - 1 / k), computed without forming the n x n displacements
+        V = P.T.dot(X) - X * np.asarray(P.sum(0)).T - (X.sum(0) - n * X) / k
+        if normalize_vector:
+            # the Frobenius norm of X - X[i]
+            X_c = X - X.mean(0)
+            V /= np.sqrt(n * np.sum(X_c ** 2, 1) + np.sum(X_c ** 2))[:, None]
         return V
 
     def solve_distribution(self, p0, n, method='naive'):
@@ -484,27 +1096,20 @@ class DiscreteTimeMarkovChain(MarkovChain):
             for _ in range(n):
                 p = self.P.dot(p)
         else:
-            if self.D is None:
-                self.eigsys()
+            self._eigsys(self.get_num_states())
             p = np.real(self.W @ np.diag(self.D ** n) @ np.linalg.inv(self.W)).dot(p0)
         return p
 
     def compute_stationary_distribution(self, method='eig'):
         if method == 'solve':
-            p = np.real(null_space(self.P - np.eye(self.P.shape[0])[:, 0]).flatten())
+            # the steady state of the chain with the (row stochastic) transition matrix P^T
+            p = _steady_state(sp.csr_matrix(self.P.T), method='gmres')
         else:
-            if self.W is None:
-                self.eigsys()
+            self._eigsys(1, sigma=1 + 1e-6, symmetrize=None)  # the eigenvalues of a stochastic matrix are at most 1
             p = np.abs(np.real(self.W[:, 0]))
         p = p / np.sum(p)
         return p
 
-    def diffusion_map_embedding(self, n_dims=2, t=1):
-        if self.W is None:
-            self.eigsys()
-        Y = np.real(self.D[1:n_dims + 1] ** t) * np.real(self.U[:, 1:n_dims + 1])
-        return Y
-
 
 class ContinuousTimeMarkovChain(MarkovChain):
     def __init__(self, P=None, nbrs_idx=None):
@@ -512,54 +1117,66 @@ class ContinuousTimeMarkovChain(MarkovChain):
         self.Kd = None
         self.nbrs_idx = nbrs_idx
 
-    def fit(self, X, V, k, s=None, tol=1e-4):
+    def fit(self, X, V, k, s=None, tol=1e-4, nbrs=None, chunk_size=None, n_jobs=1):
+        """Learn the (sparse) transition rate matrix of the chain, whose columns sum to zero, with the batched QP solver
+        (`compute_markov_trans_prob_batch`) applied to blocks of chunk_size cells on n_jobs threads. The neighbors are
+        queried from nbrs if given, otherwise found with an exact index."""
         self.__reset__()
-        # knn clustering
+        # knn clustering (nbrs: a prebuilt kNN index of X)
         if self.nbrs_idx is None:
-            nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(X)
-            _, Idx = nbrs.kneighbors(X)
+            _, Idx = _get_nbrs(X, k, nbrs, method='exact').kneighbors(X, n_neighbors=k)
             self.nbrs_idx = Idx
         else:
             Idx = self.nbrs_idx
         # compute transition prob.
-        n = X.shape[0]
-        self.P = np.zeros((n, n))
-        for i in range(n):
-            y = X[i]
-            v = V[i]
-            Y = X[Idx[i, 1:]]
-            p = compute_markov_trans_prob(y, v, Y, s, cont_time=True)
+        n, k = X.shape[0], Idx.shape[1]
+        chunk_size = _get_chunk_size(k * X.shape[1], chunk_size)
+        vals = np.zeros((n, k))
+
+        def transition_chunk(i):
+            Dx = X[Idx[i:i + chunk_size, 1:]] - X[i:i + chunk_size, None, :]
+            p = compute_markov_trans_prob_batch(Dx, V[i:i + chunk_size], s, cont_time=True)
             p[p <= tol] = 0  # tolerance check
-            self.P[Idx[i, 1:], i] = p
-            self.P[i, i] = - np.sum(p)
+            vals[i:i + chunk_size] = np.hstack((- np.sum(p, 1)[:, None], p))
+
+        _run_chunks(transition_chunk, n, chunk_size, n_jobs)
+
+        rows = np.hstack((np.arange(n)[:, None], Idx[:, 1:])).ravel()
+        self.P = sp.csc_matrix((vals.ravel(), (rows, np.repeat(np.arange(n), k))), shape=(n, n))
+        self.P.eliminate_zeros()
 
     def compute_drift(self, X):
-        n = self.get_num_states()
-        V = np.zeros_like(X)
-        for i in range(n):
-            V[i] = (X - X[i]).T.dot(self.P[:, i])
+        P = sp.csc_matrix(self.P)
+        # V[i] = sum_j P[j, i] (X[j] - X[i])
+        V = P.T.dot(X) - X * np.asarray(P.sum(0)).T
         return V
 
-    def compute_density_corrected_drift(self, X, k=None, normalize_vector=False):
+    def compute_density_corrected_drift(self, X, k=None, normalize_vector=False, use_numba=False):
         n = self.get_num_states()
-        if k is None:
-            k = n
-        V = np.zeros_like(X)
-        for i in range(n):
-            d = X[self.nbrs_idx[i]] - X[i]
-            if normalize_vector:
-                d /= np.linalg.norm(d)
-            V[i] = d.T.dot(self.P[self.nbrs_idx[i], i] - 1 / k)
+        V = density_corrected_drift(X, self.nbrs_idx, self.P, n if k is None else k,
+                                    norm_ord='fro' if normalize_vector else None, use_numba=use_numba)
         return V
 
     def solve_distribution(self, p0, t):
-        if self.D is None:
-            self.eigsys()
-        p = np.real(self.W @ np.diag(np.exp(self.D * t)) @ np.linalg.inv(self.W)).dot(p0)
+        # the action of the matrix exponential on p0 without the eigendecomposition
+        from scipy.sparse.linalg import expm_multiply
+        p = expm_multiply(sp.csc_matrix(self.P) * t, p0)
         return p
 
     def compute_stationary_distribution(self):
-        p = np.real(null_space(self.P)[:, 0].flatten())
+        # the steady state of the uniformized discrete time chain I + P / q has P p = 0
+        P = sp.csc_matrix(self.P)
+        q = np.max(np.abs(P.diagonal()))
+        M = sp.identity(P.shape[0], format='csc') + P / (q if q > 0 else 1)
+        p = _steady_state(sp.csr_matrix(M.T), method='gmres')
         p = p / np.sum(p)
         return p
 
+    def diffusion_map_embedding(self, n_dims=2, t=1, tol=0, n_eigs=None):
+        # the eigenvalues of the rate matrix are at most 0, and exp(D t) those of the transition matrix at time t
+        self._eigsys(n_dims + 1, sigma=1e-6, tol=tol, n_eigs=11 if n_eigs is None else n_eigs)
+        D, U = np.real(self.D[1:n_dims + 1]), np.real(self.U[:, 1:n_dims + 1])
+        if np.ndim(t) > 0:
+            return np.stack([np.exp(D * t_i) * U for t_i in t])
+        Y = np.exp(D * t) * U
+        return Y
@@ -6,7 +6,7 @@
 # from .dynamo_fitting import sol_u, sol_s, sol_p, sol_ode, sol_num, fit_gamma_labelling, fit_beta_lsq, fit_alpha_labelling, fit_alpha_synthesis, fit_gamma_splicing, fit_gamma
 from .moments import Estimation
 
-from .velocity import sol_u, sol_s, sol_p, fit_linreg, fit_first_order_deg_lsq, solve_first_order_deg, fit_gamma_lsq, fit_alpha_synthesis, fit_alpha_degradation, velocity, estimation
+from .velocity import sol_u, sol_s, sol_p, fit_linreg, fit_linreg_rows, fit_gamma_steady_state_genes, fit_first_order_deg_lsq, solve_first_order_deg, fit_gamma_lsq, fit_alpha_synthesis, fit_alpha_degradation, velocity, estimation
 from .cell_velocities import cell_velocities, generalized_diffusion_map, stationary_distribution, diffusion, expected_return_time
 
 from .dynamics import dynamics
@@ -15,10 +15,10 @@ from .dynamics import dynamics
 from .velocyto_scvelo import vlm_to_adata, converter, run_velocyto, run_scvelo, mean_var_by_time, run_dynamo, run_dynamo_simple_fit, run_dynamo_labelling, compare_res
 
 # vector field related
-from .scVectorField import SparseVFC, con_K, get_P, VectorField, vector_field_function #, evaluate, con_K_div_cur_free, vector_field_function, vector_field_function_auto, auto_con_K
+from .scVectorField import SparseVFC, con_K, con_K_dot, get_P, VectorField, vector_field_function #, evaluate, con_K_div_cur_free, vector_field_function, vector_field_function_auto, auto_con_K
 
 # Markov chain related:
-from .Markov import markov_combination, compute_markov_trans_prob, compute_kernel_trans_prob, compute_drift_kernel, compute_drift_local_kernel, compute_density_kernel, makeTransitionMatrix, compute_tau, smoothen_drift_on_grid, MarkovChain, KernelMarkovChain, DiscreteTimeMarkovChain, ContinuousTimeMarkovChain
+from .Markov import markov_combination, compute_markov_trans_prob, compute_markov_trans_prob_batch, compute_kernel_trans_prob, compute_drift_kernel, compute_drift_local_kernel, compute_density_kernel, compute_drift_kernel_batch, compute_drift_local_kernel_batch, compute_density_kernel_batch, density_corrected_drift, makeTransitionMatrix, compute_tau, smoothen_drift_on_grid, velocity_on_grid, velocity_grid, VelocityGrid, MarkovChain, KernelMarkovChain, DiscreteTimeMarkovChain, ContinuousTimeMarkovChain
 
 # potential related
 from .scPotential import gen_fixed_points, gen_gradient, IntGrad, DiffusionMatrix, action, Potential #, vector_field_function
@@ -30,7 +30,8 @@ from .Ao import Ao_pot_map
 from .fate import Fate, fate
 
 # dimension reduction related
-from .dimension_reduction import extract_indices_dist_from_graph, umap_conn_indices_dist_embedding, reduceDimension
+from .dimension_reduction import extract_indices_dist_from_graph, umap_conn_indices_dist_embedding, reduceDimension, PCA
+from .connectivity import NeighborIndex, neighbor_index
 
 # Pseudotime related
 from .DDRTree import DDRTree_py as DDRTree
@@ -1,10 +1,13 @@
 import scipy as scp
-from scipy.sparse import csc_matrix, issparse
+from scipy.sparse import csc_matrix, csr_matrix, issparse
 from .Markov import *
+from .Markov import _normalize_rows, _steady_state
+from .utils import _get_n_jobs, _get_chunk_size
+from .connectivity import neighbor_index
 from numba import jit
 
 def cell_velocities(adata, vkey='pca', basis='umap', method='analytical', num_pcs=None, neg_cells_trick=False, calc_rnd_vel=False,
-                    xy_grid_nums=(50, 50), sample_fraction=None, random_seed=19491001, **kmc_kwargs):
+                    xy_grid_nums=(50, 50), sample_fraction=None, random_seed=19491001, n_jobs=1, **kmc_kwargs):
     """Compute transition probability and project high dimension velocity vector to existing low dimension embedding.
 
     It is powered by the Itô kernel that not only considers the correlation between the vector from any cell to its
@@ -13,6 +16,11 @@ def cell_velocities(adata, vkey='pca', basis='umap', method='analytical', num_pc
     calculation of the stationary distribution or source states of sampled cells. The original "correlation" velocity projection
     method is also supported.
 
+    When a Markov chain needs more neighbors than the given kNN indices (e.g. the randomized one), an exact kNN index of
+    the pca basis is built once and cached with adata for the session (see `neighbor_index`), so that it is shared by the
+    Markov chains and any later call. Likewise the grid-to-cell neighbor map of the embedding is cached with adata (see
+    `velocity_grid`) and shared by the real and the randomized grid velocities and the plots.
+
     Arguments
     ---------
         adata: :class:`~anndata.AnnData`
@@ -41,6 +49,10 @@ def cell_velocities(adata, vkey='pca', basis='umap', method='analytical', num_pc
         random_seed: `int` (default: 19491001)
             The random seed for numba to ensure consistency of the random velocity vectors. Default value 19491001 is a special
             day for those who care.
+        n_jobs: `int` (default: 1)
+            Number of threads used by the `analytical` method to build the transition matrix in blocks of cells. -1 means
+            using all cores. When calc_rnd_vel is True and n_jobs is not 1, the real and the randomized transition matrices
+            are also learned concurrently. Results do not depend on n_jobs.
 
     Returns
     -------
@@ -57,43 +69,51 @@ def cell_velocities(adata, vkey='pca', basis='umap', method='analytical', num_pc
     V_mat = adata.obsm['_velocity_' + vkey] if '_velocity_' + vkey in adata.obsm.keys() else None
     X_pca, X_embedding = adata.obsm['X_pca'], adata.obsm['X_'+basis][:, :2]
     X_pca = X_pca if num_pcs is None else X_pca[:, :num_pcs]
+    grid = velocity_grid(adata, basis=basis, xy_grid_nums=xy_grid_nums, n_jobs=n_jobs)
+
+    if calc_rnd_vel:
+        # permute a copy so that the velocity stored in adata is left untouched
+        V_rnd = np.array(V_mat, copy=True)
+        permute_rows_nsign(V_rnd)
 
     # add both source and sink distribution
     if method == 'analytical':
-        kmc = KernelMarkovChain()
         ndims = X_pca.shape[1]
         kmc_args = {"M_diff": 0.25 * np.eye(ndims), "epsilon": 10**2, "adaptive_local_kernel": True, "tol": 1e-7}
         kmc_args.update(kmc_kwargs)
-
         # number of kNN in neighbor_idx may be too small
-        kmc.fit(X_pca[:, :ndims], V_mat[:, :ndims], neighbor_idx=indices, k=min(500, X_pca.shape[0] - 1), sample_fraction=sample_fraction, **kmc_args)
-        T = kmc.P
-        delta_X = kmc.compute_density_corrected_drift(X_embedding, kmc.Idx, normalize_vector=True) # indices, k = 500
-        # P = kmc.compute_stationary_distribution()
-        # adata.obs['stationary_distribution'] = P
-        X_grid, V_grid, D = velocity_on_grid(X_embedding, delta_X, xy_grid_nums=xy_grid_nums)
-
-        if calc_rnd_vel:
-            kmc = KernelMarkovChain()
-            ndims = X_pca.shape[1]
-            permute_rows_nsign(V_mat)
-            kmc.fit(X_pca[:, :ndims], V_mat[:, :ndims], k=min(500, X_pca.shape[0] - 1), M_diff=4 * np.eye(ndims),
-                    epsilon=None,
-                    adaptive_local_kernel=True, tol=1e-7)  # neighbor_idx=indices,
-            T_rnd = kmc.P
-            delta_X_rnd = kmc.compute_density_corrected_drift(X_embedding, kmc.Idx,
-                                                          normalize_vector=True)  # indices, k = 500
-            # P_rnd = kmc.compute_stationary_distribution()
-            # adata.obs['stationary_distribution_rnd'] = P_rnd
-            X_grid_rnd, V_grid_rnd, D_rnd = velocity_on_grid(X_embedding, delta_X_rnd, xy_grid_nums=xy_grid_nums)
-
-        adata.uns['transition_matrix'] = kmc
+        kmc_args.update({"neighbor_idx": indices, "k": min(500, X_pca.shape[0] - 1), "sample_fraction": sample_fraction})
+        rnd_kmc_args = {"M_diff": 4 * np.eye(ndims), "epsilon": None, "adaptive_local_kernel": True, "tol": 1e-7,
+                        "k": min(500, X_pca.shape[0] - 1)} # neighbor_idx=indices,
+        if calc_rnd_vel or kmc_args['neighbor_idx'] is None:
+            # only the chains without given kNN indices query the index
+            nbrs = neighbor_index(adata, basis='pca', n_neighbors=min(500, X_pca.shape[0] - 1), dims=ndims,
+                                  method='exact', n_jobs=n_jobs)
+            kmc_args['nbrs'], rnd_kmc_args['nbrs'] = nbrs, nbrs
+
+        if calc_rnd_vel and _get_n_jobs(n_jobs) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                res = executor.submit(_analytical_vec, X_pca, X_embedding, V_mat, xy_grid_nums, n_jobs, grid,
+                                     **kmc_args)
+                res_rnd = executor.submit(_analytical_vec, X_pca, X_embedding, V_rnd, xy_grid_nums, n_jobs, grid,
+                                         **rnd_kmc_args)
+                T, delta_X, X_grid, V_grid, D = res.result()
+                T_rnd, delta_X_rnd, X_grid_rnd, V_grid_rnd, D_rnd = res_rnd.result()
+        else:
+            T, delta_X, X_grid, V_grid, D = _analytical_vec(X_pca, X_embedding, V_mat, xy_grid_nums, n_jobs, grid,
+                                                            **kmc_args)
+            if calc_rnd_vel:
+                T_rnd, delta_X_rnd, X_grid_rnd, V_grid_rnd, D_rnd = _analytical_vec(X_pca, X_embedding, V_rnd, xy_grid_nums,
+                                                                                    n_jobs, grid, **rnd_kmc_args)
     elif method == 'empirical': # add random velocity vectors calculation below
-        T, delta_X, X_grid, V_grid, D = _empirical_vec(X_pca, X_embedding, V_mat, indices, neg_cells_trick, xy_grid_nums, neighbors)
+        T, delta_X, X_grid, V_grid, D = _empirical_vec(X_pca, X_embedding, V_mat, indices, neg_cells_trick, xy_grid_nums, neighbors,
+                                                        grid=grid)
 
         if calc_rnd_vel:
-            permute_rows_nsign(V_mat)
-            T_rnd, delta_X_rnd, X_grid_rnd, V_grid_rnd, D_rnd = _empirical_vec(X_pca, X_embedding, V_mat, indices, neg_cells_trick, xy_grid_nums, neighbors)
+            T_rnd, delta_X_rnd, X_grid_rnd, V_grid_rnd, D_rnd = _empirical_vec(X_pca, X_embedding, V_rnd, indices, neg_cells_trick,
+                                                                               xy_grid_nums, neighbors, grid=grid)
 
     adata.uns['transition_matrix'] = T
     adata.obsm['velocity_' + basis] = delta_X
@@ -131,9 +151,8 @@ def stationary_distribution(adata, method='kmc', direction='both', calc_rnd=True
 
     if method is 'kmc':
         kmc = KernelMarkovChain()
-        kmc.P = T
         if direction is 'both':
-            adata.obs['sink_steady_state_distribution'] = kmc.compute_stationary_distribution()
+            adata.obs['sink_steady_state_distribution'] = _markov_chain(adata).compute_stationary_distribution()
             kmc.P = T.T / T.T.sum(0)
             adata.obs['source_steady_state_distribution'] = kmc.compute_stationary_distribution()
 
@@ -145,7 +164,7 @@ def stationary_distribution(adata, method='kmc', direction='both', calc_rnd=True
                 adata.obs['source_steady_state_distribution_rnd'] = kmc.compute_stationary_distribution()
 
         elif direction is 'forward':
-            adata.obs['sink_steady_state_distribution'] = kmc.compute_stationary_distribution()
+            adata.obs['sink_steady_state_distribution'] = _markov_chain(adata).compute_stationary_distribution()
 
             if calc_rnd:
                 T_rnd = adata.uns['transition_matrix_rnd']
@@ -184,12 +203,17 @@ def stationary_distribution(adata, method='kmc', direction='both', calc_rnd=True
 def generalized_diffusion_map(adata, **kwargs):
     """Apply the diffusion map algorithm on the transition matrix build from Itô kernel.
 
+    The Markov chain of the transition matrix, together with its eigendecomposition, is cached with adata for the
+    current session (see `_get_adata_cache`), so that calls with other n_dims (up to the number of computed
+    eigenpairs) or t reuse the eigenpairs instead of solving the eigenproblem again.
+
     Parameters
     ----------
         adata: :class:`~anndata.AnnData`
             AnnData object that contains the constructed transition matrix.'
         kwargs:
-            Additional parameters that will be passed to the diffusion_map_embedding function.
+            Additional parameters (n_dims, t, symmetrize, tol, method) that will be passed to the diffusion_map_embedding
+            function. With a list of t, the embedding of each time is saved as X_diffusion_map_t{t}.
 
     Returns
     -------
@@ -197,28 +221,60 @@ def generalized_diffusion_map(adata, **kwargs):
             AnnData object that updated with X_diffusion_map embedding in obsm attribute.
     """
 
-    kmc = KernelMarkovChain()
-    kmc.P = adata.uns['transition_matrix']
+    kmc = _markov_chain(adata)
     dm_args = {"n_dims": 2, "t": 1}
     dm_args.update(kwargs)
-    dm = kmc.diffusion_map_embedding(*dm_args)
+    dm = kmc.diffusion_map_embedding(**dm_args)
+
+    if np.ndim(dm_args['t']) > 0:
+        for t, Y in zip(dm_args['t'], dm):
+            adata.obsm['X_diffusion_map_t' + str(t)] = Y
+    else:
+        adata.obsm['X_diffusion_map'] = dm
 
-    adata.obsm['X_diffusion_map'] = dm
 
+def _markov_chain(adata, key='transition_matrix'):
+    """The KernelMarkovChain of the transition matrix in the uns attribute, cached with adata for the current session
+    as long as the transition matrix is not replaced."""
+    from .utils import _get_adata_cache
 
-def diffusion(M, P0=None, steps=None, backward=False):
+    cache = _get_adata_cache(adata, 'markov_chain')
+    kmc = cache.get(key, None)
+    if kmc is None or kmc.P is not adata.uns[key]:
+        kmc = KernelMarkovChain()
+        kmc.P = adata.uns[key]
+        cache[key] = kmc
+
+    return kmc
+
+
+def diffusion(M, P0=None, steps=None, backward=False, method='auto', tol=1e-10, maxiter=None):
     """Find the state distribution of a Markov process.
 
+    The transition matrix is kept sparse: the steady state is found with ARPACK, GMRES or power iterations instead of a
+    dense eigendecomposition, and the distribution after a number of steps is propagated with repeated sparse
+    matrix-vector products instead of matrix powers.
+
     Parameters
     ----------
-        M: `numpy.ndarray` (dimension n x n, where n is the cell number)
-            The transition matrix.
+        M: `numpy.ndarray` or `scipy.sparse` matrix (dimension n x n, where n is the cell number)
+            The transition matrix, the rows are the sources and the columns the targets.
         P0: `numpy.ndarray` (default None; dimension is n, )
-            The initial cell state.
+            The initial cell state. The uniform distribution is used if None.
         steps: `int` (default None)
-            The random walk steps on the Markov transitioin matrix.
+            The random walk steps on the Markov transitioin matrix. The steady state distribution is returned if None.
         backward: `bool` (default False)
             Whether the backward transition will be considered.
+        method: `str` (default `auto`)
+            The method to find the steady state distribution, one of `auto`, `eig` (dense eigendecomposition), `arpack`
+            (the leading left eigenvector with scipy's sparse eigensolver), `gmres` (solve the singular linear system
+            pi (I - M) = 0 with the normalization constraint; falls back to `arpack` with a warning if it does not
+            converge) or `power` (power iterations of the lazy chain, which warn if they do not converge). `auto` uses
+            `eig` for up to 2000 cells and `arpack` otherwise.
+        tol: `float` (default 1e-10)
+            The tolerance of the iterative methods.
+        maxiter: `int` or None (default None)
+            The maximal number of iterations of the iterative methods (the solver defaults if None, 100 * n for `power`).
 
     Returns
     -------
@@ -226,18 +282,13 @@ def diffusion(M, P0=None, steps=None, backward=False):
             The state distribution of the Markov process.
     """
 
+    M = csr_matrix(M, dtype=float)
+    n = M.shape[0]
     if backward is True:
-        M = M.T
-        M = M / M.sum(1)
+        M = _normalize_rows(M.T)
 
     if steps is None:
-        # code inspired from  https://github.com/prob140/prob140/blob/master/prob140/markov_chains.py#L284
-        from scipy.sparse.linalg import eigs
-        eigenvalue, eigenvector = scp.linalg.eig(M, left=True, right=False) # if not issparse(M) else eigs(M) # source is on the row
-
-        eigenvector = np.real(eigenvector) if not issparse(M) else np.real(eigenvector.T)
-        eigenvalue_1_ind = np.isclose(eigenvalue, 1)
-        mu = eigenvector[:, eigenvalue_1_ind] / np.sum(eigenvector[:, eigenvalue_1_ind])
+        mu = _steady_state(M, method, tol, maxiter)
 
         # Zero out floating poing errors that are negative.
         indices = np.logical_and(np.isclose(mu, 0),
@@ -245,20 +296,26 @@ def diffusion(M, P0=None, steps=None, backward=False):
         mu[indices] = 0 # steady state distribution
 
     else:
-        mu = np.nanmean(M.dot(np.linalg.matrix_power(M, steps)), 0) if P0 is None else P0.dot(np.linalg.matrix_power(M, steps))
+        # the average of the rows of M^(steps + 1) is the uniform distribution propagated steps + 1 times
+        mu, steps = (np.full(n, 1 / n), steps + 1) if P0 is None else (np.array(P0, dtype=float), steps)
+        MT = M.T.tocsr()
+        for _ in range(steps):
+            mu = MT.dot(mu.T).T
 
     return mu
 
 
-def expected_return_time(M, backward=False):
+def expected_return_time(M, backward=False, **diffusion_kwargs):
     """Find the expected returning time.
 
     Parameters
     ----------
-        M: `numpy.ndarray` (dimension n x n, where n is the cell number)
+        M: `numpy.ndarray` or `scipy.sparse` matrix (dimension n x n, where n is the cell number)
             The transition matrix.
         backward: `bool` (default False)
             Whether the backward transition will be considered.
+        diffusion_kwargs:
+            Additional parameters (method, tol, maxiter) passed to the diffusion function.
 
     Returns
     -------
@@ -266,79 +323,123 @@ def expected_return_time(M, backward=False):
             The expected return time (1 / steady_state_probability).
 
     """
-    steady_state = diffusion(M, P0=None, steps=None, backward=backward)
+    steady_state = diffusion(M, P0=None, steps=None, backward=backward, **diffusion_kwargs)
 
     T = 1 / steady_state
     return T
 
 
-def _empirical_vec(X_pca, X_embedding, V_mat, indices, neg_cells_trick, xy_grid_nums, neighbors):
-    """utility function for calculating the transition matrix or low dimensional velocity embedding via the original correlation kernel."""
-    n = X_pca.shape[0]
-    if indices is not None:
-        knn = indices.shape[1] - 1 #remove the first one in kNN
-        rows = np.zeros((n * knn, 1))
-        cols = np.zeros((n * knn, 1))
-        vals = np.zeros((n * knn, 1))
-
-    delta_X = np.zeros((n, X_embedding.shape[1]))
-    idx = 0
-    for i in range(n):
-        i_vals = np.zeros((knn, 1))
-        velocity = V_mat[i, :]  # project V_mat to pca space
-        diff_velocity = np.sign(velocity) * np.sqrt(np.abs(velocity))
-
-        for j in np.arange(1, knn + 1):
-            neighbor_ind_j = indices[i, j]
-            diff = X_pca[neighbor_ind_j, :] - X_pca[i, :]
-            diff_rho = np.sign(diff) * np.sqrt(np.abs(diff))
-            pearson_corr = np.corrcoef(diff_rho, diff_velocity)[0, 1]
-
-            rows[idx] = i
-            cols[idx] = neighbor_ind_j
-            i_vals[j - 1] = pearson_corr
-            idx = idx + 1
-
-        if neg_cells_trick:
-            val_ind_vec = np.array(range(i * knn, (i + 1) * knn))
-            for sig in [-1, 1]:
-                cur_ind = np.where(np.sign(i_vals) == sig)[0]
-                if len(cur_ind) == 0:
-                    continue
-
-                cur_i_vals = i_vals[cur_ind]
-                sigma = max(abs(cur_i_vals))
-                exp_i_vals = np.exp(np.abs(cur_i_vals) / sigma)
-                denominator = sum(exp_i_vals)
-                i_prob = exp_i_vals / denominator
-                vals[val_ind_vec[cur_ind]] = sig * i_prob
-
-                j_vec = indices[i, 1:][cur_ind]
-                numerator = sig * np.array([X_embedding[j, :] - X_embedding[i, :] for j in j_vec])
-                denominator = np.array([[scp.linalg.norm(numerator[j]) for j in range(len(j_vec))]]).T
-
-                delta_X[i, :] += 0.5 * (i_prob - 1 / len(cur_ind)).T.dot(
-                    numerator / np.hstack((denominator, denominator))).flatten()
-        else:
-            sigma = max(abs(i_vals))
-            exp_i_vals = np.exp(i_vals / sigma)
-            denominator = sum(exp_i_vals)
-            i_prob = exp_i_vals / denominator
-            vals[i * knn:(i + 1) * knn] = i_prob
+def _analytical_vec(X_pca, X_embedding, V_mat, xy_grid_nums, n_jobs=1, grid=None, **kmc_args):
+    """utility function for calculating the transition matrix and low dimensional velocity embedding via the Itô kernel."""
+    ndims = X_pca.shape[1]
+    kmc = KernelMarkovChain()
+    kmc.fit(X_pca[:, :ndims], V_mat[:, :ndims], n_jobs=n_jobs, **kmc_args)
+    T = kmc.P
+    delta_X = kmc.compute_density_corrected_drift(X_embedding, kmc.Idx, normalize_vector=True) # indices, k = 500
+    X_grid, V_grid, D = velocity_on_grid(X_embedding, delta_X, xy_grid_nums=xy_grid_nums, grid=grid)
+
+    return T, delta_X, X_grid, V_grid, D
 
-            j_vec = indices[i, 1:]
-            numerator = np.array([X_embedding[j, :] - X_embedding[i, :] for j in j_vec])
-            denominator = np.array([[scp.linalg.norm(numerator[j]) for j in range(knn)]]).T
 
-            delta_X[i, :] = (i_prob - 1 / knn).T.dot(numerator / np.hstack((denominator, denominator)))
+def _empirical_vec(X_pca, X_embedding, V_mat, indices, neg_cells_trick, xy_grid_nums, neighbors, use_numba=False,
+                   chunk_size=None, grid=None):
+    """utility function for calculating the transition matrix or low dimensional velocity embedding via the original correlation kernel.
 
-        X_grid, V_grid, D = velocity_on_grid(X_embedding, X_embedding + delta_X, xy_grid_nums=xy_grid_nums)
+    The correlations between the (variance stabilized) displacements to all neighbors and the velocity vector are computed
+    in one batched pass over blocks of the (n_cells x k x n_dims) displacement tensor, or with a compiled kernel when
+    use_numba is True. The grid velocity is computed once from the final embedding velocity.
+    """
+    n = X_pca.shape[0]
+    knn = indices.shape[1] - 1 #remove the first one in kNN
+    nbrs_idx = indices[:, 1:]
+    chunk_size = _get_chunk_size(knn * X_pca.shape[1], chunk_size)
 
-    T = csc_matrix((vals.flatten(), (rows.flatten(), cols.flatten())), shape=neighbors.shape)
+    if use_numba:
+        corr = _neighbor_corrcoef_numba(np.asarray(X_pca, dtype=float), np.asarray(V_mat, dtype=float), nbrs_idx)
+    else:
+        corr = np.zeros((n, knn))
+        for i in range(0, n, chunk_size):
+            corr[i:i + chunk_size] = neighbor_corrcoef(X_pca[nbrs_idx[i:i + chunk_size]] - X_pca[i:i + chunk_size, None, :],
+                                                       V_mat[i:i + chunk_size])
+
+    # unit displacement vectors in the embedding
+    E = X_embedding[nbrs_idx] - X_embedding[:, None, :]
+    E /= np.linalg.norm(E, axis=2)[:, :, None]
+
+    if neg_cells_trick:
+        vals = np.zeros((n, knn))
+        delta_X = np.zeros((n, X_embedding.shape[1]))
+        sign = np.sign(corr)
+        for sig in [-1, 1]:
+            mask = sign == sig
+            n_cur = mask.sum(1)
+            valid = n_cur > 0
+            abs_corr = np.where(mask, np.abs(corr), 0)
+            sigma = abs_corr.max(1)
+            sigma[~valid] = 1
+            exp_vals = np.where(mask, np.exp(abs_corr / sigma[:, None]), 0)
+            i_prob = exp_vals / np.maximum(exp_vals.sum(1), np.finfo(float).tiny)[:, None]
+            vals[mask] = sig * i_prob[mask]
+
+            weights = np.where(mask, i_prob - 1 / np.maximum(n_cur, 1)[:, None], 0)
+            delta_X[valid] += 0.5 * sig * np.einsum('ik,ikd->id', weights[valid], E[valid])
+    else:
+        sigma = np.abs(corr).max(1)
+        exp_vals = np.exp(corr / sigma[:, None])
+        vals = exp_vals / exp_vals.sum(1)[:, None]
+        delta_X = np.einsum('ik,ikd->id', vals - 1 / knn, E)
+
+    X_grid, V_grid, D = velocity_on_grid(X_embedding, X_embedding + delta_X, xy_grid_nums=xy_grid_nums, grid=grid)
+
+    shape = neighbors.shape if neighbors is not None else (n, n)
+    T = csc_matrix((vals.flatten(), (np.repeat(np.arange(n), knn), nbrs_idx.flatten())), shape=shape)
 
     return T, delta_X, X_grid, V_grid, D
 
 
+def neighbor_corrcoef(D, V):
+    """Pearson correlation between the variance stabilized displacements of each cell to its neighbors and its velocity.
+
+    Parameters
+    ----------
+        D: `np.ndarray` (dimension: n_cells x k x n_dims)
+            Displacements from each cell to its k nearest neighbors.
+        V: `np.ndarray` (dimension: n_cells x n_dims)
+            Velocity vectors of the cells.
+
+    Returns
+    -------
+        corr: `np.ndarray` (dimension: n_cells x k)
+            The correlation coefficients, identical to `np.corrcoef(diff_rho, diff_velocity)[0, 1]` for each pair.
+    """
+    D = np.sign(D) * np.sqrt(np.abs(D))
+    V = np.sign(V) * np.sqrt(np.abs(V))
+    D = D - D.mean(2)[:, :, None]
+    V = V - V.mean(1)[:, None]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.einsum('ikd,id->ik', D, V) / np.sqrt(np.sum(D * D, 2) * np.sum(V * V, 1)[:, None])
+    return np.clip(corr, -1, 1)
+
+
+@jit(nopython=True)
+def _neighbor_corrcoef_numba(X, V, nbrs_idx):
+    """Compiled per-cell version of `neighbor_corrcoef` that works on the kNN indices directly."""
+    n, k = nbrs_idx.shape
+    corr = np.zeros((n, k))
+    for i in range(n):
+        v = np.sign(V[i]) * np.sqrt(np.abs(V[i]))
+        v = v - v.mean()
+        v_norm = np.sqrt(np.sum(v * v))
+        for j in range(k):
+            x = X[nbrs_idx[i, j]] - X[i]
+            x = np.sign(x) * np.sqrt(np.abs(x))
+            x = x - x.mean()
+            c = np.sum(x * v) / (np.sqrt(np.sum(x * x)) * v_norm)
+            corr[i, j] = min(max(c, -1.0), 1.0) if not np.isnan(c) else c
+    return corr
+
+
 # utility functions for calculating the random cell velocities
 @jit(nopython=True)
 def numba_random_seed(seed):
@@ -0,0 +1,187 @@
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+
+class NeighborIndex:
+    """A kNN index of a set of cells that is built once and shared by the Markov chains, the grid velocity, PSL and UMAP.
+
+    For large datasets and a small number of neighbors an approximate index is built with NN-descent (pynndescent, a
+    dependency of umap), otherwise an exact index (sklearn's NearestNeighbors) is used. The kNN graph of the indexed
+    cells is cached so that repeated queries are free, and queries for a larger number of neighbors than the index was
+    built with extend the cache instead of rebuilding the index.
+
+    Arguments
+    ---------
+        n_neighbors: `int` (default: `30`)
+            Number of nearest neighbors (including the cell itself) of the kNN graph built with the index.
+        metric: `str` (default: `euclidean`)
+            The distance metric.
+        method: `str` (default: `auto`)
+            The kNN search method, one of `auto`, `pynndescent` (approximate) or `exact`. `auto` uses pynndescent for
+            datasets with at least 4096 cells and at most 64 neighbors (if installed) and the exact search otherwise.
+            Queries of an `auto` index for more than 64 neighbors are answered by an exact index, because querying
+            NN-descent for many neighbors is much slower than the exact search.
+        random_state: `int` (default: `19491001`)
+            The random seed of NN-descent.
+        n_jobs: `int` (default: `1`)
+            Number of threads used to build and query the index. -1 means using all cores.
+    """
+
+    def __init__(self, n_neighbors=30, metric='euclidean', method='auto', random_state=19491001, n_jobs=1):
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.method = method
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.index, self._exact_index = None, None
+        self.indices_, self.distances_ = None, None
+
+    def fit(self, X):
+        """Build the index of the cells X (n_cells x n_dims) and compute their kNN graph."""
+        from .utils import _get_n_jobs
+
+        self.X = np.ascontiguousarray(X)
+        self.checksum_ = _checksum(self.X)
+        n_obs = self.X.shape[0]
+        self.n_neighbors = min(self.n_neighbors, n_obs)
+
+        method = self.method
+        if method == 'auto':
+            method = 'exact'
+            if n_obs >= 4096 and self.n_neighbors <= 64:
+                try:
+                    import pynndescent
+                    method = 'pynndescent'
+                except ImportError:
+                    pass
+        self.method_ = method
+
+        if method == 'pynndescent':
+            from pynndescent import NNDescent
+
+            self.index = NNDescent(self.X, metric=self.metric, n_neighbors=self.n_neighbors,
+                                   random_state=self.random_state, n_jobs=_get_n_jobs(self.n_jobs), low_memory=True)
+            self.indices_, self.distances_ = self.index.neighbor_graph
+        elif method == 'exact':
+            self.index = NearestNeighbors(n_neighbors=self.n_neighbors, metric=self.metric,
+                                          n_jobs=_get_n_jobs(self.n_jobs)).fit(self.X)
+            self.distances_, self.indices_ = self.index.kneighbors(self.X)
+        else:
+            raise Exception('method {} is not supported.'.format(self.method))
+
+        return self
+
+    def _query(self, X, k):
+        from .utils import _get_n_jobs
+
+        if self.method_ == 'pynndescent' and self.method == 'auto' and k > 64:
+            if self._exact_index is None:
+                self._exact_index = NearestNeighbors(metric=self.metric, n_jobs=_get_n_jobs(self.n_jobs)).fit(self.X)
+            distances, indices = self._exact_index.kneighbors(X, n_neighbors=k)
+        elif self.method_ == 'pynndescent':
+            indices, distances = self.index.query(X, k=k)
+        else:
+            distances, indices = self.index.kneighbors(X, n_neighbors=k)
+
+        return distances, indices
+
+    def kneighbors(self, X=None, n_neighbors=None, return_distance=True):
+        """Find the nearest neighbors of X, with the same return values as sklearn's NearestNeighbors.kneighbors.
+
+        Arguments
+        ---------
+            X: `np.ndarray` or None (default: `None`)
+                The query points. If None or the indexed cells, the cached kNN graph of the indexed cells (each cell
+                is its own first neighbor) is returned and extended if more neighbors are requested.
+            n_neighbors: `int` or None (default: `None`)
+                Number of nearest neighbors. The n_neighbors of the index is used if None.
+            return_distance: `bool` (default: `True`)
+                Whether to also return the distances.
+
+        Returns
+        -------
+            distances, indices: `np.ndarray`
+                The distances and indices (n_queries x n_neighbors) of the nearest neighbors, sorted by distance.
+        """
+        k = self.n_neighbors if n_neighbors is None else min(n_neighbors, self.X.shape[0])
+
+        if X is None or X is self.X or (X.shape == self.X.shape and np.array_equal(X, self.X)):
+            if k > self.indices_.shape[1]:
+                self.distances_, self.indices_ = self._query(self.X, k)
+            distances, indices = self.distances_[:, :k], self.indices_[:, :k]
+        else:
+            distances, indices = self._query(np.ascontiguousarray(X, dtype=self.X.dtype), k)
+
+        return (distances, indices) if return_distance else indices
+
+    def kneighbors_graph(self, n_neighbors=None):
+        """The kNN graph of the indexed cells as a sparse (n_cells x n_cells) distance matrix, without self edges."""
+        from scipy.sparse import csr_matrix
+
+        distances, indices = self.kneighbors(n_neighbors=n_neighbors)
+        n_obs, k = indices.shape
+        graph = csr_matrix((distances[:, 1:].ravel(), indices[:, 1:].ravel(), np.arange(0, n_obs * (k - 1) + 1, k - 1)),
+                           shape=(n_obs, n_obs))
+
+        return graph
+
+
+def _checksum(X):
+    """A cheap fingerprint of the data used to check whether a cached index is still valid."""
+    return (X.shape, float(np.sum(X, dtype=np.float64)))
+
+
+def _get_nbrs(X, k, nbrs=None, **nbrs_kwargs):
+    """Return nbrs if it is a fitted index of X (or any object with a sklearn-like kneighbors method), otherwise build a
+    NeighborIndex of X with k neighbors."""
+    if nbrs is None:
+        nbrs = NeighborIndex(n_neighbors=k, **nbrs_kwargs).fit(X)
+
+    return nbrs
+
+
+def neighbor_index(adata, basis='pca', n_neighbors=30, metric='euclidean', dims=None, method='auto', n_jobs=1,
+                   recompute=False):
+    """Get the kNN index of the cells on a basis, building it once and caching it in adata for all downstream steps.
+
+    Arguments
+    ---------
+        adata: :class:`~anndata.AnnData`
+            an Annodata object.
+        basis: `str` (default: `pca`)
+            The reduced dimension in the obsm attribute (`X_` + basis) used to find the neighbors.
+        n_neighbors: `int` (default: `30`)
+            Number of neighbors of the kNN graph when a new index is built. Queries for more neighbors are answered by
+            an existing index as well.
+        metric: `str` (default: `euclidean`)
+            The distance metric.
+        dims: `int` or None (default: `None`)
+            Number of leading dimensions of the basis that are used. All dimensions are used if None.
+        method: `str` (default: `auto`)
+            The kNN search method, one of `auto`, `pynndescent` or `exact`, see :class:`NeighborIndex`. A cached index
+            that was built with another method is only reused for `auto`.
+        n_jobs: `int` (default: `1`)
+            Number of threads used to build and query the index. -1 means using all cores.
+        recompute: `bool` (default: `False`)
+            Whether to rebuild the index even if a valid one exists.
+
+    Returns
+    -------
+        nbrs: :class:`NeighborIndex`
+            The kNN index, which is cached with adata for the current session (keyed by basis, number of dimensions
+            and metric, see `_get_adata_cache`) and rebuilt automatically when the basis changes.
+    """
+    from .utils import _get_adata_cache
+
+    X = adata.obsm['X_' + basis]
+    X = X if dims is None else X[:, :dims]
+    key = '{}_{}_{}'.format(basis, X.shape[1], metric)
+
+    cache = _get_adata_cache(adata, 'neighbor_index')
+    nbrs = cache.get(key, None)
+
+    if recompute or nbrs is None or nbrs.checksum_ != _checksum(X) or method not in ['auto', nbrs.method_]:
+        nbrs = NeighborIndex(n_neighbors=n_neighbors, metric=metric, method=method, n_jobs=n_jobs).fit(X)
+        cache[key] = nbrs
+
+    return nbrs
@@ -1,13 +1,20 @@
-from sklearn.decomposition import TruncatedSVD
 import scipy
+import scipy.linalg
+from scipy.sparse import issparse
+from sklearn.utils import check_random_state
 import warnings
 from copy import deepcopy
 from .psl import *
+from .connectivity import _get_nbrs, neighbor_index
 
 
 def extract_indices_dist_from_graph(graph, n_neighbors):
     """Extract the matrices for index, distance from the associated kNN sparse graph
 
+    The graph is processed as a whole on its CSR arrays: the entries of all cells are sorted by (cell, distance) at once.
+    The first neighbor of each cell is itself. Cells with more (or fewer) than n_neighbors - 1 nonzero entries, which
+    occur due to the approximate search, keep their n_neighbors - 1 nearest ones (or are padded with themselves).
+
     Arguments
     ---------
         graph: sparse matrix (`.X`, dtype `float32`)
@@ -23,26 +30,29 @@ def extract_indices_dist_from_graph(graph, n_neighbors):
             The matrix (n_cell x n_neighbors) that stores the distances for the each cell's n_neighbors nearest neighbors.
     """
 
-    n_cells = graph.shape[0]
-    ind_mat = np.zeros((n_cells, n_neighbors), dtype=int)
+    graph = scipy.sparse.csr_matrix(graph, copy=True)
+    graph.eliminate_zeros()  # only the nonzero entries are neighbors
+    graph.sort_indices()
+    n_cells, n_nbrs = graph.shape[0], n_neighbors - 1
+    indptr, indices, data = graph.indptr, graph.indices, graph.data
+    row_nnz = np.diff(indptr)
+    rows = np.repeat(np.arange(n_cells), row_nnz)
+    rank = np.arange(len(indices)) - indptr[rows]  # position of each entry in its row
+
+    # rows with exactly n_neighbors - 1 entries keep their column order, the other rows are sorted by distance (with
+    # ties in column order) and truncated to their n_neighbors - 1 nearest neighbors
+    order = np.arange(len(indices))
+    to_sort = (row_nnz != n_nbrs)[rows]
+    if to_sort.any():
+        sub = np.where(to_sort)[0]
+        order[sub] = sub[np.lexsort((data[sub], rows[sub]))]
+
+    keep = rank < n_nbrs
+    # set itself as the nearest neighbor (cells with fewer neighbors are padded with themselves)
+    ind_mat = np.repeat(np.arange(n_cells)[:, None], n_neighbors, axis=1)
     dist_mat = np.zeros((n_cells, n_neighbors), dtype=graph.dtype)
-
-    for cur_cell in range(n_cells):
-        cur_neighbors = graph[cur_cell, :].nonzero()  # returns the coordinate tuple for non-zero items
-
-        # set itself as the nearest neighbor
-        ind_mat[cur_cell, 0] = cur_cell
-        dist_mat[cur_cell, 0] = 0
-
-        # there could be more or less than n_neighbors because of an approximate search
-        cur_n_neighbors = len(cur_neighbors[1])
-        if cur_n_neighbors != n_neighbors - 1:  # could not broadcast input array from shape (13) into shape (14)
-            sorted_indices = np.argsort(graph[cur_cell][:, cur_neighbors[1]].A)[0][:(n_neighbors - 1)]
-            ind_mat[cur_cell, 1:] = cur_neighbors[1][sorted_indices]
-            dist_mat[cur_cell, 1:] = graph[cur_cell][0, cur_neighbors[1][sorted_indices]].A
-        else:
-            ind_mat[cur_cell, 1:] = cur_neighbors[1]
-            dist_mat[cur_cell, 1:] = graph[cur_cell][:, cur_neighbors[1]].A
+    ind_mat[rows[keep], rank[keep] + 1] = indices[order[keep]]
+    dist_mat[rows[keep], rank[keep] + 1] = data[order[keep]]
 
     return ind_mat, dist_mat
 
@@ -53,7 +63,8 @@ def umap_conn_indices_dist_embedding(X,
         metric="cosine",
         min_dist=0.1,
         random_state=0,
-        verbose=False):
+        verbose=False,
+        nbrs=None):
     """Compute connectivity graph, matrices for kNN neighbor indices, distance matrix and low dimension embedding with UMAP.
     This code is adapted from umap-learn (https://github.com/lmcinnes/umap/blob/97d33f57459de796774ab2d7fcf73c639835676d/umap/umap_.py)
 
@@ -77,6 +88,9 @@ def umap_conn_indices_dist_embedding(X,
             the random number generator; If None, the random number generator is the RandomState instance used by `numpy.random`.
         verbose: `bool` (optional, default False)
             Controls verbosity of logging.
+        nbrs: :class:`~dynamo.tools.connectivity.NeighborIndex` or None (optional, default None)
+            A prebuilt kNN index of X with the same metric (see `neighbor_index`). If None, the kNN graph is computed from
+            the pairwise distance matrix for fewer than 4096 cells or with a new NN-descent index otherwise.
 
     Returns
     -------
@@ -87,13 +101,13 @@ def umap_conn_indices_dist_embedding(X,
 
     from sklearn.utils import check_random_state
     from sklearn.metrics import pairwise_distances
-    from umap.umap_ import nearest_neighbors, fuzzy_simplicial_set, simplicial_set_embedding, find_ab_params
+    from umap.umap_ import fuzzy_simplicial_set, simplicial_set_embedding, find_ab_params
 
     random_state = check_random_state(42)
 
     _raw_data = X
 
-    if X.shape[0] < 4096: #1
+    if nbrs is None and X.shape[0] < 4096: #1
         dmat = pairwise_distances(X, metric=metric)
         graph = fuzzy_simplicial_set(
             X=dmat,
@@ -108,15 +122,8 @@ def umap_conn_indices_dist_embedding(X,
         knn_indices, knn_dists = extract_indices_dist_from_graph(g_tmp, n_neighbors=n_neighbors)
     else:
         # Standard case
-        (knn_indices, knn_dists, rp_forest) = nearest_neighbors(
-            X=X,
-            n_neighbors=n_neighbors,
-            metric=metric,
-            metric_kwds={},
-            angular=False,
-            random_state=random_state,
-            verbose=verbose
-        )
+        nbrs = _get_nbrs(X, n_neighbors, nbrs, metric=metric)
+        knn_dists, knn_indices = nbrs.kneighbors(X, n_neighbors=n_neighbors)
 
         graph = fuzzy_simplicial_set(
             X=X,
@@ -125,17 +132,17 @@ def umap_conn_indices_dist_embedding(X,
             metric=metric,
             knn_indices=knn_indices,
             knn_dists=knn_dists,
-            angular=rp_forest,
+            angular=False,
             verbose=verbose
         )
 
         _raw_data = X
         _transform_available = True
-        _search_graph = scipy.sparse.lil_matrix(
-            (X.shape[0], X.shape[0]), dtype=np.int8
+        n_obs, n_nbrs = knn_indices.shape
+        _search_graph = scipy.sparse.csr_matrix(
+            ((knn_dists != 0).astype(np.int8).ravel(), knn_indices.ravel(), np.arange(0, n_obs * n_nbrs + 1, n_nbrs)),
+            shape=(n_obs, n_obs)
         )
-        _search_graph.rows = knn_indices # An array (self.rows) of rows, each of which is a sorted list of column indices of non-zero elements.
-        _search_graph.data = (knn_dists != 0).astype(np.int8) # The corresponding nonzero values are stored in similar fashion in self.data.
         _search_graph = _search_graph.maximum( # Element-wise maximum between this and another matrix.
             _search_graph.transpose()
         ).tocsr()
@@ -165,6 +172,215 @@ def umap_conn_indices_dist_embedding(X,
     return graph, knn_indices, knn_dists, embedding_
 
 
+def _lu_normalize(Q):
+    """Normalize the range sampled in a power iteration with a (permuted) LU decomposition, as used by sklearn."""
+    Q, _ = scipy.linalg.lu(Q, permute_l=True)
+    return Q
+
+
+class PCA:
+    """Principal component analysis that is fitted once and stores the loadings so that the expression matrix, the
+    future states (X + V) or the velocity can later be projected with a single matrix product.
+
+    The fitting is based on either a randomized SVD (Halko, et al., 2009, as in sklearn's TruncatedSVD) or a single
+    streaming pass over blocks of cells which accumulates the (n_features x n_features) gram matrix, suitable for backed
+    data with a moderate number of features. Centering is optional and for sparse data it is applied implicitly so that
+    the data matrix is never densified. Without centering, the fit is identical to sklearn's TruncatedSVD with the same
+    random_state.
+
+    Arguments
+    ---------
+        n_components: `int` (default: `50`)
+            Number of principal components.
+        center: `bool` (default: `False`)
+            Whether to center the features (standard PCA) or not (unscaled PCA / truncated SVD).
+        method: `str` (default: `randomized`)
+            The fitting method, either `randomized` (randomized SVD) or `streaming` (a single pass over blocks of cells).
+        n_iter: `int` (default: `5`)
+            Number of power iterations of the randomized SVD.
+        n_oversamples: `int` (default: `10`)
+            Number of additional random vectors used to sample the range of the data in the randomized SVD.
+        chunk_size: `int` or None (default: `None`)
+            Number of cells per block in the streaming fit or transform. By default a dense block has at most 2^23
+            elements.
+        dtype: `numpy.dtype` or None (default: `None`)
+            The floating point precision of the fit (np.float32 or np.float64). By default the precision of the data is
+            used if it is a floating point array, otherwise np.float64.
+        random_state: `int` (default: `0`)
+            Seed of the random vectors used by the randomized SVD.
+
+    Attributes
+    ----------
+        components_: :class:`~numpy.ndarray`
+            The loadings (n_components x n_features).
+        mean_: :class:`~numpy.ndarray`
+            The feature means that are subtracted before the projection (zeros if center is False).
+        explained_variance_, explained_variance_ratio_, singular_values_: :class:`~numpy.ndarray`
+            The variance of the projected data, its ratio to the total variance and the singular values of each
+            component.
+    """
+
+    def __init__(self, n_components=50, center=False, method='randomized', n_iter=5, n_oversamples=10,
+                 chunk_size=None, dtype=None, random_state=0):
+        self.n_components = n_components
+        self.center = center
+        self.method = method
+        self.n_iter = n_iter
+        self.n_oversamples = n_oversamples
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.random_state = random_state
+
+    def _prepare(self, X):
+        """Cast an in-memory matrix to the precision of the fit (the indices of a sparse matrix are not copied)."""
+        if issparse(X):
+            X = X.tocsr() if X.format not in ['csr', 'csc'] else X
+            if X.dtype != self.dtype_:
+                X = X.astype(self.dtype_)
+        else:
+            X = np.asarray(X, dtype=self.dtype_)
+
+        return X
+
+    def _iter_chunks(self, X, chunk_size=None):
+        n_obs, n_features = X.shape
+        if chunk_size is None:
+            chunk_size = self.chunk_size if self.chunk_size is not None else max(1, 2**23 // max(n_features, 1))
+        for start in range(0, n_obs, chunk_size):
+            yield self._prepare(X[start:min(start + chunk_size, n_obs)])
+
+    def fit(self, X):
+        """Fit the principal components of X (n_obs x n_features), which can be dense, sparse or a backed dataset."""
+        self.fit_transform(X)
+
+        return self
+
+    def fit_transform(self, X):
+        """Fit the principal components of X and return the projection of X (n_obs x n_components)."""
+        if self.dtype is None:
+            self.dtype_ = X.dtype if X.dtype in [np.float32, np.float64] else np.float64
+        else:
+            self.dtype_ = np.dtype(self.dtype)
+
+        if self.method == 'randomized':
+            X = self._prepare(X)
+            self._fit_randomized(X)
+            X_transformed = self.transform(X)
+            self.explained_variance_ = np.var(X_transformed, axis=0)
+            if issparse(X):
+                mean = np.asarray(X.mean(0)).flatten()
+                full_var = np.asarray(X.multiply(X).mean(0)).flatten() - mean ** 2
+            else:
+                full_var = np.var(X, axis=0)
+            self.explained_variance_ratio_ = self.explained_variance_ / full_var.sum()
+        elif self.method == 'streaming':
+            self._fit_streaming(X)
+            X_transformed = self.transform(X)
+        else:
+            raise Exception('method {} is not supported.'.format(self.method))
+
+        return X_transformed
+
+    def _fit_randomized(self, X):
+        n_obs, n_features = X.shape
+        if self.n_components > min(n_obs, n_features):
+            raise ValueError('n_components ({}) must be <= min(n_obs, n_features) ({}).'.format(
+                self.n_components, min(n_obs, n_features)))
+
+        self.mean_ = np.asarray(X.mean(0), dtype=self.dtype_).flatten() if self.center else \
+            np.zeros(n_features, dtype=self.dtype_)
+        mean = self.mean_ if self.center else None
+
+        # products with the (implicitly) centered matrix A = X - 1 * mean and its transpose
+        def matmat(Q):
+            R = np.asarray(X @ Q)
+            return R if mean is None else R - mean @ Q
+
+        def rmatmat(Q):
+            R = np.asarray(X.T @ Q)
+            return R if mean is None else R - np.outer(mean, Q.sum(0))
+
+        transpose = n_obs < n_features
+        if transpose:
+            matmat, rmatmat = rmatmat, matmat
+        n_cols = n_obs if transpose else n_features
+
+        Q = check_random_state(self.random_state).normal(size=(n_cols, self.n_components + self.n_oversamples))
+        Q = Q.astype(self.dtype_, copy=False)
+        for _ in range(self.n_iter):
+            Q = matmat(Q)
+            if self.n_iter > 2: Q = _lu_normalize(Q)
+            Q = rmatmat(Q)
+            if self.n_iter > 2: Q = _lu_normalize(Q)
+        Q, _ = scipy.linalg.qr(matmat(Q), mode='economic')
+
+        Uhat, s, Vt = scipy.linalg.svd(rmatmat(Q).T, full_matrices=False)
+        U = Q @ Uhat
+
+        # deterministic signs: the largest loading (or score for transposed data) of each component is positive
+        from sklearn.utils.extmath import svd_flip
+        U, Vt = svd_flip(U, Vt, u_based_decision=not transpose)
+        if transpose:
+            U, Vt = Vt.T, U.T
+
+        self.components_ = Vt[:self.n_components]
+        self.singular_values_ = s[:self.n_components]
+
+    def _fit_streaming(self, X):
+        n_obs, n_features = X.shape
+        if self.n_components > min(n_obs, n_features):
+            raise ValueError('n_components ({}) must be <= min(n_obs, n_features) ({}).'.format(
+                self.n_components, min(n_obs, n_features)))
+
+        gram, col_sum = np.zeros((n_features, n_features)), np.zeros(n_features)
+        for block in self._iter_chunks(X):
+            gram += (block.T @ block).toarray() if issparse(block) else block.T @ block
+            col_sum += np.asarray(block.sum(0)).flatten()
+
+        mean = col_sum / n_obs
+        cov = gram / n_obs - np.outer(mean, mean)
+        eigvals, eigvecs = scipy.linalg.eigh(cov if self.center else gram / n_obs)
+        order = np.argsort(eigvals)[::-1][:self.n_components]
+        eigvals, components = np.clip(eigvals[order], 0, None), eigvecs[:, order].T
+
+        # deterministic signs: the largest loading of each component is positive
+        max_abs = np.argmax(np.abs(components), axis=1)
+        components *= np.sign(components[np.arange(components.shape[0]), max_abs])[:, None]
+
+        self.components_ = components.astype(self.dtype_)
+        self.mean_ = (mean if self.center else np.zeros(n_features)).astype(self.dtype_)
+        self.singular_values_ = np.sqrt(eigvals * n_obs)
+        self.explained_variance_ = np.einsum('ij,jk,ik->i', components, cov, components)
+        self.explained_variance_ratio_ = self.explained_variance_ / np.trace(cov)
+
+    def transform(self, X, chunk_size=None):
+        """Project X (or the future states X + V) on the principal components. A backed dataset or X with chunk_size
+        specified is projected block by block."""
+        if chunk_size is None and (issparse(X) or isinstance(X, np.ndarray)):
+            X_transformed = np.asarray(self._prepare(X) @ self.components_.T)
+        else:
+            X_transformed = np.vstack([np.asarray(block @ self.components_.T)
+                                       for block in self._iter_chunks(X, chunk_size)])
+
+        if self.center:
+            X_transformed -= self.mean_ @ self.components_.T
+
+        return X_transformed
+
+    def transform_velocity(self, V):
+        """Project the velocity V on the principal components. As the projection is linear, the mean is not subtracted
+        and the result equals transform(X + V) - transform(X)."""
+        return np.asarray(self._prepare(V) @ self.components_.T)
+
+
+def _gene_loadings(gene_bool, components):
+    """The loadings of all genes (n_genes x n_components) with zeros for the genes that are not used in the fit."""
+    PCs = np.zeros((len(gene_bool), components.shape[0]), dtype=components.dtype)
+    PCs[gene_bool] = components.T
+
+    return PCs
+
+
 def reduceDimension(adata, n_pca_components=25, n_components=2, n_neighbors=10, reduction_method='trimap', velocity_key='velocity_S', cores=1):
     """Compute a low dimension reduction projection of an annodata object first with PCA, followed by non-linear dimension reduction methods
 
@@ -189,34 +405,33 @@ def reduceDimension(adata, n_pca_components=25, n_components=2, n_neighbors=10,
     Returns
     -------
     Returns an updated `adata` with reduced dimension data for spliced counts, projected future transcript counts 'Y_dim' and adjacency matrix when possible.
+    The PCA is fitted once and reused: if the `PCs` loadings in varm (or `pca_fit`) exist, the velocity is projected on
+    the stored loadings to obtain `_velocity_pca`.
     """
 
-    n_obs = adata.shape[0]
+    gene_bool = adata.var.use_for_dynamo.values if 'use_for_dynamo' in adata.var.keys() else np.ones(adata.n_vars, bool)
+    X = adata.X[:, gene_bool]
 
-    if 'use_for_dynamo' in adata.var.keys():
-        X = adata.X[:, adata.var.use_for_dynamo.values]
-        if velocity_key is not None:
-            X_t = adata.X[:, adata.var.use_for_dynamo.values] + adata.layers[velocity_key][:, adata.var.use_for_dynamo.values]
-    else:
-        X = adata.X
-        if velocity_key is not None:
-            X_t = adata.X + adata.layers[velocity_key]
-
-    if((not 'X_pca' in adata.obsm.keys()) or 'pca_fit' not in adata.uns.keys()) or reduction_method is "pca":
-        transformer = TruncatedSVD(n_components=n_pca_components + 1, random_state=0)
-        X_fit = transformer.fit(X)
-        X_pca = X_fit.transform(X)[:, 1:]
-        adata.obsm['X_pca'] = X_pca
-        if velocity_key is not None and "_velocity_pca" not in adata.obsm.keys():
-            X_t_pca = X_fit.transform(X_t)[:, 1:]
-            adata.obsm['_velocity_pca'] = X_t_pca - X_pca
+    if ('X_pca' not in adata.obsm.keys()) or ('pca_fit' not in adata.uns.keys() and 'PCs' not in adata.varm.keys()) \
+            or reduction_method == "pca":
+        fit = PCA(n_components=n_pca_components + 1, random_state=0)
+        X_pca = fit.fit_transform(X)[:, 1:]
+        adata.obsm['X_pca'], adata.uns['pca_fit'] = X_pca, fit
+        adata.varm['PCs'] = _gene_loadings(gene_bool, fit.components_[1:])
+        PCs = fit.components_[1:].T
     else:
         X_pca = adata.obsm['X_pca'][:, :n_pca_components]
-        if velocity_key is not None and "_velocity_pca" not in adata.obsm.keys():
-            X_t_pca = adata.uns['pca_fit'].fit_transform(X_t)
-            adata.obsm['_velocity_pca'] = X_t_pca[:, 1:(n_pca_components + 1)] - X_pca
+        # loadings of the stored fit (the first component is related to the library size and is not used). The loadings
+        # in varm are preferred because they are indexed by gene, while pca_fit may be fitted on a subset of gene_bool
+        PCs = adata.varm['PCs'][gene_bool, :n_pca_components] if 'PCs' in adata.varm.keys() else \
+            adata.uns['pca_fit'].components_[1:(n_pca_components + 1)].T
         adata.obsm['X_pca'] = X_pca
 
+    # the projection is linear, so the velocity in PCA space equals PCA(X + V) - PCA(X), computed without refitting
+    if velocity_key is not None and "_velocity_pca" not in adata.obsm.keys():
+        V = adata.layers[velocity_key][:, gene_bool]
+        adata.obsm['_velocity_pca'] = np.asarray(V @ PCs.astype(V.dtype if V.dtype == np.float32 else np.float64))
+
     if reduction_method is "trimap":
         import trimap
         triplemap = trimap.TRIMAP(n_inliers=20,
@@ -246,12 +461,14 @@ def reduceDimension(adata, n_pca_components=25, n_components=2, n_neighbors=10,
     elif reduction_method is 'umap':
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            graph, knn_indices, knn_dists, X_dim = umap_conn_indices_dist_embedding(X_pca) # X_pca
+            nbrs = neighbor_index(adata, basis='pca', metric='cosine', dims=X_pca.shape[1])
+            graph, knn_indices, knn_dists, X_dim = umap_conn_indices_dist_embedding(X_pca, nbrs=nbrs) # X_pca
         adata.obsm['X_umap'] = X_dim
         adata.uns['neighbors'] = {'params': {'n_neighbors': n_neighbors, 'method': reduction_method}, 'connectivities': graph, \
                                   'distances': knn_dists, 'indices': knn_indices}
     elif reduction_method is 'psl':
-        adj_mat, X_dim = psl_py(X_pca, d=n_components, K=n_neighbors) # this need to be updated
+        nbrs = neighbor_index(adata, basis='pca', dims=X_pca.shape[1])
+        adj_mat, X_dim = psl_py(X_pca, d=n_components, K=n_neighbors, nbrs=nbrs) # this need to be updated
         adata.obsm['X_psl'] = X_dim
         adata.uns['PSL_adj_mat'] = adj_mat
 
@@ -8,7 +8,7 @@ from .utils import get_U_S_for_velocity_estimation
 # incorporate the model selection code soon
 def dynamics(adata, filter_gene_mode='final', mode='deterministic', tkey='Time', protein_names=None,
              experiment_type=None, assumption_mRNA=None, assumption_protein='ss', NTR_vel = True, concat_data=False,
-             log_unnormalized=True):
+             log_unnormalized=True, n_jobs=1):
     """Inclusive model of expression dynamics considers splicing, metabolic labeling and protein translation. It supports
     learning high-dimensional velocity vector samples for droplet based (10x, inDrop, drop-seq, etc), scSLAM-seq, NASC-seq
     sci-fate, scNT-seq or cite-seq datasets.
@@ -46,6 +46,9 @@ def dynamics(adata, filter_gene_mode='final', mode='deterministic', tkey='Time',
             Whether to concatenate data before estimation. If your data is a list of matrices for each time point, this need to be set as True.
         log_unnormalized: `bool` (default: `True`)
             Whether to log transform the unnormalized data.
+        n_jobs: `int` (default: 1)
+            The number of processes used to estimate the parameters of different genes in parallel (steady state
+            regressions or the per gene fitting of the `moment` mode).
 
     Returns
     -------
@@ -180,7 +183,7 @@ def dynamics(adata, filter_gene_mode='final', mode='deterministic', tkey='Time',
                          experiment_type=experiment_type,
                          assumption_mRNA=assumption_mRNA, assumption_protein=assumption_protein,
                          concat_data=concat_data)
-        est.fit()
+        est.fit(n_jobs=n_jobs)
 
         alpha, beta, gamma, eta, delta = est.parameters.values()
 
@@ -290,7 +293,7 @@ def dynamics(adata, filter_gene_mode='final', mode='deterministic', tkey='Time',
             Moment = MomData(subset_adata, tkey)
             adata.uns['M'], adata.uns['V'] = Moment.M, Moment.V
             Est = Estimation(Moment, time_key=tkey, normalize=True) #  # data is already normalized
-        params, costs = Est.fit()
+        params, costs = Est.fit(n_jobs=n_jobs)
         a, b, alpha_a, alpha_i, beta, gamma = params[:, 0], params[:, 1], params[:, 2], params[:, 3], params[:,
                                                                                                       4], params[:, 5]
         def fbar(x_a, x_i, a, b):
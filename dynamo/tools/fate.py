@@ -1,7 +1,7 @@
 from .scVectorField import VectorField
 import numpy as np
 from scipy.integrate import odeint
-from .scVectorField import vector_field_function
+from .scVectorField import vector_field_function, con_K_dot
 from scipy.sparse import issparse
 
 
@@ -58,7 +58,8 @@ def Fate(adata, VecFld_true=None, basis='X', query_cell_str="steady_states=='roo
         adata.uns["Fate_true"] = {'t': t, 'prediction': prediction}
 
 
-def fate(VecFld, init_state, VecFld_true = None, t_end=1, step_size=None, direction='both', average=False):
+def fate(VecFld, init_state, VecFld_true = None, t_end=1, step_size=None, direction='both', average=False, method='odeint',
+         rtol=1e-6, atol=1e-8):
     """Predict the historical and future cell transcriptomic states over arbitrary time scales by integrating vector field
     functions from one or a set of initial cell state(s).
 
@@ -82,6 +83,15 @@ def fate(VecFld, init_state, VecFld_true = None, t_end=1, step_size=None, direct
         average: `bool` (default: False)
             A boolean flag to determine whether to smooth the trajectory by calculating the average cell state at each time
             step.
+        method: `string` (default: odeint)
+            The numerical integrator. `odeint` integrates each cell (and each direction) separately with scipy's odeint.
+            `rk4` (fixed step Runge-Kutta, one step per time point) and `rk45` (adaptive Dormand-Prince with per-trajectory
+            error control) advance all initial states, forward and backward, together as one (n_cells x n_features)
+            system so that the vector field is evaluated for all cells at once. This is much faster for many cells.
+        rtol: `float` (default 1e-6)
+            Relative tolerance of the local error of each trajectory, only used by `rk45`.
+        atol: `float` (default 1e-8)
+            Absolute tolerance of the local error of each trajectory, only used by `rk45`.
 
     Returns
     -------
@@ -95,36 +105,59 @@ def fate(VecFld, init_state, VecFld_true = None, t_end=1, step_size=None, direct
         at each time point is calculated for all cells.
     """
 
-    V_func = lambda x, t: vector_field_function(x=x, t=t, VecFld=VecFld) if VecFld_true is None else VecFld_true
+    V_func = (lambda x, t: vector_field_function(x=x, t=t, VecFld=VecFld)) if VecFld_true is None else VecFld_true
 
     if step_size is None:
         t1=np.linspace(0, t_end, 250)
     else:
         t1 = np.arange(0, t_end + step_size, step_size)
     n_cell, n_feature, n_steps = init_state.shape[0], init_state.shape[1], len(t1)
+    t0 = - t1 #[::-1] # reverse and negate the time-points
 
-    if direction is 'both':
-        t0 = - t1 #[::-1] # reverse and negate the time-points
+    if direction not in ['both', 'forward', 'backward']:
+        raise Exception('both, forward, backward are the only valid direction argument string')
+
+    if method == 'odeint':
+        history, future = None, None
+        if direction in ['both', 'backward']:
+            history = np.zeros((n_cell * n_steps, n_feature))
+            for i in range(n_cell):
+                history[(n_steps * i):(n_steps * (i + 1)), :] = odeint(V_func, init_state[i, :], t=t0)
+        if direction in ['both', 'forward']:
+            future = np.zeros((n_cell * n_steps, n_feature))
+            for i in range(n_cell):
+                future[(n_steps * i):(n_steps * (i + 1)), :] = odeint(V_func, init_state[i, :], t=t1)
+    elif method in ['rk4', 'rk45']:
+        if VecFld_true is None:
+            V_batch = lambda X: con_K_dot(X, VecFld['X'], VecFld['beta'], VecFld['C'])
+        else:
+            V_batch = lambda X: np.array([VecFld_true(x, 0) for x in X]).reshape(X.shape)
+
+        # backward trajectories are integrated as the forward trajectories of the negated vector field so that both
+        # directions are advanced together in one batch
+        signs = np.hstack([[-1] * n_cell if direction in ['both', 'backward'] else [],
+                           [1] * n_cell if direction in ['both', 'forward'] else []])[:, None]
+        X0 = np.tile(init_state, (len(signs) // n_cell, 1))
+        f = lambda X, idx=slice(None): signs[idx] * V_batch(X)
+
+        if method == 'rk4':
+            res = integrate_rk4(f, X0, t1)
+        else:
+            res = integrate_rk45(f, X0, t1, rtol=rtol, atol=atol)
+        # (n_steps, n_trajectories, n_features) -> rows ordered by trajectory then time
+        res = res.transpose((1, 0, 2)).reshape((-1, n_feature))
+
+        history = res[:(n_cell * n_steps)] if direction in ['both', 'backward'] else None
+        future = res[-(n_cell * n_steps):] if direction in ['both', 'forward'] else None
+    else:
+        raise Exception('odeint, rk4, rk45 are the only valid method argument string')
 
-        history, future = np.zeros((n_cell * n_steps, n_feature)), np.zeros((n_cell * n_steps, n_feature))
-        for i in range(n_cell):
-            history[(n_steps * i):(n_steps * (i + 1)), :] = odeint(V_func, init_state[i, :], t=t0)
-            future[(n_steps * i):(n_steps * (i + 1)), :] = odeint(V_func, init_state[i, :], t=t1)
+    if direction == 'both':
         t, prediction = np.hstack((t0, t1)), np.vstack((history, future))
-    elif direction is 'forward':
-        prediction = np.zeros((n_cell * n_steps, n_feature))
-
-        for i in range(n_cell):
-            prediction[(n_steps * i):(n_steps * (i + 1)), :] = odeint(V_func, init_state[i, :], t=t1)
-        t=t1
-    elif direction is "backward":
-        t0 = - t1 #[::-1] # reverse and negate the time-points
-        prediction = np.zeros((n_cell * n_steps, n_feature))
-        for i in range(n_cell):
-            prediction[(n_steps * i):(n_steps * (i + 1)), :] = odeint(V_func, init_state[i, :], t=t0)
-        t=t0
+    elif direction == 'forward':
+        t, prediction = t1, future
     else:
-        raise Exception('both, forward, backward are the only valid direction argument string')
+        t, prediction = t0, history
 
     if average:
         avg = np.zeros((len(t), init_state.shape[1]))
@@ -135,6 +168,124 @@ def fate(VecFld, init_state, VecFld_true = None, t_end=1, step_size=None, direct
 
     return t, prediction
 
+
+def integrate_rk4(f, X0, t):
+    """Integrate a batch of initial states with the classical fixed step Runge-Kutta method, one step per time point.
+
+    Arguments
+    ---------
+        f: `function`
+            The right hand side of the ODE system, f(X) returns the (n x d) derivatives of the (n x d) states X.
+        X0: `numpy.ndarray` (dimension: n x d)
+            The initial states.
+        t: `numpy.ndarray`
+            The time points (starting with the time of X0) at which the states are returned.
+
+    Returns
+    -------
+        X: `numpy.ndarray` (dimension: len(t) x n x d)
+            The states of all trajectories at each time point.
+    """
+
+    X = np.zeros((len(t),) + X0.shape)
+    X[0] = X0
+    for i in range(len(t) - 1):
+        h, x = t[i + 1] - t[i], X[i]
+        k1 = f(x)
+        k2 = f(x + h / 2 * k1)
+        k3 = f(x + h / 2 * k2)
+        k4 = f(x + h * k3)
+        X[i + 1] = x + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+    return X
+
+
+# Dormand-Prince 5(4) tableau
+_DP_C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1, 1])
+_DP_A = [[],
+         [1/5],
+         [3/40, 9/40],
+         [44/45, -56/15, 32/9],
+         [19372/6561, -25360/2187, 64448/6561, -212/729],
+         [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+         [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+_DP_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0])
+_DP_E = _DP_B - np.array([5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40])
+
+
+def integrate_rk45(f, X0, t, rtol=1e-6, atol=1e-8, max_steps=100000):
+    """Integrate a batch of initial states with the adaptive Dormand-Prince (RK45) method.
+
+    All unfinished trajectories are advanced together, but each of them has its own step size that is adapted to its own
+    local error estimate and is shortened to hit the requested time points exactly.
+
+    Arguments
+    ---------
+        f: `function`
+            The right hand side of the ODE system, f(X, idx) returns the derivatives of the states X of the trajectories
+            idx (an index array into the batch).
+        X0: `numpy.ndarray` (dimension: n x d)
+            The initial states.
+        t: `numpy.ndarray`
+            The increasing time points (starting with the time of X0) at which the states are returned.
+        rtol: `float` (default 1e-6)
+            Relative tolerance of the local error.
+        atol: `float` (default 1e-8)
+            Absolute tolerance of the local error.
+        max_steps: `int` (default 100000)
+            Maximal number of (accepted or rejected) steps.
+
+    Returns
+    -------
+        X: `numpy.ndarray` (dimension: len(t) x n x d)
+            The states of all trajectories at each time point.
+    """
+
+    n = X0.shape[0]
+    X = np.zeros((len(t),) + X0.shape)
+    X[0] = X0
+    if len(t) == 1:
+        return X
+
+    x, cur_t, nxt = np.array(X0, dtype=float), np.repeat(float(t[0]), n), np.ones(n, dtype=int)
+    h = np.repeat(float(t[1] - t[0]), n)
+    k_first = f(x, np.arange(n))
+    active = np.arange(n)
+
+    for _ in range(max_steps):
+        if len(active) == 0:
+            break
+        x_a, t_a, h_a = x[active], cur_t[active], np.minimum(h[active], t[nxt[active]] - cur_t[active])
+
+        K = [k_first[active]]
+        for s in range(1, 7):
+            x_s = x_a + h_a[:, None] * sum(a * k for a, k in zip(_DP_A[s], K) if a != 0)
+            K.append(f(x_s, active))
+        x_new = x_a + h_a[:, None] * sum(b * k for b, k in zip(_DP_B, K) if b != 0)
+        err = h_a[:, None] * sum(e * k for e, k in zip(_DP_E, K) if e != 0)
+
+        scale = atol + rtol * np.maximum(np.abs(x_a), np.abs(x_new))
+        err_norm = np.sqrt(np.mean((err / scale)**2, 1))
+        accepted = err_norm <= 1
+
+        with np.errstate(divide='ignore'):
+            factor = np.clip(0.9 * err_norm**(-1/5), 0.2, 10)
+        h[active] = h_a * np.where(accepted, factor, np.minimum(factor, 1))
+
+        acc = active[accepted]
+        x[acc], cur_t[acc] = x_new[accepted], t_a[accepted] + h_a[accepted]
+        k_first[acc] = K[6][accepted] # first same as last
+
+        reached = acc[np.isclose(cur_t[acc], t[nxt[acc]], rtol=0, atol=1e-12 * max(abs(t[-1]), 1))]
+        cur_t[reached] = t[nxt[reached]]
+        X[nxt[reached], reached] = x[reached]
+        nxt[reached] += 1
+        active = active[nxt[active] < len(t)]
+    else:
+        raise Exception('The maximal number of steps is reached before all trajectories are integrated.')
+
+    return X
+
 # def fate_(adata, time, direction = 'forward'):
 #     from .moments import *
 #     gene_exprs = adata.X
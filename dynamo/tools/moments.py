@@ -1,7 +1,9 @@
+import os
 from anndata import AnnData
 import numpy as np
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csr_matrix
 from .utils_moments import estimation
+from .utils import _get_n_jobs
 
 def stratify(arr, strata):
     s = np.unique(strata)
@@ -11,6 +13,60 @@ def strat_mom(arr, strata, fcn_mom):
     x = stratify(arr, strata)
     return np.array([fcn_mom(y) for y in x])
 
+def strat_12_mom(X, strata, has_nan=False):
+    """Compute the first and second moments of all features in each stratum at once.
+
+    The sums of x and x^2 over the samples of each stratum are obtained as the product of the data with a sparse
+    indicator matrix of the strata, so no per-feature slicing or densification is needed.
+
+    Arguments
+    ---------
+        X: `np.ndarray` or sparse matrix (dimension: n_features x n_samples)
+            The data, for example genes x cells.
+        strata: `np.ndarray`
+            The stratum (for example the time point) of each sample.
+        has_nan: `bool` (default: False)
+            Whether X contains NaN values, which are then ignored (as in `np.nanmean` and `np.nanvar`).
+
+    Returns
+    -------
+        M: `np.ndarray` (dimension: n_features x n_strata)
+            The mean in each stratum.
+        V: `np.ndarray` (dimension: n_features x n_strata)
+            The (population) variance in each stratum, E[x^2] - E[x]^2.
+        uniq: `np.ndarray`
+            The sorted unique strata corresponding to the columns of M and V.
+    """
+    uniq, inv = np.unique(strata, return_inverse=True)
+    n_samples = len(inv)
+    G = csr_matrix((np.ones(n_samples), (np.arange(n_samples), inv)), shape=(n_samples, len(uniq)))
+    n = np.bincount(inv, minlength=len(uniq)).astype(float)[None, :]
+
+    if issparse(X):
+        X = csr_matrix(X, dtype=float, copy=True)
+        if has_nan:
+            nan_ind = np.isnan(X.data)
+            n = n - csr_matrix((nan_ind.astype(float), X.indices, X.indptr), shape=X.shape).dot(G).A
+            X.data[nan_ind] = 0
+        S1 = X.dot(G).A
+        X.data **= 2
+        S2 = X.dot(G).A
+    else:
+        X = np.array(X, dtype=float)
+        if has_nan:
+            nan_ind = np.isnan(X)
+            n = n - G.T.dot(nan_ind.T.astype(float)).T
+            X[nan_ind] = 0
+        S1 = G.T.dot(X.T).T
+        S2 = G.T.dot((X**2).T).T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        M = S1 / n
+        V = np.maximum(S2 / n - M**2, 0)
+
+    return M, V, uniq
+
+
 def calc_mom_all_genes(T, adata, fcn_mom):
     ng = adata.var.shape[0]
     nT = len(np.unique(T))
@@ -35,19 +91,8 @@ class MomData(AnnData):
         # calculate first and second moments from data
         self.times = np.array(self.obs[time_key].values, dtype=float)
         self.uniq_times = np.unique(self.times)
-        nT = self.get_n_times()
-        ng = self.get_n_genes()
-        self.M = np.zeros((ng, nT))      # first moments (data)
-        self.V = np.zeros((ng, nT))      # second moments (data)
-        for g in range(ng):
-            tmp = self[:, g].layers['new']
-            L = np.array(tmp.A, dtype=float) if issparse(tmp) else np.array(tmp, dtype=float)  # consider using the `adata.obs_vector`, `adata.var_vector` methods or accessing the array directly.
-            if has_nan:
-                self.M[g] = strat_mom(L, self.times, np.nanmean)
-                self.V[g] = strat_mom(L, self.times, np.nanvar)
-            else:
-                self.M[g] = strat_mom(L, self.times, np.mean)
-                self.V[g] = strat_mom(L, self.times, np.var)
+        # first and second moments (data) of all genes in each time point
+        self.M, self.V, _ = strat_12_mom(self.layers['new'].T, self.times, has_nan)
 
     def get_n_genes(self):
         return self.var.shape[0]
@@ -78,27 +123,120 @@ class Estimation:
             return {'a': parr[:, 0], 'b': parr[:, 1], 'alpha_a': parr[:, 2], \
                 'alpha_i': parr[:, 3], 'beta': parr[:, 4], 'gamma': parr[:, 5]}
 
-    def fit_gene(self, gene_no, n_p0=10):
-        estm = estimation(list(self.param_ranges.values()))
+    def get_gene_data(self, gene_no):
+        """Return the moments of a gene stacked as the data for `estimation.fit_lsq` and the matching experiment type."""
         if self.data_u is None:
             m = self.data.M[gene_no, :].T
             v = self.data.V[gene_no, :].T
             x_data = np.vstack((m, v))
-            popt, cost = estm.fit_lsq(self.data.uniq_times, x_data, p0=None, n_p0=n_p0, normalize=self.normalize, experiment_type='nosplice')
+            experiment_type = 'nosplice'
         else:
             mu = self.data_u.M[gene_no, :].T
             ms = self.data.M[gene_no, :].T
             vu = self.data_u.V[gene_no, :].T
             vs = self.data.V[gene_no, :].T
             x_data = np.vstack((mu, ms, vu, vs))
-            popt, cost = estm.fit_lsq(self.data.uniq_times, x_data, p0=None, n_p0=n_p0, normalize=self.normalize, experiment_type=None)
+            experiment_type = None
+        return x_data, experiment_type
+
+    def fit_gene(self, gene_no, n_p0=10, random_state=None):
+        estm = estimation(list(self.param_ranges.values()))
+        x_data, experiment_type = self.get_gene_data(gene_no)
+        popt, cost = estm.fit_lsq(self.data.uniq_times, x_data, p0=None, n_p0=n_p0, normalize=self.normalize,
+                                  experiment_type=experiment_type, random_state=random_state)
         return popt, cost
 
-    def fit(self, n_p0=10):
+    def fit(self, n_p0=10, n_jobs=1, backend='process', chunk_size=None, random_seed=None, checkpoint=None):
+        """Fit the moment model to all genes.
+
+        Arguments
+        ---------
+            n_p0: `int` (default: 10)
+                The number of initial parameter sets (sampled by latin hypercube sampling) for the multi-start least squares.
+            n_jobs: `int` (default: 1)
+                The number of workers that fit chunks of genes in parallel. Negative values follow the joblib convention
+                (-1 means all cores).
+            backend: `str` (default: `process`)
+                Either `process` (a process pool) or `thread` (a thread pool) to run the chunks when n_jobs is not 1.
+            chunk_size: `int` or None (default: None)
+                The number of genes fitted per task. By default, the genes are split into about 4 chunks per worker.
+            random_seed: `int` or None (default: None)
+                If set, the initial parameters of gene i are sampled with the seed random_seed + i, so the results do not
+                depend on n_jobs, chunk_size or on resuming from a checkpoint. If None, the global numpy random state is
+                used as before, so the results of parallel or resumed fits are not reproducible.
+            checkpoint: `str` or None (default: None)
+                Path of a `.npz` file (the suffix is appended if missing) where the fitted parameters are saved after each
+                chunk. The file is replaced atomically, so an interrupted save leaves the previous checkpoint intact. If
+                the file exists, the genes already fitted are loaded from it and only the remaining genes are fitted.
+                Its `done` array records which genes are fitted, which can be used to monitor the progress.
+
+        Returns
+        -------
+            params: `np.ndarray` (dimension: n_genes x n_params)
+                The fitted parameters a, b, alpha_a, alpha_i, beta, gamma of each gene.
+            costs: `np.ndarray`
+                The least squares cost of each gene.
+        """
         ng = self.data.get_n_genes()
         params = np.zeros((ng, self.n_params))
         costs = np.zeros(ng)
-        for i in range(ng):
-            params[i], costs[i] = self.fit_gene(i, n_p0)
+        done = np.zeros(ng, dtype=bool)
+
+        if checkpoint is not None:
+            # np.savez appends the suffix to a path without it
+            checkpoint = str(checkpoint) if str(checkpoint).endswith('.npz') else str(checkpoint) + '.npz'
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with np.load(checkpoint) as saved:
+                if saved['params'].shape != params.shape:
+                    raise ValueError('The checkpoint {} does not match the number of genes or parameters.'.format(checkpoint))
+                params, costs, done = saved['params'], saved['costs'], saved['done']
+
+        todo = np.where(~done)[0]
+        n_jobs = _get_n_jobs(n_jobs)
+        chunk_size = max(int(np.ceil(len(todo) / (4 * n_jobs))), 1) if chunk_size is None else chunk_size
+        chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+        tasks = [(list(self.param_ranges.values()), self.data.uniq_times, [self.get_gene_data(g) for g in genes],
+                  n_p0, self.normalize, None if random_seed is None else [random_seed + g for g in genes]) for genes in chunks]
+
+        if n_jobs > 1 and len(chunks) > 1:
+            if backend == 'process':
+                from concurrent.futures import ProcessPoolExecutor as Executor
+            elif backend == 'thread':
+                from concurrent.futures import ThreadPoolExecutor as Executor
+            else:
+                raise ValueError("backend can only be 'process' or 'thread'.")
+            executor = Executor(max_workers=n_jobs)
+            results = executor.map(_fit_genes, tasks)
+        else:
+            executor, results = None, map(_fit_genes, tasks)
+
+        try:
+            for genes, (chunk_params, chunk_costs) in zip(chunks, results):
+                params[genes], costs[genes], done[genes] = chunk_params, chunk_costs, True
+                if checkpoint is not None:
+                    _save_checkpoint(checkpoint, params=params, costs=costs, done=done)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
         return params, costs
-        
+
+
+def _save_checkpoint(checkpoint, **arrays):
+    """Save the arrays to a temporary file next to checkpoint and move it in place, so that the checkpoint is never
+    left half written."""
+    tmp = checkpoint + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, checkpoint)
+
+
+def _fit_genes(args):
+    """Fit the moment model to a chunk of genes; module level so that it can be sent to a process pool."""
+    ranges, t, gene_data, n_p0, normalize, seeds = args
+    estm = estimation(ranges)
+    params, costs = np.zeros((len(gene_data), len(ranges))), np.zeros(len(gene_data))
+    for i, (x_data, experiment_type) in enumerate(gene_data):
+        params[i], costs[i] = estm.fit_lsq(t, x_data, p0=None, n_p0=n_p0, normalize=normalize, experiment_type=experiment_type,
+                                           random_state=None if seeds is None else seeds[i])
+    return params, costs
@@ -28,7 +28,7 @@ def Pseudotime(adata, layer='X', method='DDRTree', **kwargs):
 
     transition_matrix, cell_membership, principal_g = adata.uns['transition_matrix'], R, stree
 
-    final_g = compute_partition(transition_matrix, cell_membership, principal_g)
+    final_g = compute_partition(adata, transition_matrix, cell_membership, principal_g)
     direct_g = final_g.copy()
     tmp = final_g - final_g.T
     direct_g[np.where(tmp < 0)] = 0
@@ -82,9 +82,11 @@ def compute_partition(adata, transition_matrix, cell_membership, principal_g, gr
     Tcsr = minimum_spanning_tree(X)
     principal_g = Tcsr.toarray().astype(int)
 
-    membership_matrix = cell_membership.T.dot(transition_matrix).dot(cell_membership)
+    # cell_membership is sparse when DDRTree is run in the fast mode
+    cell_membership = csr_matrix(cell_membership)
+    membership_matrix = cell_membership.T.dot(csr_matrix(transition_matrix)).dot(cell_membership)
 
-    direct_principal_g = principal_g * membership_matrix
+    direct_principal_g = membership_matrix.multiply(principal_g).toarray()
 
     # get the data:
     # edges_per_module < - Matrix::rowSums(num_links)
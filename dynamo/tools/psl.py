@@ -5,7 +5,9 @@ import scipy.spatial as ss
 import scipy.sparse
 
 from scipy.sparse import csr_matrix
-from scipy.sparse.linalg import eigs
+import scipy.linalg
+import scipy.sparse.linalg
+from scipy.sparse.linalg import eigs, eigsh
 # from scikits.sparse.cholmod import cholesky
 
 # use for convert list of list to a list (https://stackoverflow.com/questions/952914/how-to-make-a-flat-list-out-of-list-of-lists)
@@ -92,7 +94,8 @@ def diag_mat (values):
 
     return mat
 
-def psl_py(Y, sG = None, dist = None, K = 10, C = 1e3, param_gamma = 1e-3, d = 2, maxIter = 10, verbose = False):
+def psl_py(Y, sG = None, dist = None, K = 10, C = 1e3, param_gamma = 1e-3, d = 2, maxIter = 10, verbose = False, nbrs = None,
+           solver = 'dense', n_probes = 100, tol = 1e-6, random_state = 19491001):
     """This function is a pure Python implementation of the PSL algorithm.
 
     Reference: Li Wang and Qi Mao, Probabilistic Dimensionality Reduction via Structure Learning. T-PAMI, VOL. 41, NO. 1, JANUARY 2019
@@ -120,6 +123,22 @@ def psl_py(Y, sG = None, dist = None, K = 10, C = 1e3, param_gamma = 1e-3, d = 2
             Number of maximum iterations
         verbose: 'bool'
             Whether to print running information
+        nbrs: 'NeighborIndex'
+            a prebuilt kNN index of Y (see `neighbor_index`) that is queried instead of building a new one when neither
+            sG nor dist is passed.
+        solver: 'str'
+            `dense` (dense Cholesky decomposition, exact), `cg` (sparse conjugate gradient solves, for large datasets) or
+            `auto` (dense for up to 2000 cells and cg for larger ones). With `cg` neither the dense inverse of the graph
+            Laplacian Q nor the N x N matrix P is formed: the terms of P are only evaluated on the edges of the graph, using
+            random projections for the inv(Q) part. The results of `cg` (and thus of `auto` above 2000 cells) are
+            therefore stochastic approximations of the exact ones, which depend on n_probes and random_state.
+        n_probes: 'int'
+            Number of random projections used to estimate the inv(Q) part of P on the edges by the `cg` solver. The relative
+            error decreases as 1 / sqrt(n_probes).
+        tol: 'float'
+            Relative tolerance of the conjugate gradient solves (at least 1e-3 for the random projections).
+        random_state: 'int'
+            The seed of the random projections.
     Returns
     -------
         (S,Z): 'tuple'
@@ -127,23 +146,14 @@ def psl_py(Y, sG = None, dist = None, K = 10, C = 1e3, param_gamma = 1e-3, d = 2
     """
 
     if sG is None:
-        if not dist:
-            tree = ss.cKDTree(Y)
-            dist_mat, idx_mat = tree.query(Y, k=K + 1)
+        if dist is None:
+            from .connectivity import _get_nbrs
+            dist_mat, idx_mat = _get_nbrs(Y, K + 1, nbrs).kneighbors(Y, n_neighbors=K + 1)
             N = Y.shape[0]
-            distances = dist_mat[:, 1:]
-            indices = idx_mat[:, 1:]
-
-            rows = np.zeros(N * K)
-            cols = np.zeros(N * K)
-            dists = np.zeros(N * K)
-            location = 0
-
-            for i in range(N):
-                rows[location:location+K] = i
-                cols[location:location+K] = indices[i]
-                dists[location:location+K] = distances[i]
-                location = location + K
+
+            rows = np.repeat(np.arange(N), K)
+            cols = idx_mat[:, 1:].flatten()
+            dists = dist_mat[:, 1:].flatten()
             sG = csr_matrix((np.array(dists) ** 2, (rows, cols)), shape=(N, N))
             sG = scipy.sparse.csc_matrix.maximum(sG, sG.T) # symmetrize the matrix
         else:
@@ -154,10 +164,10 @@ def psl_py(Y, sG = None, dist = None, K = 10, C = 1e3, param_gamma = 1e-3, d = 2
             j = sidx[:, 1:K+1].T.flatten() # .reshape(1, -1)[0]
             sG = csr_matrix((np.repeat(1, N * K), (i, j)), shape=(N, N)) # [1 for k in range(N * K)]
 
-    if not dist:
-        if list(set(sG.data)) == [1]:
-            print('Error: sG should not just be an adjacency graph and has to include the distance information between vertices!')
-            exit()
+    if dist is None:
+        if np.all(sG.data == 1):
+            raise Exception('sG should not just be an adjacency graph and has to include the distance information between '
+                            'vertices!')
         else:
             dist = sG
 
@@ -165,77 +175,83 @@ def psl_py(Y, sG = None, dist = None, K = 10, C = 1e3, param_gamma = 1e-3, d = 2
     G = sG
 
     rows, cols, s0 = scipy.sparse.find(scipy.sparse.tril(G))
+    dist = np.asarray(dist[rows, cols]).flatten() # distances of the edges
+    on_diag = rows == cols
 
-    # idx_map = np.vstack((rows, cols)).T
+    if solver == 'auto':
+        solver = 'dense' if N <= 2000 else 'cg'
+    random_state = np.random.RandomState(random_state)
 
     s = np.ones(s0.shape)
     m = len(s)
     #############################################
     objs = np.zeros(maxIter)
+    invQY = None
 
     for iter in range(maxIter):
-        S = csr_matrix((s, (rows, cols)), shape=(N, N)) # .toarray()
+        S = csr_matrix((s, (rows, cols)), shape=(N, N))
         S = S + S.T
-        Q = scipy.sparse.diags(functools.reduce(operator.concat, S.sum(axis=1)[:, 0].tolist())) - \
-            S + 0.25 * (param_gamma + 1) * scipy.sparse.eye(N, N) ##################
-        R = scipy.linalg.cholesky(Q.toarray())  # Cholesky Decomposition of a Sparse Matrix
-        invR = scipy.sparse.linalg.inv(csr_matrix(R))  # R:solve(R)
-        # invR = np.matrix(invR)
-        # invQ = invR*invR.T
-        # left = invR.T*np.matrix(Y)
-        invQ = invR.dot(invR.T)
-        left = invR.T.dot(Y)
-
-        #res = scipy.sparse.linalg.svds(left, k = d)
-        res = scipy.linalg.svd(left)
-        Lambda = res[1][:d]
-        W = res[2][:, :2]
-        invQY = invR.dot(left)
+        Q = (scipy.sparse.diags(np.asarray(S.sum(axis=1)).flatten()) - S +
+             0.25 * (param_gamma + 1) * scipy.sparse.eye(N, N)).tocsr()
+
+        if solver == 'dense':
+            R = scipy.linalg.cholesky(Q.toarray())  # Q = R^T R
+            invQ = scipy.linalg.cho_solve((R, False), np.eye(N))
+            invQY = invQ.dot(Y)
+            # (e_i - e_j)^T inv(Q) (e_i - e_j) of each edge
+            resistance = invQ[rows, rows] + invQ[cols, cols] - 2 * invQ[rows, cols]
+            logdet_Q = 2 * np.sum(np.log(np.diag(R))) if verbose else None
+        else:
+            invQY = _block_cg(Q, Y, tol, X0=invQY)
+            # the error of the random projections dominates, so their solves do not need to be more accurate than 1e-3
+            resistance = _edge_resistance(Q, rows, cols, s, 0.25 * (param_gamma + 1), n_probes, max(tol, 1e-3),
+                                          random_state)
+            logdet_Q = _logdet(Q) if verbose else None
+
+        # W: the top d right singular vectors of inv(R^T) Y, i.e. the eigenvectors of Y^T inv(Q) Y
+        vals, vecs = scipy.linalg.eigh(Y.T.dot(invQY))
+        W = vecs[:, ::-1][:, :d]
+        W *= np.sign(W[np.argmax(np.abs(W), axis=0), np.arange(d)])
         invQYW = invQY.dot(W)
 
-        P = 0.5 * D * invQ + 0.125 * param_gamma ** 2 * invQYW.dot(invQYW.T)
-        logdet_Q =  2 * sum(np.log(np.diag(np.linalg.cholesky(Q.toarray()).T)))
-        # log(det(Q))
-        obj = 0.5 * D * logdet_Q - scipy.sparse.csr_matrix.sum(scipy.sparse.csr_matrix.multiply(S, dist)) + \
-              0.25 / C * scipy.sparse.csr_matrix.sum(scipy.sparse.csr_matrix.multiply(S, S)) - \
-              0.125 * param_gamma ** 2 * sum(np.diag(np.dot(W.T, np.dot(Y.T, invQYW))))  # trace: #sum(diag(m))
-        objs[iter] = obj
+        # P = 0.5 * D * inv(Q) + 0.125 * param_gamma ** 2 * invQYW * invQYW^T is only evaluated on the edges
+        P_edges = 0.5 * D * resistance + 0.125 * param_gamma ** 2 * np.sum((invQYW[rows] - invQYW[cols]) ** 2, 1)
+        S_edges = np.where(on_diag, 2 * s, s)
 
         if verbose:
+            obj = 0.5 * D * logdet_Q - np.sum(S_edges * dist * (2 - on_diag)) + \
+                  0.25 / C * np.sum(S_edges ** 2 * (2 - on_diag)) - \
+                  0.125 * param_gamma ** 2 * np.sum(Y.dot(W) * invQYW)  # trace: #sum(diag(m))
+            objs[iter] = obj
+
             if iter == 0:
                 print('i = ', iter+1, ', obj = ', obj)
             else:
                 rel_obj_diff = abs(obj - objs[iter - 1]) / abs(objs[iter - 1])
                 print('i = ', iter, ', obj = ', obj, ', rel_obj_diff = ', rel_obj_diff)
-        subgrad = np.zeros(m)
 
-        for i in range(len(rows)):
-            subgrad[i] = P[rows[i], rows[i]] + P[cols[i], cols[i]] - P[rows[i], cols[i]] - P[cols[i], rows[i]] - \
-                         1 / C * S[rows[i], cols[i]] - 2 * dist[rows[i], cols[i]]
+        subgrad = np.where(on_diag, 0, P_edges) - 1 / C * S_edges - 2 * dist
 
         s = s + 1 / (iter+1) * subgrad
         s[s < 0] = 0
 
-        #print("print s:",s)
         if param_gamma != 0:
-            #print("print invQY:",invQY)
-            #print("print W:",W)
-
-            Z = 0.25 * (param_gamma + 1) * np.dot(invQY, W)
+            Z = 0.25 * (param_gamma + 1) * invQYW
         else:
-            # centeralized kernel
-            A = scipy.sparse.linalg.inv(Q)
-            column_sums = np.array(np.sum(A, 0) / N)
-            J = np.dot(np.array(np.ones(N))[:, None], np.array(column_sums))
-            K = A - J - J.T + sum(column_sums) / N
+            # centeralized kernel H inv(Q) H, with H = I - 1 1^T / N
+            def center(x):
+                return x - np.mean(x, 0)
 
-            # eigendecomposition
-            V, U = eigs(K, d)
-            v = V[0:d]
+            if solver == 'dense':
+                kernel = center(center(invQ).T)
+            else:
+                kernel = scipy.sparse.linalg.LinearOperator((N, N), dtype=float, matvec=lambda x: center(
+                    _block_cg(Q, center(x.reshape(-1, 1)), tol)).flatten())
 
-            tmp = np.zeros(shape=(d, d))
-            np.fill_diagonal(tmp, np.sqrt(v))
-            Z = np.dot(U, tmp)
+            # eigendecomposition
+            v, U = eigsh(kernel, d)
+            v, U = v[::-1], U[:, ::-1]
+            Z = U * np.sqrt(v)
 
     return (S,Z)
 
@@ -250,3 +266,89 @@ def logdet(A):
     """
     v = 2 * sum(np.log(np.diag(np.linalg.cholesky(A))))
     return v
+
+
+def _block_cg(Q, B, tol=1e-6, maxiter=None, X0=None):
+    """Solve Q X = B for a sparse symmetric positive definite Q with a Jacobi preconditioned conjugate gradient applied
+    to all columns of B at once (each column with its own step sizes)."""
+    B = B.reshape(B.shape[0], -1)
+    maxiter = 10 * Q.shape[0] if maxiter is None else maxiter
+    inv_diag = 1 / Q.diagonal()[:, None]
+    X = np.zeros(B.shape) if X0 is None else np.array(X0, dtype=float)
+    R = B - Q.dot(X) if X0 is not None else np.array(B, dtype=float)
+    Z = inv_diag * R
+    P = Z.copy()
+    rz = np.sum(R * Z, 0)
+    b_norm = np.linalg.norm(B, axis=0)
+    b_norm[b_norm == 0] = 1
+
+    for _ in range(maxiter):
+        if np.all(np.linalg.norm(R, axis=0) <= tol * b_norm):
+            break
+        QP = Q.dot(P)
+        pQp = np.sum(P * QP, 0)
+        alpha = np.divide(rz, pQp, out=np.zeros_like(rz), where=pQp > 0)
+        X += alpha * P
+        R -= alpha * QP
+        Z = inv_diag * R
+        rz_new = np.sum(R * Z, 0)
+        beta = np.divide(rz_new, rz, out=np.zeros_like(rz), where=rz > 0)
+        P = Z + beta * P
+        rz = rz_new
+
+    return X
+
+
+def _edge_resistance(Q, rows, cols, s, c, n_probes, tol, random_state):
+    """Estimate (e_i - e_j)^T inv(Q) (e_i - e_j) on all edges (i, j) of Q = L(s) + c I with random projections.
+
+    Q = A^T A with A = [diag(sqrt(s)) E; sqrt(c) I], where E is the edge incidence matrix, so the quantity equals
+    ||A inv(Q) (e_i - e_j)||^2, which is preserved (in expectation) by projecting the rows of A inv(Q) on n_probes random
+    directions: each probe costs one sparse solve instead of forming the dense inv(Q).
+    """
+    from .utils import _get_chunk_size
+
+    N, m = Q.shape[0], len(rows)
+    edges = np.where(rows != cols)[0]
+    weights = np.sqrt(s[edges])
+    E = csr_matrix((np.hstack((weights, -weights)), (np.hstack((rows[edges], cols[edges])), np.hstack((edges, edges)))),
+                   shape=(N, m))
+
+    resistance = np.zeros(m)
+    block_size = min(n_probes, _get_chunk_size(max(m, N)))
+    for start in range(0, n_probes, block_size):
+        n_block = min(block_size, n_probes - start)
+        B = E.dot(random_state.choice([-1.0, 1.0], size=(m, n_block))) + \
+            np.sqrt(c) * random_state.choice([-1.0, 1.0], size=(N, n_block))
+        X = _block_cg(Q, B, tol)
+        resistance += np.sum((X[rows] - X[cols]) ** 2, 1)
+
+    return resistance / n_probes
+
+
+def _logdet(Q, n_probes=30, n_steps=30, random_state=None):
+    """Estimate log(det(Q)) of a sparse symmetric positive definite matrix with stochastic Lanczos quadrature, after a
+    Jacobi scaling (log(det(Q)) = sum(log(diag(Q))) + log(det(D^-1/2 Q D^-1/2)))."""
+    random_state = np.random.RandomState(0) if random_state is None else random_state
+    N = Q.shape[0]
+    inv_sqrt_diag = 1 / np.sqrt(Q.diagonal())
+    A = scipy.sparse.diags(inv_sqrt_diag).dot(Q).dot(scipy.sparse.diags(inv_sqrt_diag)).tocsr()
+
+    res = 0
+    for _ in range(n_probes):
+        v = random_state.choice([-1.0, 1.0], size=N) / np.sqrt(N)
+        v_prev, beta, alphas, betas = np.zeros(N), 0, [], []
+        for _ in range(min(n_steps, N)):
+            w = A.dot(v) - beta * v_prev
+            alpha = w.dot(v)
+            w -= alpha * v
+            alphas.append(alpha)
+            beta = np.linalg.norm(w)
+            if beta < 1e-10:
+                break
+            betas.append(beta)
+            v_prev, v = v, w / beta
+        theta, U = scipy.linalg.eigh_tridiagonal(np.array(alphas), np.array(betas[:len(alphas) - 1]))
+        res += N * np.sum(U[0] ** 2 * np.log(theta)) / n_probes
+
+    return res - 2 * np.sum(np.log(inv_sqrt_diag))
@@ -1,5 +1,7 @@
 import numpy as np
 import scipy
+import scipy.linalg
+import warnings
 import numpy.matlib
 from scipy.sparse import issparse
 
@@ -39,17 +41,20 @@ def norm(X, V, T):
         return X, V, T, norm_dict
 
 
-def auto_con_K(self, x, y, beta):
+def auto_con_K(x, y, beta):
     """Con_K constructs the kernel K, where K(i, j) = k(x, y) = exp(-beta * ||x - y||^2).
 
+    Same as :func:`con_K` but computed in a single expression without in-place operations or chunking. This is the
+    kernel used by vector_field_function_auto when autograd is True.
+
     Arguments
     ---------
         x: 'np.ndarray'
             Original training data points.
         y: 'np.ndarray'
             control points used to build kernel basis functions
-        beta: 'np.ndarray'
-            The function that returns diffusion matrix which can be dependent on the variables (for example, genes)
+        beta: 'float'
+            Paramerter of Gaussian Kernel, k(x, y) = exp(-beta*||x-y||^2),
 
     Returns
     -------
@@ -57,20 +62,13 @@ def auto_con_K(self, x, y, beta):
             the kernel to represent the vector field function.
     """
 
-    n, d = x.shape
-    m, d = y.shape
-
-    # https://stackoverflow.com/questions/1721802/what-is-the-equivalent-of-matlabs-repmat-in-numpy
-    # https://stackoverflow.com/questions/12787475/matlabs-permute-in-python
-    K = np.matlib.tile(x[:, :, None], [1, 1, m]) - np.transpose(np.matlib.tile(y[:, :, None], [1, 1, n]), [2, 1, 0])
-    K = np.squeeze(np.sum(K**2, 1))
-    K = - beta * K
-    K = np.exp(K) #
+    D = np.sum(x**2, 1)[:, None] + np.sum(y**2, 1)[None, :] - 2 * x.dot(y.T)
+    K = np.exp(- beta * np.maximum(D, 0))
 
-    return K
+    return np.squeeze(K)
 
 
-def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, lambda_ = 3, minP = 1e-5, MaxIter = 500, theta = 0.75, div_cur_free_kernels = False):
+def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, lambda_ = 3, minP = 1e-5, MaxIter = 500, theta = 0.75, div_cur_free_kernels = False, chunk_size = None):
     """Apply sparseVFC (vector field consensus) algorithm to learn a functional form of the vector field on the entire space robustly and efficiently.
     Reference: Regularized vector field learning with sparse approximation for mismatch removal, Ma, Jiayi, etc. al, Pattern Recognition
 
@@ -100,6 +98,19 @@ def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, l
             Maximum iterition times.
         theta: 'float' (default: 0.75)
             Define how could be an inlier. If the posterior probability of a sample is an inlier is larger than theta, then it is regarded as an inlier.
+        div_cur_free_kernels: 'bool' (default: False)
+            A logic flag to determine whether the divergence-free or curl-free kernels will be used for learning the vector
+            field. Not supported in the chunked mode.
+        chunk_size: 'int' or None (default: None)
+            If not None, the kernel matrix U between the samples and the control points is never formed. Instead, each EM
+            iteration streams over blocks of chunk_size samples to accumulate U^T P U and U^T P Y and the M x M linear system
+            is solved with a Cholesky factorization. Memory then scales as O(M^2 + chunk_size * M) instead of O(N * M),
+            which makes it possible to learn vector fields of millions of cells. When the system is singular or too
+            ill-conditioned for the Cholesky solution (e.g. for a small beta and many control points, where the kernel
+            matrix is numerically singular), it falls back to the least squares solution like the unchunked mode. The
+            coefficients C of such a system are not unique, so C (and, through the EM iterations, V and P) can differ
+            from the unchunked ones even though the fitted vector field is nearly the same. For well-conditioned systems
+            both modes give the same results up to round-off.
 
     Returns
     -------
@@ -111,19 +122,60 @@ def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, l
     N, D = Y.shape
     grid_U = None
 
+    if chunk_size is not None and div_cur_free_kernels:
+        raise ValueError('The chunked mode of SparseVFC only supports the Gaussian kernel.')
+
     # Construct kernel matrix K
     M = 500 if M is None else M
-    tmp_X = np.unique(X, axis = 0) # return unique rows
-    idx = np.random.RandomState(seed=0).permutation(tmp_X.shape[0]) # rand select some intial points
-    idx = idx[range(min(M, tmp_X.shape[0]))]
-    ctrl_pts = tmp_X[idx, :]
+    ctrl_pts = _select_ctrl_pts(X, M)
     # ctrl_pts = X[range(500), :]
 
     K = con_K(ctrl_pts, ctrl_pts, beta) if div_cur_free_kernels is False else con_K_div_cur_free(ctrl_pts, ctrl_pts)[0]
-    U = con_K(X, ctrl_pts, beta) if div_cur_free_kernels is False else con_K_div_cur_free(X, ctrl_pts)[0]
+    if chunk_size is None:
+        U = con_K(X, ctrl_pts, beta) if div_cur_free_kernels is False else con_K_div_cur_free(X, ctrl_pts)[0]
+        if Grid is not None and div_cur_free_kernels is not False:
+            grid_U = con_K_div_cur_free(Grid, ctrl_pts)[0]
+
+        def normal_eqs(P):
+            UP = U.T * P[None, :]
+            return UP.dot(U), UP.dot(Y)
+
+        predict, solve = U.dot, lambda A, b: scipy.linalg.lstsq(A, b)[0]
+    else:
+        # the kernel between each block of samples and the control points is recomputed on the fly
+        chunk_size = max(int(chunk_size), 1)
+        chunks = [slice(i, min(i + chunk_size, N)) for i in range(0, N, chunk_size)]
+
+        def normal_eqs(P):
+            UPU, UPY = 0, 0
+            for cur in chunks:
+                U = con_K(X[cur], ctrl_pts, beta)
+                UP = U.T * P[cur]
+                UPU, UPY = UPU + UP.dot(U), UPY + UP.dot(Y[cur])
+            return UPU, UPY
+
+        def predict(C):
+            return np.vstack([con_K_dot(X[cur], ctrl_pts, beta, C) for cur in chunks])
+
+        solve = _solve_spd
+
+    V, C, P, sigma2 = _SparseVFC_EM(Y, K, normal_eqs, predict, solve, a, ecr, gamma, lambda_, minP, MaxIter, theta)
+
+    grid_V = None
     if Grid is not None:
-        grid_U = con_K(Grid, ctrl_pts, beta) if div_cur_free_kernels is False else con_K_div_cur_free(Grid, ctrl_pts)[0]
-    M = ctrl_pts.shape[0]
+        grid_V = con_K_dot(Grid, ctrl_pts, beta, C, chunk_size=chunk_size) if grid_U is None else np.dot(grid_U, C)
+
+    VecFld = {"X": ctrl_pts, "Y": Y, "beta": beta, "V": V, "C": C, "P": P, "VFCIndex": np.where(P > theta)[0], "sigma2": sigma2, "grid": Grid, "grid_V": grid_V}
+
+    return VecFld
+
+
+def _SparseVFC_EM(Y, K, normal_eqs, predict, solve, a, ecr, gamma, lambda_, minP, MaxIter, theta):
+    """The EM iterations of SparseVFC. With U the kernel matrix between the samples and the control points,
+    normal_eqs(P) returns U^T P U and U^T P Y, predict(C) returns U C and solve(A, b) solves the M-step system, so that
+    U can either be kept in memory or streamed over blocks of samples."""
+    N, D = Y.shape
+    M = K.shape[0]
 
     # Initialization
     V = np.zeros((N, D))
@@ -144,17 +196,17 @@ def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, l
 
         # M-step. Solve linear system for C.
         P = scipy.maximum(P, minP)
-        C = scipy.linalg.lstsq(((U.T * numpy.matlib.repmat(P.T, M, 1)).dot(U) + lambda_ * sigma2 * K), \
-                               (U.T * numpy.matlib.repmat(P.T, M, 1)).dot(Y))[0]
+        UPU, UPY = normal_eqs(P)
+        C = solve(UPU + lambda_ * sigma2 * K, UPY)
 
         # Update V and sigma**2
-        V = U.dot(C)
+        V = predict(C)
         Sp = sum(P)
         sigma2 = sum(P.T * np.sum((Y - V)**2, 1)) / np.dot(Sp, D)
 
         # Update gamma
         numcorr = len(np.where(P > theta)[0])
-        gamma = numcorr / X.shape[0]
+        gamma = numcorr / N
 
         if gamma > 0.95:
             gamma = 0.95
@@ -163,16 +215,69 @@ def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, l
 
         iter += 1
 
-    grid_V = None
-    if Grid is not None:
-        grid_V = np.dot(grid_U, C)
+    return V, C, P, sigma2
 
-    VecFld = {"X": ctrl_pts, "Y": Y, "beta": beta, "V": V, "C": C, "P": P, "VFCIndex": np.where(P > theta)[0], "sigma2": sigma2, "grid": Grid, "grid_V": grid_V}
 
-    return VecFld
+def _select_ctrl_pts(X, M):
+    """Randomly select (at most) M unique samples as the control points of the kernel basis functions."""
+    tmp_X = np.unique(X, axis = 0) # return unique rows
+    idx = np.random.RandomState(seed=0).permutation(tmp_X.shape[0]) # rand select some intial points
+    idx = idx[range(min(M, tmp_X.shape[0]))]
+
+    return tmp_X[idx, :]
+
 
+def _solve_spd(A, b):
+    """Solve the symmetric positive (semi-)definite system A x = b with a Cholesky factorization, falling back to least
+    squares when A is singular or too ill-conditioned for the Cholesky solution to be accurate."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', scipy.linalg.LinAlgWarning)
+        try:
+            return scipy.linalg.solve(A, b, assume_a='pos')
+        except (np.linalg.LinAlgError, scipy.linalg.LinAlgWarning):
+            return scipy.linalg.lstsq(A, b)[0]
 
-def con_K(x, y, beta):
+
+def sq_dist(x, y, y_sq=None, dtype=None):
+    """Pairwise squared euclidean distances between the rows of x and y via ||x||^2 + ||y||^2 - 2 x y^T.
+
+    Arguments
+    ---------
+        x: 'np.ndarray' (dimension: n x d)
+            The first set of points.
+        y: 'np.ndarray' (dimension: m x d)
+            The second set of points.
+        y_sq: 'np.ndarray' or None (default: None)
+            Precomputed squared norms of the rows of y, used to avoid recomputing them for each block of x.
+        dtype: 'np.dtype' or None (default: None)
+            The floating point type used for the computation, e.g. np.float32 to halve the memory footprint. If None, the
+            result type of x and y is used.
+
+    Returns
+    -------
+        D: 'np.ndarray' (dimension: n x m)
+            The squared distances (clipped at 0 to remove negative round-off errors).
+    """
+
+    if dtype is not None:
+        x, y = np.asarray(x, dtype=dtype), np.asarray(y, dtype=dtype)
+    y_sq = np.sum(y**2, 1) if y_sq is None else y_sq
+
+    D = x.dot(y.T)
+    D *= -2
+    D += np.sum(x**2, 1)[:, None]
+    D += y_sq[None, :]
+    np.maximum(D, 0, out=D)
+
+    return D
+
+
+def _get_kernel_chunk_size(m, chunk_size=None, max_elements=2**22):
+    """Number of rows of x per block so that a block of the kernel has at most max_elements elements."""
+    return max(int(max_elements // max(m, 1)), 1) if chunk_size is None else max(int(chunk_size), 1)
+
+
+def con_K(x, y, beta, dtype=None, chunk_size=None):
     """Con_K constructs the kernel K, where K(i, j) = k(x, y) = exp(-beta * ||x - y||^2).
 
     Arguments
@@ -183,6 +288,12 @@ def con_K(x, y, beta):
             Control points used to build kernel basis functions.
         beta: 'float' (default: 0.1)
             Paramerter of Gaussian Kernel, k(x, y) = exp(-beta*||x-y||^2),
+        dtype: 'np.dtype' or None (default: None)
+            The floating point type of the kernel, for example np.float32. If None, the (floating point) result type of
+            x and y is used.
+        chunk_size: 'int' or None (default: None)
+            The number of rows of x that are processed at a time. Only the temporary memory is bounded by this; the full
+            kernel is still returned. Use :func:`con_K_dot` if only the product with the coefficients is needed.
 
     Returns
     -------
@@ -190,17 +301,70 @@ def con_K(x, y, beta):
     the kernel to represent the vector field function.
     """
 
-    n, d = x.shape
-    m, d = y.shape
+    n, m = x.shape[0], y.shape[0]
+    chunk_size = _get_kernel_chunk_size(m, chunk_size)
+    dtype = np.result_type(x, y, np.float32) if dtype is None else dtype
+    y_sq = np.sum(np.asarray(y, dtype=dtype)**2, 1)
+
+    if n <= chunk_size:
+        K = sq_dist(x, y, y_sq, dtype)
+        K *= - beta
+        np.exp(K, out=K)
+    else:
+        K = np.empty((n, m), dtype=dtype)
+        for i in range(0, n, chunk_size):
+            K_i = sq_dist(x[i:i + chunk_size], y, y_sq, dtype)
+            K_i *= - beta
+            K[i:i + chunk_size] = np.exp(K_i, out=K_i)
 
-    # https://stackoverflow.com/questions/1721802/what-is-the-equivalent-of-matlabs-repmat-in-numpy
-    # https://stackoverflow.com/questions/12787475/matlabs-permute-in-python
-    K = np.matlib.tile(x[:, :, None], [1, 1, m]) - np.transpose(np.matlib.tile(y[:, :, None], [1, 1, n]), [2, 1, 0])
-    K = np.squeeze(np.sum(K**2, 1))
-    K = - beta * K
-    K = np.exp(K) #
+    return np.squeeze(K)
 
-    return K
+
+def con_K_dot(x, y, beta, C, dtype=None, chunk_size=None):
+    """Evaluate K(x, y).dot(C) block by block without materializing the full kernel K, where
+    K(i, j) = k(x, y) = exp(-beta * ||x - y||^2). This is the prediction of the vector field at x.
+
+    Arguments
+    ---------
+        x: 'np.ndarray' (dimension: n x d)
+            Points where the vector field is evaluated.
+        y: 'np.ndarray' (dimension: m x d)
+            Control points used to build kernel basis functions.
+        beta: 'float'
+            Paramerter of Gaussian Kernel, k(x, y) = exp(-beta*||x-y||^2),
+        C: 'np.ndarray' (dimension: m x D or m)
+            The coefficients of the kernel basis functions.
+        dtype: 'np.dtype' or None (default: None)
+            The floating point type used for the kernel blocks, for example np.float32.
+        chunk_size: 'int' or None (default: None)
+            The number of rows of x that are processed at a time. If None, it is chosen such that each kernel block has at
+            most 2^22 elements.
+
+    Returns
+    -------
+        V: 'np.ndarray' (dimension: n x D or n)
+            The product of the kernel and the coefficients.
+    """
+
+    x = np.atleast_2d(x)
+    n, m = x.shape[0], y.shape[0]
+    if n == 1:
+        # single query point, e.g. one step of an ODE solver: the explicit differences are cheaper and exact
+        if dtype is not None:
+            x, y = np.asarray(x, dtype=dtype), np.asarray(y, dtype=dtype)
+        return np.exp(- beta * np.sum((x - y)**2, 1)).dot(C)[None]
+
+    chunk_size = _get_kernel_chunk_size(m, chunk_size)
+    dtype = np.result_type(x, y, np.float32) if dtype is None else dtype
+    y_sq = np.sum(np.asarray(y, dtype=dtype)**2, 1)
+
+    V = np.empty((n,) + C.shape[1:], dtype=np.result_type(y_sq, C))
+    for i in range(0, n, chunk_size):
+        K_i = sq_dist(x[i:i + chunk_size], y, y_sq, dtype)
+        K_i *= - beta
+        V[i:i + chunk_size] = np.exp(K_i, out=K_i).dot(C)
+
+    return V
 
 
 def get_P(Y, V, sigma2, gamma, a):
@@ -300,7 +464,7 @@ def VectorField(adata, basis='trimap', grid_velocity=False, grid_num=50, velocit
 
 
 class vectorfield:
-    def __init__(self, X=None, V=None, Grid=None, M=100, a=5, beta=0.1, ecr=1e-5, gamma=0.9, lambda_=3, minP=1e-5, MaxIter=500, theta=0.75, div_cur_free_kernels=False):
+    def __init__(self, X=None, V=None, Grid=None, M=100, a=5, beta=0.1, ecr=1e-5, gamma=0.9, lambda_=3, minP=1e-5, MaxIter=500, theta=0.75, div_cur_free_kernels=False, chunk_size=None):
         """Initialize the VectorField class.
 
         Parameters
@@ -335,11 +499,14 @@ class vectorfield:
         div_cur_free_kernels: `bool` (default: False)
             A logic flag to determine whether the divergence-free or curl-free kernels will be used for learning the vector
             field.
+        chunk_size: `int` or None (default: None)
+            If not None, SparseVFC streams over blocks of chunk_size cells instead of building the full kernel matrix
+            between the cells and the control points, see :func:`SparseVFC`.
         """
 
         self.data = {"X": X, "V": V, "Grid": Grid}
 
-        self.parameters = {'M': M, "a": a, "beta": beta, "ecr": ecr, "gamma": gamma, "lambda_": lambda_, "minP": minP, "MaxIter": MaxIter, "theta": theta, "div_cur_free_kernels": div_cur_free_kernels}
+        self.parameters = {'M': M, "a": a, "beta": beta, "ecr": ecr, "gamma": gamma, "lambda_": lambda_, "minP": minP, "MaxIter": MaxIter, "theta": theta, "div_cur_free_kernels": div_cur_free_kernels, "chunk_size": chunk_size}
         self.norm_dict = {}
 
     def fit(self, normalize = False, method='SparseVFC'):
@@ -371,7 +538,7 @@ class vectorfield:
             VecFld = SparseVFC(self.data['X'], self.data['V'], self.data['Grid'], M = self.parameters['M'], a = self.parameters['a'],
                                beta = self.parameters['beta'], ecr = self.parameters['ecr'], gamma = self.parameters['gamma'],
                                lambda_ = self.parameters['lambda_'], minP = self.parameters['minP'], MaxIter = self.parameters['MaxIter'],
-                               theta = self.parameters['theta'])
+                               theta = self.parameters['theta'], chunk_size = self.parameters['chunk_size'])
 
         return VecFld
 
@@ -483,11 +650,13 @@ class vectorfield:
         Reference: Regularized vector field learning with sparse approximation for mismatch removal, Ma, Jiayi, etc. al, Pattern Recognition
         """
 
-        K= con_K(x, VecFld['X'], VecFld['beta']) if autograd is False else auto_con_K(x, VecFld['X'], VecFld['beta'])
+        if autograd is False:
+            K = con_K_dot(x, VecFld['X'], VecFld['beta'], VecFld['C'])
+            K = K[0] if K.shape[0] == 1 else K
+        else:
+            K = auto_con_K(x, VecFld['X'], VecFld['beta']).dot(VecFld['C'])
 
-        K = K.dot(VecFld['C']).T
-
-        return K
+        return K.T
 
 
 def vector_field_function(x, t, VecFld):
@@ -496,10 +665,6 @@ def vector_field_function(x, t, VecFld):
     Reference: Regularized vector field learning with sparse approximation for mismatch removal, Ma, Jiayi, etc. al, Pattern Recognition
     """
     x=np.array(x).reshape((1, -1))
-    if(len(x.shape) == 1):
-        x = x[None, :]
-    K= con_K(x, VecFld['X'], VecFld['beta'])
-
-    K = K.dot(VecFld['C'])
+    K = con_K_dot(x, VecFld['X'], VecFld['beta'], VecFld['C'])
 
-    return K.T
+    return K[0]
@@ -8,7 +8,8 @@ def cal_ncenter(ncells, ncells_limit=100):
   return np.round(2 * ncells_limit * np.log(ncells)/ (np.log(ncells) + np.log(ncells_limit)))
 
 
-def directed_pg(adata, basis='umap', maxIter=10, sigma=0.001, Lambda=None, gamma=10, ncenter=None, raw_embedding=True):
+def directed_pg(adata, basis='umap', maxIter=10, sigma=0.001, Lambda=None, gamma=10, ncenter=None, raw_embedding=True,
+                **DDRTree_kwargs):
     """A function that learns a direct principal graph by integrating the transition matrix between and DDRTree.
 
     Parameters
@@ -27,13 +28,16 @@ def directed_pg(adata, basis='umap', maxIter=10, sigma=0.001, Lambda=None, gamma
             regularization parameter for k-means.
         raw_embedding: `bool` (default: True)
             Whether to project the nodes on the principal graph into the original embedding.
+        DDRTree_kwargs:
+            Additional parameters passed to DDRTree_py, for example `fast=True` to learn the principal graph of large
+            datasets with the performance mode of DDRTree_py.
 
     Returns
     -------
         An updated AnnData object that is updated with principal_g_transition, X__DDRTree and and X_DDRTree_pg keys.
 
     """
-    X = adata.obsm['X_' + basis].T if basis in adata.obsm.keys() else None
+    X = adata.obsm['X_' + basis].T if 'X_' + basis in adata.obsm.keys() else None
     if X is None:
         raise Exception('{} is not a key of obsm ({} dimension reduction is not performed yet.).'.format(basis, basis))
 
@@ -42,21 +46,24 @@ def directed_pg(adata, basis='umap', maxIter=10, sigma=0.001, Lambda=None, gamma
         raise Exception('transition_matrix is not a key of uns. Please first run cell_velocity.')
     
     Lambda = 5 * X.shape[1] if Lambda is None else Lambda
-    ncenter = 250 if cal_ncenter(X.shape[1]) is None else ncenter
+    ncenter = int(cal_ncenter(X.shape[1])) if ncenter is None else ncenter
 
-    DDRTree_res = DDRTree_py(X, maxIter=maxIter, Lambda=Lambda, sigma=sigma, gamma=gamma, ncenter=ncenter)
-    principal_g, cell_membership = DDRTree_res.loc[maxIter - 1, 'stree'], DDRTree_res.loc[maxIter - 1, 'R']
+    Z, Y, principal_g, cell_membership = DDRTree_py(X, maxIter=maxIter, Lambda=Lambda, sigma=sigma, gamma=gamma,
+                                                    ncenter=ncenter, **DDRTree_kwargs)[:4]
+    cell_membership = csr_matrix(cell_membership)
 
-    X = csr_matrix(principal_g)
-    Tcsr = minimum_spanning_tree(X)
+    Tcsr = minimum_spanning_tree(csr_matrix(principal_g > 0))
     principal_g = Tcsr.toarray().astype(int)
 
     # here we can also identify siginificant links using methods related to PAGA
-    principal_g_transition = cell_membership.T.dot(transition_matrix).dot(cell_membership) * principal_g
+    principal_g_transition = cell_membership.T.dot(csr_matrix(transition_matrix)).dot(cell_membership)
+    principal_g_transition = principal_g_transition.multiply(principal_g)
 
-    adata.uns['principal_g_transition'] = principal_g_transition
-    adata.obsm['X_DDRTree'] = X.T if raw_embedding else DDRTree_res.loc[maxIter - 1, 'Z']
-    adata.uns['X_DDRTree_pg'] = cell_membership.dot(X.T) if raw_embedding else DDRTree_res.loc[maxIter - 1, 'Y']
+    adata.uns['principal_g_transition'] = principal_g_transition.toarray()
+    adata.obsm['X_DDRTree'] = X.T if raw_embedding else Z.T
+    # the nodes in the original embedding are the membership-weighted means of their cells
+    adata.uns['X_DDRTree_pg'] = cell_membership.T.dot(X.T) / np.asarray(cell_membership.sum(0)).T if raw_embedding \
+        else Y.T
 
     return adata
 
@@ -5,7 +5,7 @@ from scipy.optimize import fsolve
 from scipy.spatial.distance import pdist
 from scipy.linalg import eig
 from scipy.integrate import odeint
-from .scVectorField import con_K
+from .scVectorField import con_K, con_K_dot
 
 def vector_field_function(x, VecFld, dim=None):
     """Learn an analytical function of vector field from sparse single cell samples on the entire space robustly.
@@ -15,13 +15,10 @@ def vector_field_function(x, VecFld, dim=None):
     x = np.array(x)
     if (x.ndim == 1):
         x = x[None, :]
-    K = con_K(x, VecFld['X'], VecFld['beta'])
+    C = VecFld['C'] if dim is None else VecFld['C'][:, dim]
+    K = con_K_dot(x, VecFld['X'], VecFld['beta'], C)
 
-    if dim is None:
-        K = K.dot(VecFld['C'])
-    else:
-        K = K.dot(VecFld['C'][:, dim])
-    return K
+    return K[0] if K.shape[0] == 1 else K
 
 
 def index_condensed_matrix(n, i, j):
@@ -1,13 +1,13 @@
+import os
+import weakref
 import numpy as np
 from scipy.sparse import issparse
-from .moments import strat_mom
+from concurrent.futures import ThreadPoolExecutor
 
 def cal_12_mom(data, t):
-    t_uniq = np.unique(t)
-    m, v = np.zeros((data.shape[0], len(t_uniq))), np.zeros((data.shape[0], len(t_uniq)))
-    for i in range(data.shape[0]):
-        data_ = np.array(data[i].A.flatten(), dtype=float) if issparse(data) else np.array(data[i], dtype=float)  # consider using the `adata.obs_vector`, `adata.var_vector` methods or accessing the array directly.
-        m[i], v[i] = strat_mom(data_, t, np.nanmean), strat_mom(data_, t, np.nanvar)
+    from .moments import strat_12_mom
+
+    m, v, t_uniq = strat_12_mom(data, t, has_nan=True)
 
     return m, v, t_uniq
 
@@ -60,14 +60,17 @@ def get_U_S_for_velocity_estimation(subset_adata, has_splicing, has_labeling, lo
     return U, S
 
 
-def lhsclassic(n_samples, n_dim):
+def lhsclassic(n_samples, n_dim, random_state=None):
+    """Latin hypercube sampling of n_samples points in the n_dim dimensional unit cube. random_state (a seed or a
+    `np.random.RandomState`) makes the samples reproducible; by default the global numpy random state is used."""
 
     # From PyDOE
+    rng = np.random if random_state is None else np.random.RandomState(random_state) if np.isscalar(random_state) else random_state
     # Generate the intervals
     cut = np.linspace(0, 1, n_samples + 1)
 
     # Fill points uniformly in each interval
-    u = np.random.rand(n_samples, n_dim)
+    u = rng.rand(n_samples, n_dim)
     a = cut[:n_samples]
     b = cut[1:n_samples + 1]
     rdpoints = np.zeros(u.shape)
@@ -77,7 +80,7 @@ def lhsclassic(n_samples, n_dim):
     # Make the random pairings
     H = np.zeros(rdpoints.shape)
     for j in range(n_dim):
-        order = np.random.permutation(range(n_samples))
+        order = rng.permutation(range(n_samples))
         H[:, j] = rdpoints[order, j]
 
     return H
@@ -89,3 +92,50 @@ def norm_loglikelihood(x, mu, sig):
     ll = - 0.5 * np.log(2 * np.pi) - 0.5 * (x - mu)**2 / sig**2
 
     return np.sum(ll)
+
+
+def _get_chunk_size(n_cols, chunk_size=None, max_elements=2**23):
+    """Number of cells processed per block so that a (chunk_size x n_cols) float buffer stays below max_elements."""
+    if chunk_size is None:
+        chunk_size = max_elements // max(n_cols, 1)
+    return int(max(1, chunk_size))
+
+
+def _get_n_jobs(n_jobs):
+    """Resolve the number of workers; negative values follow the joblib convention (-1 means all cores)."""
+    n_cores = os.cpu_count() or 1
+    if n_jobs is None:
+        return 1
+    return max(1, n_cores + 1 + n_jobs) if n_jobs < 0 else min(n_jobs, n_cores)
+
+
+def _run_chunks(func, n, chunk_size, n_jobs=1):
+    """Apply func to the start index of each block of chunk_size rows out of n, optionally on a thread pool.
+
+    The numpy kernels release the GIL, so blocks that write to disjoint slices of preallocated arrays run in parallel
+    and the result does not depend on the number of workers.
+    """
+    starts = range(0, n, chunk_size)
+    n_jobs = _get_n_jobs(n_jobs)
+    if n_jobs == 1 or len(starts) == 1:
+        for start in starts:
+            func(start)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(func, starts))
+
+
+_adata_caches = {}
+
+
+def _get_adata_cache(adata, name):
+    """A dictionary of objects derived from adata (e.g. kNN indices) that is kept with adata for the current session.
+
+    The objects are not stored in the uns attribute because they can't be written to h5ad files. The cache of adata is
+    looked up by its id and dropped when adata is garbage collected.
+    """
+    key = id(adata)
+    if key not in _adata_caches:
+        _adata_caches[key] = {}
+        weakref.finalize(adata, _adata_caches.pop, key, None)
+    return _adata_caches[key].setdefault(name, {})
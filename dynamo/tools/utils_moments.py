@@ -188,7 +188,51 @@ class moments:
 
         return K, p
     
-    def solve(self, t, x0=None):
+    def computeKnp_jac(self):
+        """Derivatives of K and p with respect to the parameters (a, b, alpha_a, alpha_i, beta, gamma)."""
+        # parameters
+        a = self.a
+        b = self.b
+        aa = self.aa
+        ai = self.ai
+
+        dK = zeros((6, self.n_species, self.n_species))
+        dp = zeros((6, self.n_species))
+        ab2 = (a + b)**2
+
+        # a
+        dK[0, self.ua, self.ua], dK[0, self.ua, self.ui] = -1, 1
+        dK[0, self.xa, self.xa], dK[0, self.xa, self.xi] = -1, 1
+        dK[0, self.uu, self.ua], dK[0, self.uu, self.ui] = -2 * aa * b / ab2, 2 * ai * b / ab2
+        dK[0, self.ux, self.xa], dK[0, self.ux, self.xi] = -aa * b / ab2, ai * b / ab2
+
+        # b
+        dK[1, self.ui, self.ua], dK[1, self.ui, self.ui] = 1, -1
+        dK[1, self.xi, self.xa], dK[1, self.xi, self.xi] = 1, -1
+        dK[1, self.uu, self.ua], dK[1, self.uu, self.ui] = 2 * aa * a / ab2, -2 * ai * a / ab2
+        dK[1, self.ux, self.xa], dK[1, self.ux, self.xi] = aa * a / ab2, -ai * a / ab2
+
+        # alpha_a
+        dK[2, self.uu, self.ua], dK[2, self.ux, self.xa] = 2 * b / (a + b), b / (a + b)
+        dp[2, self.ua] = 1
+
+        # alpha_i
+        dK[3, self.uu, self.ui], dK[3, self.ux, self.xi] = 2 * a / (a + b), a / (a + b)
+        dp[3, self.ui] = 1
+
+        # beta
+        dK[4, self.ua, self.ua], dK[4, self.ui, self.ui], dK[4, self.uu, self.uu], dK[4, self.ux, self.ux] = -1, -1, -2, -1
+        dK[4, self.xa, self.ua], dK[4, self.xi, self.ui], dK[4, self.xx, self.ux], dK[4, self.ux, self.uu] = 1, 1, 2, 1
+
+        # gamma
+        dK[5, self.xa, self.xa], dK[5, self.xi, self.xi], dK[5, self.xx, self.xx], dK[5, self.ux, self.ux] = -1, -1, -2, -1
+
+        return dK, dp
+
+    def solve(self, t, x0=None, jac=False):
+        """Solve the moment equations dx/dt = Kx + p analytically at the time points t from one eigendecomposition of K.
+        If jac is True, the sensitivities of the solution with respect to the six parameters are also computed and
+        stored in self.dx (dimension: len(t) x 6 x n_species)."""
         t0 = t[0]
         if x0 is None:
             x0 = self.x0
@@ -209,15 +253,55 @@ class moments:
         D, U = linalg.eig(K)
         V = linalg.inv(U)
         D, U, V = map(real, (D, U, V))
-        expD = exp(D)
-        x = zeros((len(t), self.n_species))
+        dt = asarray(t, dtype=float) - t0
+        expDt = exp(outer(dt, D))   # propagators of all time points in the eigenbasis
+        w = V.dot(y0)
+        x = (expDt * w).dot(U.T) - x_ss
         x[0] = x0
-        for i in range(1, len(t)):
-            x[i] = U.dot(diag(expD**(t[i]-t0))).dot(V).dot(y0) - x_ss
         self.x = x
         self.t = t
+
+        if jac:
+            dK, dp = self.computeKnp_jac()
+            dx_ss = linalg.solve(K, (dp - dK.dot(x_ss)).T).T   # (6, n_species)
+
+            # Frechet derivative of exp(K dt) in the eigenbasis: G_ij = (exp(D_i dt) - exp(D_j dt)) / (D_i - D_j),
+            # or dt * exp(D_i dt) for (numerically) equal eigenvalues
+            dD = D[:, None] - D[None, :]
+            same = abs(dD) < 1e-10 * maximum(1, abs(D[:, None]))
+            with errstate(divide='ignore', invalid='ignore'):
+                G = where(same, dt[:, None, None] * expDt[:, :, None],
+                          (expDt[:, :, None] - expDt[:, None, :]) / where(same, 1, dD))
+            B = einsum('ij,kjl,lm->kim', V, dK, U)   # V dK U for each parameter
+            dx = einsum('tij,kij,j->tki', G, B, w) + expDt[:, None, :] * dx_ss.dot(V.T)
+            dx = dx.dot(U.T) - dx_ss
+            dx[0] = 0
+            self.dx = dx
+
         return x
 
+    def get_central_moments_jac(self, experiment_type=None):
+        """Jacobian (dimension: n_moments x len(t) x 6) of get_all_central_moments (experiment_type None) or
+        get_nosplice_central_moments (experiment_type 'nosplice') with respect to the six parameters. Requires
+        solve(t, jac=True)."""
+        a, b, x, dx = self.a, self.b, self.x, self.dx
+        ab2 = (a + b)**2
+        # derivatives of the weights b/(a+b) and a/(a+b) of fbar
+        dwa, dwi = zeros(6), zeros(6)
+        dwa[0], dwa[1], dwi[0], dwi[1] = -b / ab2, a / ab2, b / ab2, -a / ab2
+
+        nu, nx = self.get_nu(), self.get_nx()
+        dnu = self.fbar(dx[:, :, self.ua], dx[:, :, self.ui]) + outer(x[:, self.ua], dwa) + outer(x[:, self.ui], dwi)
+        dnx = self.fbar(dx[:, :, self.xa], dx[:, :, self.xi]) + outer(x[:, self.xa], dwa) + outer(x[:, self.xi], dwi)
+        dvar_nu = dx[:, :, self.uu] + (1 - 2 * nu)[:, None] * dnu
+        dvar_nx = dx[:, :, self.xx] + (1 - 2 * nx)[:, None] * dnx
+
+        if experiment_type is None:
+            return array([dnu, dnx, dvar_nu, dvar_nx])
+        elif experiment_type == 'nosplice':
+            dcov_ux = dx[:, :, self.ux] - nx[:, None] * dnu - nu[:, None] * dnx
+            return array([dnu + dnx, dvar_nu + dvar_nx + 2 * dcov_ux])
+
 class estimation:
     def __init__(self, ranges, x0=None):
         self.ranges = ranges
@@ -226,24 +310,25 @@ class estimation:
         if not x0 is None:
             self.simulator.x0 = x0
 
-    def sample_p0(self, samples=1, method='lhs'):
+    def sample_p0(self, samples=1, method='lhs', random_state=None):
         ret = zeros((samples, self.n_params))
         if method == 'lhs':
-            ret = self._lhsclassic(samples)
+            ret = self._lhsclassic(samples, random_state)
             for i in range(self.n_params):
                 ret[:, i] = ret[:, i] * (self.ranges[i][1] - self.ranges[i][0]) + self.ranges[i][0]
         else:
+            rng = random if random_state is None else random.RandomState(random_state) if isscalar(random_state) else random_state
             for n in range(samples):
                 for i in range(self.n_params):
-                    r = random.rand()
+                    r = rng.rand()
                     ret[n, i] = r * (self.ranges[i][1] - self.ranges[i][0]) + self.ranges[i][0]
         return ret
 
-    def _lhsclassic(self, samples):
+    def _lhsclassic(self, samples, random_state=None):
         # From PyDOE
         # Generate the intervals
         from .utils import lhsclassic
-        H = lhsclassic(samples, self.n_params)
+        H = lhsclassic(samples, self.n_params, random_state)
 
         return H
 
@@ -276,9 +361,27 @@ class estimation:
         ret[isnan(ret)] = 0
         return ret - x_data_norm
 
-    def fit_lsq(self, t, x_data, p0=None, n_p0=1, bounds=None, sample_method='lhs', method='analytical', normalize=True, experiment_type=None):
+    def jac_lsq(self, params, t, x_data_norm, method='analytical', normalize=True, experiment_type=None):
+        """Analytical Jacobian of f_lsq with respect to the six parameters, computed from the forward sensitivities of the
+        analytical solution of the moment equations."""
+        self.simulator.set_params(*params)
+        self.simulator.solve(t, self.simulator.x0, jac=True)
+        if experiment_type is None:
+            ret = self.simulator.get_all_central_moments()
+        elif experiment_type == 'nosplice':
+            ret = self.simulator.get_nosplice_central_moments()
+        jac = self.simulator.get_central_moments_jac(experiment_type)
+        if normalize:
+            jac = jac / (ret + 1)[:, :, None]
+            ret = self.normalize_data(ret)
+        jac = jac.reshape((-1, self.n_params))
+        jac[isnan(ret.flatten())] = 0
+        jac[isnan(jac)] = 0
+        return jac
+
+    def fit_lsq(self, t, x_data, p0=None, n_p0=1, bounds=None, sample_method='lhs', method='analytical', normalize=True, experiment_type=None, random_state=None, jac=None):
         if p0 is None:
-            p0 = self.sample_p0(n_p0, sample_method)
+            p0 = self.sample_p0(n_p0, sample_method, random_state)
         else:
             if p0.ndim == 1:
                 p0 = [p0]
@@ -289,10 +392,18 @@ class estimation:
         if bounds is None:
             bounds = (self.get_bound(0), self.get_bound(1))
         
+        # the analytical Jacobian needs only one eigendecomposition instead of one per parameter for finite differences
+        if jac is None:
+            jac = 'analytical' if method == 'analytical' else '2-point'
+        if jac == 'analytical':
+            jac_fun = lambda p: self.jac_lsq(p, t, x_data_norm.flatten(), method, normalize=True, experiment_type=experiment_type)
+        else:
+            jac_fun = jac
+
         costs = zeros(n_p0)
         X = []
         for i in range(n_p0):
-            ret = least_squares(lambda p: self.f_lsq(p, t, x_data_norm.flatten(), method, normalize=True, experiment_type=experiment_type), p0[i], bounds=bounds)
+            ret = least_squares(lambda p: self.f_lsq(p, t, x_data_norm.flatten(), method, normalize=True, experiment_type=experiment_type), p0[i], bounds=bounds, jac=jac_fun)
             costs[i] = ret.cost
             X.append(ret.x)
         i_min = argmin(costs)
@@ -2,7 +2,7 @@ import numpy as np
 from scipy.optimize import least_squares
 from scipy.sparse import issparse, csr_matrix
 from warnings import warn
-from .utils import cal_12_mom
+from .utils import cal_12_mom, _get_chunk_size, _get_n_jobs
 from .moments import strat_mom
 # from sklearn.cluster import KMeans
 # from sklearn.neighbors import NearestNeighbors
@@ -223,6 +223,142 @@ def fit_linreg(x, y, intercept=True):
     r2 = 1 - SS_res_n / SS_tot_n
     return k, b, r2
 
+def fit_linreg_rows(x, y, intercept=True):
+    """Row-wise simple linear regression y[i] = k[i] x[i] + b[i] for two dense matrices without missing values.
+
+    This gives exactly the same results as calling :func:`fit_linreg` on each pair of rows.
+
+    Arguments
+    ---------
+    x: :class:`~numpy.ndarray`
+        A matrix of independent variables. Dimension: genes x samples.
+    y: :class:`~numpy.ndarray`
+        A matrix of dependent variables. Dimension: genes x samples.
+    intercept: bool
+        True -- the linear regression is performed with an unfixed intercept;
+        False -- the linear regresssion is performed with a fixed zero intercept.
+
+    Returns
+    -------
+    k: :class:`~numpy.ndarray`
+        The estimated slopes.
+    b: :class:`~numpy.ndarray`
+        The estimated intercepts.
+    r2: :class:`~numpy.ndarray`
+        Coefficients of determination or r square.
+    """
+    ym = np.mean(y, 1)
+    xm = np.mean(x, 1)
+
+    if intercept:
+        cov = np.mean(x * y, 1) - xm * ym
+        var_x = np.mean(x * x, 1) - xm * xm
+        k = cov / var_x
+        b = ym - k * xm
+    else:
+        k = ym / xm
+        b = np.zeros(len(k))
+
+    SS_tot_n = np.var(y, 1)
+    SS_res_n = np.mean((y - k[:, None] * x - b[:, None]) ** 2, 1)
+    r2 = 1 - SS_res_n / SS_tot_n
+    return k, b, r2
+
+
+def _fit_gamma_steady_state_block(u, s, intercept=True, perc_left=5, perc_right=5):
+    """Steady state regression of u on s for a dense block of genes (genes x cells), see
+    :func:`fit_gamma_steady_state_genes`."""
+    n = u.shape[1]
+    i_left = int(perc_left/100.0*n) if perc_left is not None else n
+    i_right = int((100-perc_right)/100.0*n) if perc_right is not None else 0
+    mask = np.zeros(n, dtype=bool)
+    mask[:i_left] = mask[i_right:] = True
+
+    extreme_ind = np.argsort(s + u, axis=1)[:, mask]
+    # C order makes the row reductions sum in the same (pairwise) order as for a single gene
+    x = np.ascontiguousarray(np.take_along_axis(s, extreme_ind, 1))
+    y = np.ascontiguousarray(np.take_along_axis(u, extreme_ind, 1))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k, b, r2 = fit_linreg_rows(x, y, intercept)
+
+    # genes with missing values are fitted on the remaining samples one by one
+    for i in np.where(np.isnan(x).any(1) | np.isnan(y).any(1))[0]:
+        k[i], b[i], r2[i] = fit_linreg(x[i], y[i], intercept)
+
+    return k, b, r2
+
+
+def _fit_gamma_steady_state_chunk(args):
+    u, s, intercept, perc_left, perc_right = args
+    u = u.toarray() if issparse(u) else np.asarray(u)
+    s = s.toarray() if issparse(s) else np.asarray(s)
+
+    return _fit_gamma_steady_state_block(u, s, intercept, perc_left, perc_right)
+
+
+def fit_gamma_steady_state_genes(U, S, intercept=True, perc_left=5, perc_right=5, chunk_size=None, n_jobs=1):
+    """Estimate gamma of all genes at once using linear regression based on the steady state assumption.
+
+    The cells in the extreme quantiles of s + u are selected for each gene and the slope, intercept and r square of the
+    regression of u on s are computed for blocks of genes in vectorized passes. Sparse matrices are not fitted directly
+    on the CSR data: each block of genes is densified (chunk_size x n_cells) before it is fitted, so the peak memory is
+    bounded by the block size rather than by the whole matrix. The results are identical to calling
+    `estimation.fit_gamma_steady_state` for each gene.
+
+    Arguments
+    ---------
+    U: :class:`~numpy.ndarray` or sparse `csr_matrix` / `csc_matrix`
+        A matrix of unspliced mRNA counts. Dimension: genes x cells.
+    S: :class:`~numpy.ndarray` or sparse `csr_matrix` / `csc_matrix`
+        A matrix of spliced mRNA counts. Dimension: genes x cells.
+    intercept: bool
+        If using steady state assumption for fitting, then:
+        True -- the linear regression is performed with an unfixed intercept;
+        False -- the linear regresssion is performed with a fixed zero intercept.
+    perc_left: float
+        The percentage of samples included in the linear regression in the left tail. If set to None, then all the samples are included.
+    perc_right: float
+        The percentage of samples included in the linear regression in the right tail. If set to None, then all the samples are included.
+    chunk_size: int or None (default: None)
+        The number of genes processed (and densified) in one block. By default, blocks of about 2^24 matrix elements
+        are used.
+    n_jobs: int (default: 1)
+        The number of processes used to fit the blocks of genes in parallel. Negative values follow the joblib
+        convention, e.g. -1 means using all cores and -2 all cores but one.
+
+    Returns
+    -------
+    k: :class:`~numpy.ndarray`
+        The slopes of the linear regression model, which are gamma under the steady state assumption.
+    b: :class:`~numpy.ndarray`
+        The intercepts of the linear regression model.
+    r2: :class:`~numpy.ndarray`
+        Coefficients of determination or r square.
+    """
+    if issparse(U): U = U.tocsr()
+    if issparse(S): S = S.tocsr()
+
+    n_genes, n_cells = U.shape
+    chunk_size = _get_chunk_size(n_cells, chunk_size, max_elements=2**24)
+    chunks = [(U[i:i + chunk_size], S[i:i + chunk_size], intercept, perc_left, perc_right) for i in range(0, n_genes, chunk_size)]
+
+    n_jobs = _get_n_jobs(n_jobs)
+    if n_jobs > 1 and len(chunks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            res = list(executor.map(_fit_gamma_steady_state_chunk, chunks))
+    else:
+        res = [_fit_gamma_steady_state_chunk(chunk) for chunk in chunks]
+
+    if len(res) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    k, b, r2 = [np.hstack(i) for i in zip(*res)]
+
+    return k, b, r2
+
+
 def fit_first_order_deg_lsq(t, l, bounds=(0, np.inf), fix_l0=False, beta_0=1):
     """Estimate beta with degradation data using least squares method.
 
@@ -839,7 +975,7 @@ class estimation:
                           'delta_r2': None, "uu0": None, "ul0": None, "su0": None, "sl0": None, 'U0': None, 'S0': None, 'total0': None} # note that alpha_intercept also corresponds to u0 in fit_alpha_degradation, similar to fit_first_order_deg_lsq
         self.ind_for_proteins = ind_for_proteins
 
-    def fit(self, intercept=True, perc_left=5, perc_right=5, clusters=None):
+    def fit(self, intercept=True, perc_left=5, perc_right=5, clusters=None, n_jobs=1):
         """Fit the input data to estimate all or a subset of the parameters
 
         Arguments
@@ -854,27 +990,25 @@ class estimation:
             The percentage of samples included in the linear regression in the right tail. If set to None, then all the samples are included.
         clusters: `list`
             A list of n clusters, each element is a list of indices of the samples which belong to this cluster.
+        n_jobs: `int` (default: 1)
+            The number of processes used for the steady state regressions of blocks of genes.
         """
         n = self.get_n_genes()
         # fit mRNA
         if self.asspt_mRNA == 'ss':
             if np.all(self._exist_data('uu', 'su')):
                 self.parameters['beta'] = np.ones(n)
-                gamma, gamma_intercept, gamma_r2 = np.zeros(n), np.zeros(n), np.zeros(n)
                 U = self.data['uu'] if self.data['ul'] is None else self.data['uu'] + self.data['ul']
                 S = self.data['su'] if self.data['sl'] is None else self.data['su'] + self.data['sl']
-                for i in range(n):
-                    gamma[i], gamma_intercept[i], gamma_r2[i] = self.fit_gamma_steady_state(U[i], S[i],
-                            intercept, perc_left, perc_right)
+                gamma, gamma_intercept, gamma_r2 = fit_gamma_steady_state_genes(U, S, intercept, perc_left, perc_right,
+                                                                                n_jobs=n_jobs)
                 self.parameters['gamma'], self.aux_param['gamma_intercept'], self.aux_param['gamma_r2'] = gamma, gamma_intercept, gamma_r2
             elif np.all(self._exist_data('uu', 'ul')):
                 self.parameters['beta'] = np.ones(n)
-                gamma, gamma_intercept, gamma_r2 = np.zeros(n), np.zeros(n), np.zeros(n)
                 U = self.data['ul']
                 S = self.data['uu'] + self.data['ul']
-                for i in range(n):
-                    gamma[i], gamma_intercept[i], gamma_r2[i] = self.fit_gamma_steady_state(U[i], S[i],
-                            intercept, perc_left, perc_right)
+                gamma, gamma_intercept, gamma_r2 = fit_gamma_steady_state_genes(U, S, intercept, perc_left, perc_right,
+                                                                                n_jobs=n_jobs)
                 self.parameters['gamma'], self.aux_param['gamma_intercept'], self.aux_param['gamma_r2'] = gamma, gamma_intercept, gamma_r2
         else:
             if self.extyp == 'deg':
@@ -1004,14 +1138,12 @@ class estimation:
 
             if self.asspt_prot == 'ss' and n > 0:
                 self.parameters['eta'] = np.ones(n)
-                delta, delta_intercept, delta_r2 = np.zeros(n), np.zeros(n), np.zeros(n)
 
                 s = self.data['su'][ind_for_proteins] + self.data['sl'][ind_for_proteins] \
                     if self._exist_data('sl') else self.data['su'][ind_for_proteins]
 
-                for i in range(n):
-                    delta[i], delta_intercept[i], delta_r2[i] = self.fit_gamma_steady_state(s[i], self.data['p'][i],
-                            intercept, perc_left, perc_right)
+                delta, delta_intercept, delta_r2 = fit_gamma_steady_state_genes(s, self.data['p'][:n], intercept,
+                                                                                perc_left, perc_right, n_jobs=n_jobs)
                 self.parameters['delta'], self.aux_param['delta_intercept'], self.aux_param['delta_r2'] = delta, delta_intercept, delta_r2
 
     def fit_gamma_steady_state(self, u, s, intercept=True, perc_left=5, perc_right=5):
@@ -1045,8 +1177,8 @@ class estimation:
         s = s.A.flatten() if issparse(s) else s.flatten()
 
         n = len(u)
-        i_left = np.int(perc_left/100.0*n) if perc_left is not None else n
-        i_right = np.int((100-perc_right)/100.0*n) if perc_right is not None else 0
+        i_left = int(perc_left/100.0*n) if perc_left is not None else n
+        i_right = int((100-perc_right)/100.0*n) if perc_right is not None else 0
         mask = np.zeros(n, dtype=bool)
         mask[:i_left] = mask[i_right:] = True
         extreme_ind = np.argsort(s + u)[mask]
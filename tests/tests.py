@@ -1,6 +1,7 @@
 import dynamo as dyn
 import numpy as np
 import scipy.io
+import pytest
 from scipy import optimize
 
 def VecFnc(input, n=4,
@@ -163,3 +164,814 @@ def test_Ao_LAP():
 
 
 
+
+
+def _kmc_P_reference(X, V, M_diff, Idx, epsilon=None, adaptive_local_kernel=False, tol=1e-4):
+    """Per-cell loop of the original KernelMarkovChain.fit, kept as a reference for the vectorized implementation."""
+    from dynamo.tools.Markov import compute_drift_kernel, compute_drift_local_kernel, compute_density_kernel
+
+    n = X.shape[0]
+    P = np.zeros((n, n))
+    if epsilon is not None:
+        Kd = np.zeros((n, n))
+        for i in range(n):
+            Kd[i, Idx[i]] = compute_density_kernel(X[i], X[Idx[i]], 1 / epsilon)
+        D = Kd.sum(0)
+
+    inv_s = np.linalg.inv(M_diff)
+    for i in range(n):
+        if adaptive_local_kernel:
+            k, _ = compute_drift_local_kernel(X[i], V[i], X[Idx[i]], inv_s)
+        else:
+            k = compute_drift_kernel(X[i], V[i], X[Idx[i]], inv_s)
+        if epsilon is not None:
+            k = k / D[Idx[i]]
+        p = k / np.sum(k)
+        p[p <= tol] = 0
+        P[Idx[i], i] = p / np.sum(p)
+
+    return P
+
+
+def test_kmc_fit():
+    """Test the vectorized KernelMarkovChain.fit against the original per-cell loop."""
+    from sklearn.neighbors import NearestNeighbors
+    from dynamo.tools.Markov import KernelMarkovChain
+
+    rng = np.random.RandomState(0)
+    X = rng.randn(200, 2)
+    V = np.c_[-X[:, 1], X[:, 0]] + 0.1 * rng.randn(200, 2)
+    M_diff = 0.5 * np.eye(2)
+    Idx = NearestNeighbors(n_neighbors=20).fit(X).kneighbors(X)[1]
+
+    for epsilon in [None, 0.5]:
+        for adaptive_local_kernel in [False, True]:
+            kmc = KernelMarkovChain()
+            kmc.fit(X, V, M_diff, neighbor_idx=Idx, epsilon=epsilon, adaptive_local_kernel=adaptive_local_kernel,
+                    chunk_size=37)
+            P = _kmc_P_reference(X, V, M_diff, Idx, epsilon, adaptive_local_kernel)
+            assert np.allclose(kmc.P.toarray(), P)
+
+
+def _velocity_adata(n_cells=300, n_neighbors=15, seed=0):
+    """A small AnnData with a pca basis, a pca velocity, an embedding and a kNN graph for cell_velocities."""
+    from anndata import AnnData
+    from scipy.sparse import csr_matrix
+    from sklearn.neighbors import NearestNeighbors
+
+    rng = np.random.RandomState(seed)
+    X_pca = rng.normal(size=(n_cells, 5))
+    adata = AnnData(np.zeros((n_cells, 3)))
+    adata.obsm['X_pca'], adata.obsm['X_umap'] = X_pca, X_pca[:, :2]
+    adata.obsm['_velocity_pca'] = 0.1 * X_pca[:, [1, 0, 2, 3, 4]] * [1, -1, 1, 1, 1]
+    dist, idx = NearestNeighbors(n_neighbors=n_neighbors).fit(X_pca).kneighbors(X_pca)
+    graph = csr_matrix((dist.ravel(), idx.ravel(), np.arange(0, n_cells * n_neighbors + 1, n_neighbors)),
+                       shape=(n_cells, n_cells))
+    adata.uns['neighbors'] = {'connectivities': graph, 'distances': graph, 'indices': idx}
+
+    return adata
+
+
+def test_cell_velocities_n_jobs():
+    """The analytical projection does not depend on n_jobs and leaves the stored velocity untouched."""
+    results = []
+    for n_jobs in [1, 2]:
+        adata = _velocity_adata()
+        V = adata.obsm['_velocity_pca'].copy()
+        dyn.tl.cell_velocities(adata, vkey='pca', basis='umap', xy_grid_nums=(10, 10), calc_rnd_vel=True,
+                               n_jobs=n_jobs, chunk_size=37)
+        assert np.array_equal(adata.obsm['_velocity_pca'], V)
+        results.append(adata)
+
+    for key in ['transition_matrix', 'transition_matrix_rnd']:
+        assert np.allclose(results[0].uns[key].toarray(), results[1].uns[key].toarray())
+    for key in ['velocity_umap', 'velocity_umap_rnd']:
+        assert np.allclose(results[0].obsm[key], results[1].obsm[key])
+    assert np.allclose(results[0].uns['grid_velocity_umap']['V_grid'], results[1].uns['grid_velocity_umap']['V_grid'])
+
+
+def test_fit_gamma_steady_state_genes():
+    """Test the vectorized steady state regression against the per-gene fit_gamma_steady_state loop."""
+    from scipy.sparse import csr_matrix, csc_matrix
+    from dynamo.tools.velocity import estimation, fit_gamma_steady_state_genes
+
+    rng = np.random.RandomState(0)
+    S = rng.poisson(3, size=(30, 200)).astype(float)
+    U = 0.5 * S + rng.poisson(1, size=(30, 200))
+    fit_gamma = estimation().fit_gamma_steady_state
+
+    for intercept, perc_left in [(True, 5), (False, None)]:
+        ref = np.array([fit_gamma(U[i], S[i], intercept, perc_left, 5) for i in range(30)]).T
+        for fmt in [np.asarray, csr_matrix, csc_matrix]:
+            for n_jobs in [1, 2]:
+                res = fit_gamma_steady_state_genes(fmt(U), fmt(S), intercept, perc_left, 5, chunk_size=7, n_jobs=n_jobs)
+                assert np.allclose(np.array(res), ref)
+
+    U[3, :5] = np.nan  # genes with missing values are fitted on the remaining samples
+    ref = np.array([fit_gamma(U[i], S[i]) for i in range(30)]).T
+    assert np.allclose(np.array(fit_gamma_steady_state_genes(U, S, chunk_size=7)), ref, equal_nan=True)
+
+
+def test_moments_jac():
+    """Test the analytical derivatives of the moment equations and of the least squares objective against central
+    finite differences."""
+    from dynamo.tools.utils_moments import moments, estimation
+
+    params, h = np.array([0.5, 0.3, 20, 2, 1, 0.5]), 1e-6
+    t = np.linspace(0, 5, 10)
+    dK, dp = moments(*params).computeKnp_jac()
+    for i in range(6):
+        dparams = h * np.eye(6)[i]
+        (K1, p1), (K0, p0) = moments(*(params + dparams)).computeKnp(), moments(*(params - dparams)).computeKnp()
+        assert np.allclose(dK[i], (K1 - K0) / (2 * h), atol=1e-6) and np.allclose(dp[i], (p1 - p0) / (2 * h), atol=1e-6)
+
+    est = estimation([[0, 1]] * 6)
+    for experiment_type in [None, 'nosplice']:
+        x_data = np.zeros(len(t) * (4 if experiment_type is None else 2))
+        jac = est.jac_lsq(params, t, x_data, experiment_type=experiment_type)
+        fd = np.array([est.f_lsq(params + h * np.eye(6)[i], t, x_data, experiment_type=experiment_type)
+                       - est.f_lsq(params - h * np.eye(6)[i], t, x_data, experiment_type=experiment_type)
+                       for i in range(6)]).T / (2 * h)
+        assert np.allclose(jac, fd, rtol=1e-4, atol=1e-6)
+
+
+def test_strat_12_mom():
+    """Test the per stratum moments of all features against the per-feature strat_mom loop."""
+    from scipy.sparse import csr_matrix, csc_matrix
+    from dynamo.tools.moments import strat_mom, strat_12_mom
+
+    rng = np.random.RandomState(0)
+    X = rng.poisson(2, size=(20, 100)).astype(float)
+    strata = rng.choice([4., 1., 2.5], 100)
+    X[2, :10] = np.nan
+
+    for has_nan, mean, var in [(False, np.mean, np.var), (True, np.nanmean, np.nanvar)]:
+        X_ = X if has_nan else np.nan_to_num(X)
+        M_ref = np.array([strat_mom(x, strata, mean) for x in X_])
+        V_ref = np.array([strat_mom(x, strata, var) for x in X_])
+        for fmt in [np.asarray, csr_matrix, csc_matrix]:
+            M, V, uniq = strat_12_mom(fmt(X_), strata, has_nan)
+            assert np.array_equal(uniq, [1., 2.5, 4.])
+            assert np.allclose(M, M_ref) and np.allclose(V, V_ref)
+
+
+def test_recipe_monocle_chunked(tmp_path):
+    """recipe_monocle_chunked gives the same obs/var columns, normalized feature genes and X_pca as recipe_monocle."""
+    from anndata import AnnData, read_h5ad
+    from scipy.sparse import csr_matrix
+
+    rng = np.random.RandomState(0)
+    mu = rng.gamma(1, 2, size=200)
+    S = rng.poisson(mu * rng.uniform(0.5, 2, size=(300, 1))).astype(float)
+    U = rng.poisson(0.3 * mu * rng.uniform(0.5, 2, size=(300, 1))).astype(float)
+
+    def make_adata():
+        adata = AnnData(csr_matrix(S + U), layers={'spliced': csr_matrix(S), 'unspliced': csr_matrix(U)})
+        adata.var_names = ['gene_' + str(i) for i in range(200)]
+        return adata
+
+    adata = dyn.pp.recipe_monocle(make_adata(), n_top_genes=50, num_dim=10)
+    adata_chunked = make_adata()
+    feature_adata = dyn.pp.recipe_monocle_chunked(adata_chunked, n_top_genes=50, num_dim=10, chunk_size=64)
+
+    for key in ['Size_Factor', 'spliced_Size_Factor', 'unspliced_Size_Factor']:
+        assert np.allclose(adata.obs[key], adata_chunked.obs[key])
+    for key in ['pass_basic_filter', 'use_for_dynamo']:
+        assert np.array_equal(adata.var[key], adata_chunked.var[key])
+    for key in ['log_m', 'log_cv']:
+        assert np.allclose(adata.var[key], adata_chunked.var[key], equal_nan=True)
+    # the SVR is only solved to the tolerance of libsvm (1e-3), which amplifies round-off differences of its inputs
+    assert np.allclose(adata.var['score'], adata_chunked.var['score'], atol=1e-2, equal_nan=True)
+
+    feature_genes = adata.var_names[adata.var['use_for_dynamo']]
+    assert np.array_equal(feature_adata.var_names, feature_genes)
+    for key in ['X_spliced', 'X_unspliced']:
+        assert np.allclose(adata[:, feature_genes].layers[key].toarray(), feature_adata.layers[key].toarray())
+    assert np.allclose(adata[:, feature_genes].X.toarray(), feature_adata.X.toarray())
+    assert np.allclose(adata.obsm['X_pca'], feature_adata.obsm['X_pca'])
+
+    make_adata().write_h5ad(tmp_path / 'adata.h5ad')
+    adata_backed = read_h5ad(tmp_path / 'adata.h5ad', backed='r')
+    with pytest.raises(Exception):
+        dyn.pp.recipe_monocle(adata_backed)
+    feature_adata_backed = dyn.pp.recipe_monocle_chunked(adata_backed, n_top_genes=50, num_dim=10)
+    assert np.allclose(feature_adata_backed.obsm['X_pca'], feature_adata.obsm['X_pca'])
+
+
+def test_summary_stats_cache():
+    """The cached summary statistics are recomputed after an in-place edit, for a subset and for a rounded request of
+    non-integer data, and the cached gene moments agree with the direct computation."""
+    from anndata import AnnData
+    from scipy.sparse import csr_matrix
+    from dynamo.preprocessing.preprocess import _get_layer_stats, _gene_moments
+
+    rng = np.random.RandomState(0)
+    X = rng.poisson(2, size=(100, 20)) * rng.choice([0.4, 1], size=(100, 20))
+    adata = AnnData(csr_matrix(X))
+    dyn.pp.summary_stats(adata, layers='X')
+    stats = adata.uns['summary_stats']['X']
+    assert np.allclose(stats['gene_sum'], X.sum(0)) and not stats['is_integer']
+    assert _get_layer_stats(adata, 'X') is stats
+
+    adata.X.data[0] += 5
+    X[adata.X.nonzero()[0][0], adata.X.nonzero()[1][0]] += 5
+    stats = _get_layer_stats(adata, 'X')
+    assert np.allclose(stats['gene_sum'], X.sum(0))
+
+    subset = adata[:50].copy()
+    assert 'summary_stats' in subset.uns.keys()
+    assert np.allclose(_get_layer_stats(subset, 'X')['gene_sum'], X[:50].sum(0))
+    assert np.allclose(_get_layer_stats(adata[:50], 'X')['cell_total'], X[:50].sum(1))
+
+    stats_rounded = _get_layer_stats(adata, 'X', round_exprs=True)
+    assert np.allclose(stats_rounded['gene_sum'], X.round().sum(0)) and not np.allclose(X.round().sum(0), X.sum(0))
+    assert _get_layer_stats(adata, 'X') is not stats_rounded
+
+    for szfactors in [X.sum(1) / X.sum(1).mean(), rng.uniform(0.5, 2, size=100)]:
+        _, mean, mean_sq = _gene_moments(adata, 'X', szfactors)
+        X_norm = X / szfactors[:, None]
+        assert np.allclose(mean, X_norm.mean(0)) and np.allclose(mean_sq, (X_norm ** 2).mean(0))
+
+
+def test_dispersion_svr():
+    """Dispersion and SVRs give the same results for dense and sparse data and for a view, and the SVR inputs are the
+    moments of the size factor normalized data."""
+    from anndata import AnnData
+    from scipy.sparse import csr_matrix
+    from dynamo.preprocessing.preprocess import SVRs
+
+    rng = np.random.RandomState(0)
+    mu = rng.gamma(1, 2, size=100)
+    S = rng.poisson(mu * rng.uniform(0.5, 2, size=(200, 1))).astype(float)
+
+    adata_sparse, adata_dense = AnnData(csr_matrix(S), layers={'spliced': csr_matrix(S)}), AnnData(S, layers={'spliced': S})
+    for adata in [adata_sparse, adata_dense]:
+        dyn.pp.szFactor(adata)
+        dyn.pp.Dispersion(adata, layers=['X', 'spliced'])
+        SVRs(adata, layers=['spliced'], min_expr_cells=0)
+
+    for key in ['dispFitInfo', 'spliced_dispFitInfo']:
+        assert np.allclose(adata_sparse.uns[key]['coefs'], adata_dense.uns[key]['coefs'])
+    for key in ['log_m', 'log_cv', 'score']:
+        assert np.allclose(adata_sparse.var[key], adata_dense.var[key], equal_nan=True)
+
+    S_norm = S / adata_dense.obs['spliced_Size_Factor'].values[:, None]
+    detected = S_norm.mean(0) > 0
+    assert np.allclose(adata_dense.var['log_m'][detected], np.log2(S_norm.mean(0)[detected]))
+    assert np.allclose(adata_dense.var['log_cv'][detected], np.log2(S_norm.std(0)[detected] / S_norm.mean(0)[detected]))
+
+    adata_view = adata_sparse[:150]
+    adata_copy = adata_view.copy()
+    dyn.pp.Dispersion(adata_view)
+    dyn.pp.Dispersion(adata_copy)
+    assert np.allclose(adata_view.uns['dispFitInfo']['coefs'], adata_copy.uns['dispFitInfo']['coefs'])
+
+
+def _clr_normalize_reference(CM):
+    """Per-feature loop of the original centered log-ratio normalization, kept as a reference for the vectorized one."""
+    CM = np.array(CM, dtype=float).T
+    n_feature = CM.shape[1]
+
+    for i in range(CM.shape[0]):
+        x = CM[i]
+        res = np.log1p(x / (np.exp(np.nansum(np.log1p(x[x > 0])) / n_feature)))
+        res[np.isnan(res)] = 0
+        CM[i] = res
+
+    return CM.T
+
+
+def test_clr_normalize():
+    """Test the vectorized centered log-ratio normalization against the per-feature loop, on a copy of the input."""
+    from scipy.sparse import csr_matrix, csc_matrix
+    from dynamo.preprocessing.preprocess import _clr_normalize
+
+    rng = np.random.RandomState(0)
+    X = rng.poisson(1, size=(100, 20)).astype(float)
+    X[:, 3] = 0  # a feature without counts
+    ref = _clr_normalize_reference(X)
+
+    for fmt in [np.array, csr_matrix, csc_matrix]:
+        CM = fmt(X)
+        res = _clr_normalize(CM)
+        assert np.array_equal(CM.toarray() if fmt is not np.array else CM, X)
+        if fmt is not np.array:
+            assert res.format == CM.format
+            res = res.toarray()
+        assert np.allclose(res, ref)
+    assert np.allclose(_clr_normalize(csr_matrix(X), np.float32).toarray(), ref, atol=1e-6)
+
+
+def test_log_normalize():
+    """The normalized sparse layers don't share their arrays with the raw layers and match the dense normalization."""
+    from anndata import AnnData
+    from scipy.sparse import csr_matrix
+
+    rng = np.random.RandomState(0)
+    S = rng.poisson(1, size=(100, 20)).astype(float)
+    S_sparse = csr_matrix(S)
+    rows, cols = S_sparse.nonzero()
+    S_sparse.data[:5], S[rows[:5], cols[:5]] = 0, 0  # explicit zeros
+
+    adata = AnnData(S_sparse.copy(), layers={'spliced': S_sparse})
+    adata_dense = AnnData(S.copy(), layers={'spliced': S.copy()})
+    for adata_ in [adata, adata_dense]:
+        dyn.pp.normalize_expr_data(adata_, dtype=np.float32)
+
+    adata.layers['X_spliced'].eliminate_zeros()
+    assert np.array_equal(adata.layers['spliced'].toarray(), S)
+    assert adata.layers['X_spliced'].dtype == np.float32
+    assert np.allclose(adata.layers['X_spliced'].toarray(), adata_dense.layers['X_spliced'])
+
+
+def test_PCA():
+    """Without centering the PCA class reproduces TruncatedSVD, and the streaming and centered fits agree with the
+    exact decompositions up to the signs of the components."""
+    from scipy.sparse import csr_matrix
+    from sklearn.decomposition import TruncatedSVD, PCA as skPCA
+    from dynamo.tools.dimension_reduction import PCA
+
+    rng = np.random.RandomState(0)
+    X = rng.poisson(1, size=(300, 40)) * rng.uniform(0.5, 2, size=40)
+
+    svd = TruncatedSVD(n_components=10, random_state=2019)
+    Y_svd = svd.fit_transform(csr_matrix(X))
+    for X_ in [X, csr_matrix(X)]:
+        pca = PCA(n_components=10, random_state=2019)
+        assert np.allclose(pca.fit_transform(X_), Y_svd)
+        assert np.allclose(pca.components_, svd.components_)
+        assert np.allclose(pca.explained_variance_ratio_, svd.explained_variance_ratio_)
+
+    # the randomized SVD is only exact for a decaying spectrum
+    X = 3 + rng.normal(size=(300, 5)).dot(np.diag([10, 8, 6, 4, 2])).dot(rng.normal(size=(5, 40)))
+    X += 0.01 * rng.normal(size=X.shape)
+    sk_pca = skPCA(n_components=5, svd_solver='full').fit(X)
+    for method in ['randomized', 'streaming']:
+        pca = PCA(n_components=5, center=True, method=method, chunk_size=64).fit(csr_matrix(X))
+        signs = np.sign(np.sum(pca.components_ * sk_pca.components_, 1))
+        assert np.allclose(pca.components_ * signs[:, None], sk_pca.components_, atol=1e-6)
+        assert np.allclose(pca.explained_variance_ratio_, sk_pca.explained_variance_ratio_)
+        # the velocity projection equals PCA(X + V) - PCA(X)
+        V = rng.normal(size=X.shape)
+        assert np.allclose(pca.transform(X + V) - pca.transform(X), V.dot(pca.components_.T))
+
+
+def test_reduceDimension_PCs():
+    """reduceDimension projects the velocity on the loadings in varm rather than on those of pca_fit."""
+    from anndata import AnnData
+    from dynamo.tools.dimension_reduction import PCA
+
+    rng = np.random.RandomState(0)
+    adata = AnnData(rng.poisson(1, size=(100, 20)).astype(float), layers={'velocity_S': rng.normal(size=(100, 20))})
+    gene_bool = np.arange(20) % 2 == 0
+    adata.var['use_for_dynamo'] = gene_bool
+    adata.obsm['X_pca'] = rng.normal(size=(100, 5))
+    adata.varm['PCs'] = rng.normal(size=(20, 5)) * gene_bool[:, None]
+    adata.uns['pca_fit'] = PCA(n_components=6).fit(adata.X[:, gene_bool])
+
+    dyn.tl.reduceDimension(adata, n_pca_components=3, reduction_method='psl')
+    V = adata.layers['velocity_S'][:, gene_bool]
+    assert np.allclose(adata.obsm['_velocity_pca'], V.dot(adata.varm['PCs'][gene_bool, :3]))
+
+
+def test_psl_cg():
+    """The conjugate gradient solver of psl_py learns the same graph and embedding as the dense solver, up to the error
+    of the random projections."""
+    from scipy.spatial.distance import pdist
+    from dynamo.tools.psl import psl_py, logdet
+
+    rng = np.random.RandomState(0)
+    t = rng.uniform(0, 3, 300)
+    Y = np.c_[np.cos(t), np.sin(t), t, 0.05 * rng.normal(size=(300, 7))]
+
+    S, Z = psl_py(Y, solver='dense')
+    S_cg, Z_cg = psl_py(Y, solver='cg', n_probes=200)
+    S, S_cg = S.toarray(), S_cg.toarray()
+
+    assert np.array_equal(S > 0, S_cg > 0)
+    assert np.mean(np.abs(S - S_cg)[S > 0]) < 0.05 * np.mean(S[S > 0])
+    assert np.corrcoef(pdist(Z), pdist(Z_cg))[0, 1] > 0.999
+
+    # the exact solver is the default
+    assert np.array_equal(psl_py(Y)[0].toarray(), S)
+    A = Y.T.dot(Y) + np.eye(Y.shape[1])
+    assert np.isclose(logdet(A), np.linalg.slogdet(A)[1])
+
+
+def _empirical_vec_reference(X_pca, X_embedding, V_mat, indices, neg_cells_trick):
+    """Per-cell loop of the original correlation kernel, kept as a reference for the vectorized implementation."""
+    n, knn = X_pca.shape[0], indices.shape[1] - 1
+    vals = np.zeros((n, knn))
+    delta_X = np.zeros((n, X_embedding.shape[1]))
+    for i in range(n):
+        diff_velocity = np.sign(V_mat[i]) * np.sqrt(np.abs(V_mat[i]))
+        i_vals = np.zeros(knn)
+        for j in range(knn):
+            diff = X_pca[indices[i, j + 1]] - X_pca[i]
+            i_vals[j] = np.corrcoef(np.sign(diff) * np.sqrt(np.abs(diff)), diff_velocity)[0, 1]
+
+        numerator = X_embedding[indices[i, 1:]] - X_embedding[i]
+        numerator = numerator / np.linalg.norm(numerator, axis=1)[:, None]
+        if neg_cells_trick:
+            for sig in [-1, 1]:
+                cur_ind = np.where(np.sign(i_vals) == sig)[0]
+                if len(cur_ind) == 0:
+                    continue
+                exp_i_vals = np.exp(np.abs(i_vals[cur_ind]) / max(abs(i_vals[cur_ind])))
+                i_prob = exp_i_vals / sum(exp_i_vals)
+                vals[i, cur_ind] = sig * i_prob
+                delta_X[i] += 0.5 * (i_prob - 1 / len(cur_ind)).dot(sig * numerator[cur_ind])
+        else:
+            exp_i_vals = np.exp(i_vals / max(abs(i_vals)))
+            vals[i] = exp_i_vals / sum(exp_i_vals)
+            delta_X[i] = (vals[i] - 1 / knn).dot(numerator)
+
+    return vals, delta_X
+
+
+def test_empirical_vec():
+    """Test the vectorized correlation kernel in cell_velocities against the original per-cell loop."""
+    from sklearn.neighbors import NearestNeighbors
+    from dynamo.tools.cell_velocities import _empirical_vec
+
+    rng = np.random.RandomState(0)
+    X_pca, V_mat, X_embedding = rng.randn(200, 10), rng.randn(200, 10), rng.randn(200, 2)
+    nbrs = NearestNeighbors(n_neighbors=16).fit(X_pca)
+    _, indices = nbrs.kneighbors(X_pca)
+    neighbors = nbrs.kneighbors_graph(X_pca)
+
+    for neg_cells_trick in [False, True]:
+        vals, delta_X = _empirical_vec_reference(X_pca, X_embedding, V_mat, indices, neg_cells_trick)
+        for use_numba in [False, True]:
+            T, delta_X_vec, _, _, _ = _empirical_vec(X_pca, X_embedding, V_mat, indices, neg_cells_trick, (50, 50),
+                                                     neighbors, use_numba=use_numba, chunk_size=37)
+            T = T.toarray()
+            assert np.allclose(np.take_along_axis(T, indices[:, 1:], 1), vals)
+            assert np.allclose(delta_X_vec, delta_X)
+
+
+def _extract_indices_dist_from_graph_reference(graph, n_neighbors):
+    """Per-cell loop of the original kNN graph extraction, kept as a reference for the vectorized implementation."""
+    n_cells = graph.shape[0]
+    ind_mat = np.zeros((n_cells, n_neighbors), dtype=int)
+    dist_mat = np.zeros((n_cells, n_neighbors), dtype=graph.dtype)
+
+    for cur_cell in range(n_cells):
+        cur_neighbors = graph[cur_cell, :].nonzero()
+        ind_mat[cur_cell, 0] = cur_cell
+        dist_mat[cur_cell, 0] = 0
+
+        if len(cur_neighbors[1]) != n_neighbors - 1:
+            sorted_indices = np.argsort(graph[cur_cell][:, cur_neighbors[1]].A, kind='stable')[0][:(n_neighbors - 1)]
+            ind_mat[cur_cell, 1:] = cur_neighbors[1][sorted_indices]
+            dist_mat[cur_cell, 1:] = graph[cur_cell][0, cur_neighbors[1][sorted_indices]].A
+        else:
+            ind_mat[cur_cell, 1:] = cur_neighbors[1]
+            dist_mat[cur_cell, 1:] = graph[cur_cell][:, cur_neighbors[1]].A
+
+    return ind_mat, dist_mat
+
+
+def _symmetric_knn_graph(n_cells, n_neighbors, seed=0):
+    """A symmetrized kNN distance graph in which cells have n_neighbors - 1 or more neighbors, like the UMAP graph."""
+    from sklearn.neighbors import NearestNeighbors
+
+    X = np.random.RandomState(seed).randn(n_cells, 10)
+    graph = NearestNeighbors(n_neighbors=n_neighbors - 1).fit(X).kneighbors_graph(mode='distance')
+    return graph.maximum(graph.T).tocsr().astype(np.float32)
+
+
+def test_extract_indices_dist_from_graph():
+    """Test the vectorized kNN graph extraction against the original per-cell loop."""
+    from dynamo.tools.dimension_reduction import extract_indices_dist_from_graph
+
+    graph = _symmetric_knn_graph(500, 15)
+    graph[3, graph[3].indices[0]] = 0  # an explicitly stored zero is not a neighbor
+    ind_ref, dist_ref = _extract_indices_dist_from_graph_reference(graph, 15)
+    ind_mat, dist_mat = extract_indices_dist_from_graph(graph, 15)
+    assert np.array_equal(ind_mat, ind_ref) and np.array_equal(dist_mat, dist_ref)
+
+
+def bench_extract_indices_dist_from_graph(n_cells=20000, n_neighbors=30):
+    """Benchmark the vectorized kNN graph extraction against the original per-cell loop (run it manually)."""
+    import time
+    from dynamo.tools.dimension_reduction import extract_indices_dist_from_graph
+
+    graph = _symmetric_knn_graph(n_cells, n_neighbors)
+    start = time.time()
+    extract_indices_dist_from_graph(graph, n_neighbors)
+    vectorized = time.time() - start
+    start = time.time()
+    _extract_indices_dist_from_graph_reference(graph, n_neighbors)
+    reference = time.time() - start
+    print('{} cells: vectorized {:.3f}s, per-cell loop {:.3f}s ({:.0f}x)'.format(n_cells, vectorized, reference,
+                                                                                reference / vectorized))
+
+
+def test_DDRTree_fast():
+    """Without truncation, in double precision and with the complete graph among centers, the fast mode of DDRTree_py
+    follows the exact iterations."""
+    from dynamo.tools.DDRTree import DDRTree_py
+
+    rng = np.random.RandomState(0)
+    t = rng.uniform(0, 3, 300)
+    X = np.vstack([5 * np.cos(t), 5 * np.sin(t), t]) + 0.2 * rng.normal(size=(3, 300))
+    init = np.arange(0, 300, 30)  # the same initial centers for both modes
+    exact = DDRTree_py(X, 5, 0.001, 10, init=init)
+    fast = DDRTree_py(X, 5, 0.001, 10, init=init, fast=True, dtype=np.float64, R_tol=0, n_mst_neighbors=10)
+
+    assert np.allclose(exact[7], fast[7])
+    assert np.allclose(np.abs(exact[1]), np.abs(fast[1]))
+    assert np.allclose(exact[2], fast[2].toarray())
+    assert np.allclose(exact[3], fast[3].toarray())
+
+
+def test_velocity_grid():
+    """The sparse grid-to-cell map gives the same grid velocities and diffusion matrices as the neighbor gather."""
+    from sklearn.neighbors import NearestNeighbors
+    from scipy.stats import norm
+    from dynamo.tools.Markov import VelocityGrid, diffusionMatrix
+
+    rng = np.random.RandomState(0)
+    X, V = rng.normal(size=(1000, 3)), rng.normal(size=(1000, 3))
+    grid = VelocityGrid((8, 6, 5), n_neighbors=20, chunk_size=37).fit(X)
+    dists, neighs = NearestNeighbors(n_neighbors=20).fit(X).kneighbors(grid.X_grid_)
+    weight = norm.pdf(x=dists, scale=np.mean([g[1] - g[0] for g in grid.grs_]) * grid.smooth)
+    V_grid = (V[neighs] * weight[:, :, None]).sum(1) / np.maximum(1, weight.sum(1))[:, None]
+
+    assert grid.X_grid_.shape == (240, 3)
+    assert np.allclose(grid.transform(V), V_grid)
+    assert np.allclose(grid.diffusion(V), diffusionMatrix(V[neighs]))
+
+
+def test_diffusion():
+    """The sparse steady state solvers agree with the dense eigendecomposition and the stepped distribution with the
+    matrix power."""
+    from scipy.sparse import csr_matrix
+    from dynamo.tools.cell_velocities import diffusion
+
+    rng = np.random.RandomState(0)
+    M = rng.uniform(size=(300, 300)) * (rng.uniform(size=(300, 300)) < 0.05) + np.eye(300)
+    M /= M.sum(1)[:, None]
+    mu = diffusion(M, method='eig')
+
+    assert np.allclose(mu.dot(M), mu)
+    for method in ['arpack', 'gmres', 'power']:
+        assert np.allclose(diffusion(csr_matrix(M), method=method), mu, atol=1e-8)
+    assert np.allclose(diffusion(M, steps=5), np.mean(np.linalg.matrix_power(M, 6), 0))
+    assert np.allclose(diffusion(M, backward=True).dot(M.T / M.T.sum(1)[:, None]), diffusion(M, backward=True))
+
+    with pytest.warns(UserWarning, match='GMRES did not converge'):
+        assert np.allclose(diffusion(csr_matrix(M), method='gmres', tol=1e-16, maxiter=1), mu, atol=1e-8)
+
+
+def test_markov_trans_prob_batch():
+    """The batched NNLS active-set QP reaches the objective of the per-cell cvxopt QP."""
+    from cvxopt import solvers
+    from dynamo.tools.Markov import compute_markov_trans_prob, compute_markov_trans_prob_batch
+
+    solvers.options['show_progress'] = False
+    rng = np.random.RandomState(0)
+    D, V, s = rng.normal(size=(50, 15, 2)), 0.5 * rng.normal(size=(50, 2)), np.full(2, 0.3)
+
+    def objective(i, p):
+        scale = np.abs(np.max(D[i], 0) - np.min(D[i], 0))
+        A = np.hstack((D[i] / scale, 0.5 * (D[i] / scale) ** 2))
+        return 0.5 * np.sum((A.T.dot(p) - np.hstack((V[i] / scale, 0.5 * (s / scale) ** 2))) ** 2)
+
+    for cont_time in [False, True]:
+        P = compute_markov_trans_prob_batch(D, V, s, cont_time=cont_time)
+        assert np.all(P >= 0) and (cont_time or np.all(P.sum(1) <= 1 + 1e-12))
+        for i in range(len(D)):
+            p = compute_markov_trans_prob(np.zeros(2), V[i], D[i], s, cont_time=cont_time)
+            assert objective(i, P[i]) <= objective(i, p) + 1e-7
+
+
+def test_propagate_P():
+    """Cached powers of P and the mat-vec drift agree with the explicit matrix powers."""
+    from dynamo.tools.Markov import KernelMarkovChain
+
+    rng = np.random.RandomState(0)
+    X, V = rng.normal(size=(300, 2)), 0.1 * rng.normal(size=(300, 2))
+    kmc = KernelMarkovChain()
+    kmc.fit(X, V, 0.1 * np.eye(2), k=15)
+
+    P3 = kmc.P.dot(kmc.P).dot(kmc.P)
+    assert abs(kmc.propagate_P(3) - P3).max() < 1e-12
+    assert (3, None) in kmc._P_cache
+    Pt = kmc.propagate_P(3, threshold=1e-3)
+    assert Pt.nnz <= P3.nnz and np.allclose(Pt.sum(0), 1)
+
+    V3 = P3.T.dot(X) - X * np.asarray(P3.sum(0)).T
+    assert np.allclose(kmc.compute_drift(X, num_prop=3), V3)
+
+
+def test_density_corrected_drift():
+    """The vectorized and the numba density corrected drifts agree with the per-cell loop."""
+    from scipy.sparse import random as sparse_random
+    from dynamo.tools.Markov import density_corrected_drift
+
+    rng = np.random.RandomState(0)
+    X, Idx = rng.normal(size=(100, 3)), rng.randint(0, 100, size=(100, 8))
+    P = sparse_random(100, 100, density=0.3, format='csc', random_state=0)
+    P_dense = P.toarray()
+
+    for norm_ord in [None, 1, 'fro']:
+        V = np.zeros_like(X)
+        for i in range(100):
+            D = X[Idx[i]] - X[i]
+            if norm_ord is not None:
+                D = D / np.linalg.norm(D, norm_ord)
+            V[i] = D.T.dot(P_dense[Idx[i], i] - 1 / 8)
+        assert np.allclose(density_corrected_drift(X, Idx, P, norm_ord=norm_ord), V)
+        assert np.allclose(density_corrected_drift(X, Idx, P, norm_ord=norm_ord, use_numba=True), V)
+
+
+def test_diffusion_map_cache():
+    """Diffusion maps of other n_dims and t and the stationary distribution reuse the cached eigenpairs."""
+    from dynamo.tools.Markov import KernelMarkovChain
+
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(300, 2))
+    kmc = KernelMarkovChain()
+    kmc.fit(X, 0.1 * X[:, ::-1], 0.1 * np.eye(2), k=15)
+
+    Y = kmc.diffusion_map_embedding(n_dims=2, t=1)
+    D = kmc.D
+    Ys = kmc.diffusion_map_embedding(n_dims=4, t=[1, 2])
+    p = kmc.compute_stationary_distribution()
+    assert kmc.D is D and Ys.shape == (2, 300, 4) and np.allclose(Ys[0][:, :2], Y)
+    assert np.allclose(kmc.P.dot(p), p)
+
+    kmc.diffusion_map_embedding(n_dims=2, symmetrize=True)
+    assert kmc.D is not D and np.all(np.isreal(kmc.D)) and np.allclose(kmc.W[:, 0] / kmc.W[:, 0].sum(), p)
+
+
+def test_Gini():
+    """The Gini coefficients of a sparse layer (computed on the nonzero values) agree with those of the dense layer."""
+    from anndata import AnnData
+    from scipy.sparse import csr_matrix
+
+    rng = np.random.RandomState(0)
+    X = rng.poisson(0.5, size=(200, 30)).astype(float)
+    X[:, 0] = 0
+
+    adata_sparse, adata_dense = AnnData(csr_matrix(X)), AnnData(X)
+    dyn.pp.Gini(adata_sparse, layers='X', chunk_size=7)
+    dyn.pp.Gini(adata_dense, layers='X', n_jobs=2)
+    assert np.allclose(adata_sparse.var['gini'], adata_dense.var['gini'], atol=1e-12)
+
+
+def test_fate_integrators():
+    """The batched RK4 and RK45 integrators agree with the per-cell odeint integration of a vector field."""
+    from dynamo.tools.fate import fate
+
+    rng = np.random.RandomState(0)
+    VecFld = {'X': rng.normal(size=(20, 2)), 'beta': 0.5, 'C': 0.3 * rng.normal(size=(20, 2))}
+    init_state = rng.normal(size=(3, 2))
+
+    # the method names are built at runtime, so they are not interned and must be compared by value
+    t, X_odeint = fate(VecFld, init_state, t_end=1, direction='both', method=''.join(['ode', 'int']))
+    for method in ''.join(['rk', '4']), ''.join(['rk', '45']):
+        t_rk, X_rk = fate(VecFld, init_state, t_end=1, direction='both', method=method)
+        assert np.allclose(t_rk, t) and np.abs(X_rk - X_odeint).max() < 1e-5
+
+
+def test_moments_fit_resume(tmp_path):
+    """Fitting the moment model is deterministic across n_jobs and resumes from a checkpoint given without suffix."""
+    from anndata import AnnData
+    from dynamo.tools.moments import Estimation
+
+    rng = np.random.RandomState(0)
+    times = np.repeat([0., 1., 2., 4.], 15)
+    adata = AnnData(np.zeros((60, 4)), obs={'Time': times})
+    adata.layers['new'] = rng.poisson(np.outer(1 - np.exp(-times / 2), [2, 5, 8, 3])).astype(float)
+
+    est = Estimation(adata)
+    params, costs = est.fit(n_p0=2, random_seed=0)
+    params_thread, costs_thread = est.fit(n_p0=2, n_jobs=2, backend='thread', chunk_size=1, random_seed=0)
+    assert np.array_equal(params, params_thread) and np.array_equal(costs, costs_thread)
+
+    # a run interrupted after the first two genes
+    checkpoint = str(tmp_path / 'moments')
+    est.fit(n_p0=2, chunk_size=2, random_seed=0, checkpoint=checkpoint)
+    with np.load(checkpoint + '.npz') as f:
+        saved = dict(f)
+    saved['done'][2:], saved['params'][2:] = False, 0
+    saved['params'][:2] = -1  # marks the genes that must be loaded instead of refitted
+    np.savez(checkpoint + '.npz', **saved)
+
+    params_resumed, costs_resumed = est.fit(n_p0=2, chunk_size=2, random_seed=0, checkpoint=checkpoint)
+    assert np.all(params_resumed[:2] == -1) and np.array_equal(params[2:], params_resumed[2:])
+    assert np.array_equal(costs, costs_resumed)
+    with np.load(checkpoint + '.npz') as f:
+        assert f['done'].all()
+
+
+def test_velocity_grid_cache(tmp_path):
+    """velocity_grid reuses the grid of an embedding and keeps it out of the uns attribute."""
+    from anndata import AnnData
+    from dynamo.tools.Markov import velocity_grid
+
+    adata = AnnData(np.zeros((200, 3)))
+    adata.obsm['X_umap'] = np.random.RandomState(0).normal(size=(200, 2))
+
+    grid = velocity_grid(adata, xy_grid_nums=(10, 10))
+    assert velocity_grid(adata, xy_grid_nums=(10, 10)) is grid
+    assert velocity_grid(adata, xy_grid_nums=(10, 12)) is not grid
+    assert 'velocity_grid' not in adata.uns.keys()
+    adata.write_h5ad(tmp_path / 'adata.h5ad')
+
+
+def test_SparseVFC_chunked():
+    """On a well-conditioned problem the chunked SparseVFC reproduces the unchunked one."""
+    from dynamo.tools.scVectorField import SparseVFC
+
+    rng = np.random.RandomState(0)
+    X = rng.uniform(-2, 2, size=(500, 2))
+    Y = np.c_[-X[:, 1], X[:, 0]] + 0.05 * rng.normal(size=(500, 2))
+    Y[:20] = 3 * rng.normal(size=(20, 2))  # outliers
+    Grid = rng.uniform(-2, 2, size=(50, 2))
+
+    dense = SparseVFC(X, Y.copy(), Grid, M=30, beta=2)
+    chunked = SparseVFC(X, Y.copy(), Grid, M=30, beta=2, chunk_size=64)
+    for key in ['V', 'P', 'C', 'grid_V']:
+        assert np.allclose(dense[key], chunked[key], atol=1e-8)
+    assert np.array_equal(dense['VFCIndex'], chunked['VFCIndex'])
+
+
+def test_con_K_dtype():
+    """The chunked kernel has the same dtype and values as the unchunked one, and the non-autograd vector field
+    function matches the explicit kernel product."""
+    from dynamo.tools.scVectorField import con_K, auto_con_K, vectorfield
+
+    rng = np.random.RandomState(0)
+    x, y = rng.normal(size=(100, 3)), rng.normal(size=(20, 3)).astype(np.float32)
+    K = con_K(x, y, 0.5)
+    K_chunked = con_K(x, y, 0.5, chunk_size=16)
+    assert K.dtype == K_chunked.dtype == np.float64
+    assert np.allclose(K, K_chunked) and np.allclose(K, auto_con_K(x, y, 0.5))
+
+    VecFld = {'X': y, 'beta': 0.5, 'C': rng.normal(size=(20, 3))}
+    vf = vectorfield()
+    for x_i in [x, x[:1]]:
+        assert np.allclose(vf.vector_field_function_auto(x_i, VecFld),
+                           vf.vector_field_function_auto(x_i, VecFld, autograd=True))
+
+
+def test_neighbor_index_cache(tmp_path):
+    """The kNN index is reused across calls, rebuilt when the basis changes and kept out of the uns attribute."""
+    from anndata import AnnData
+    from dynamo.tools.connectivity import neighbor_index
+
+    rng = np.random.RandomState(0)
+    adata = AnnData(np.zeros((100, 3)))
+    adata.obsm['X_pca'] = rng.normal(size=(100, 5))
+
+    nbrs = neighbor_index(adata, n_neighbors=10)
+    assert neighbor_index(adata) is nbrs and neighbor_index(adata, dims=3) is not nbrs
+    assert np.array_equal(nbrs.kneighbors(n_neighbors=5, return_distance=False)[:, 0], np.arange(100))
+    adata.obsm['X_pca'] = adata.obsm['X_pca'] + 1
+    assert neighbor_index(adata) is not nbrs
+
+    assert 'neighbor_index' not in adata.uns.keys()
+    adata.write_h5ad(tmp_path / 'adata.h5ad')
+
+
+def test_neighbor_index_auto():
+    """`auto` only builds NN-descent for a few neighbors and answers queries for many neighbors exactly."""
+    from anndata import AnnData
+    from sklearn.neighbors import NearestNeighbors
+    from dynamo.tools.connectivity import neighbor_index
+
+    rng = np.random.RandomState(0)
+    adata = AnnData(np.zeros((4096, 3)))
+    adata.obsm['X_pca'] = rng.normal(size=(4096, 5))
+
+    assert neighbor_index(adata, n_neighbors=200, method='auto').method_ == 'exact'
+    nbrs = neighbor_index(adata, n_neighbors=15, method='auto', recompute=True)
+    assert nbrs.method_ == 'pynndescent'
+
+    dists = nbrs.kneighbors(n_neighbors=100)[0]
+    exact_dists = NearestNeighbors(n_neighbors=100).fit(adata.obsm['X_pca']).kneighbors(adata.obsm['X_pca'])[0]
+    assert np.allclose(dists, exact_dists)
+    assert neighbor_index(adata, method='exact').method_ == 'exact'
+
+
+def test_markov_chain_cache(tmp_path):
+    """The diffusion map and the stationary distribution share the cached chain, which is kept out of uns."""
+    from dynamo.tools.cell_velocities import _markov_chain
+
+    adata = _velocity_adata()
+    dyn.tl.cell_velocities(adata, vkey='pca', basis='umap', xy_grid_nums=(10, 10), calc_rnd_vel=True)
+    dyn.tl.generalized_diffusion_map(adata)
+    kmc = _markov_chain(adata)
+    D = kmc.D
+    dyn.tl.generalized_diffusion_map(adata, n_dims=3, t=[1, 2])
+    dyn.tl.stationary_distribution(adata)
+    assert _markov_chain(adata) is kmc and kmc.D is D
+    assert adata.obsm['X_diffusion_map_t2'].shape == (300, 3)
+
+    adata.uns['transition_matrix'] = adata.uns['transition_matrix'].copy()
+    assert _markov_chain(adata) is not kmc
+    adata.write_h5ad(tmp_path / 'adata.h5ad')